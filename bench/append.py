@@ -0,0 +1,65 @@
+"""Дописывание в один растущий ресурс: задержка первых и последних дописываний
+и чтение диапазона из конца большого ресурса.
+
+python -m bench.append [appends] [chunk_bytes]
+
+При O(1) дописывании p50 последних дописываний не растет вместе с ресурсом.
+"""
+import os
+import sys
+
+from bench.common import prepare_env, seed_json, measure, summarize, print_report
+
+root = prepare_env()
+APPENDS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+CHUNK = "ж" * ((int(sys.argv[2]) if len(sys.argv) > 2 else 200) // 2)
+
+import sqlite_storage  # noqa: E402
+import storage  # noqa: E402
+
+
+def make(case: str) -> storage.Storage:
+    users = str(root / "db.json")
+    resources = str(root / f"resources_{case}.json")
+    tokens = str(root / "db_refresh_tokens.json")
+    for path in (users, resources, tokens):
+        seed_json(path, {})
+    if case == "sqlite":
+        return sqlite_storage.SqliteStorage(str(root / "bench.sqlite3"), pool_size=2)
+    return storage.JsonStorage(
+        users, resources, tokens, wal=case.startswith("wal"), wal_compact_every=10**9,
+        wal_fsync=case == "wal_fsync",
+    )
+
+
+def run():
+    for case in ("wal_no_fsync", "sqlite"):
+        store = make(case)
+        store.create_resource("bench", {"content": "", "is_public": True})
+        samples = []
+        for i in range(APPENDS):
+            samples.append(
+                measure(store.append_resource, 1, "bench", CHUNK, True)["p50_us"]
+            )
+        tenth = max(1, APPENDS // 10)
+        size = store.get_resource_meta("bench")["size"]
+        tail = measure(
+            lambda: b"".join(store.read_resource("bench", size - 1024, size)), 200
+        )
+        print_report(
+            "append",
+            {
+                "case": case,
+                "appends": APPENDS,
+                "size_bytes": size,
+                "first_p50_us": summarize(samples[:tenth])["p50_us"],
+                "last_p50_us": summarize(samples[-tenth:])["p50_us"],
+                "tail_1k_read_p50_us": tail["p50_us"],
+            },
+        )
+        store.close()
+    os.unlink(str(root / "bench.sqlite3"))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,82 @@
+"""Стоимость авторизации на декорированных эндпоинтах: задержка,
+число jwt.decode и поисков юзера в хранилище на один запрос.
+
+python -m bench.auth_path [users]
+
+Для сравнения "до/после" запустить на нужных коммитах.
+"""
+import sys
+
+from bench.common import (
+    prepare_env,
+    seed_users,
+    seed_json,
+    measure,
+    print_report,
+    BENCH_PASSWORD,
+)
+
+root = prepare_env()
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+seed_users(
+    str(root / "db.json"),
+    USERS,
+    extra={"bench_user": ["user", "guest"], "bench_public": ["user"]},
+)
+seed_json(
+    str(root / "resources.json"),
+    {
+        "bench_user": {"content": "мой профиль", "is_public": False},
+        "bench_public": {"content": "открытый профиль", "is_public": True},
+    },
+)
+seed_json(str(root / "db_refresh_tokens.json"), {})
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+import security  # noqa: E402
+from db import storage  # noqa: E402
+
+counters = {"jwt_decode": 0, "user_lookup": 0}
+
+
+def counted(name, fn):
+    def wrapper(*args, **kwargs):
+        counters[name] += 1
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+security.jwt.decode = counted("jwt_decode", security.jwt.decode)
+storage.get_user = counted("user_lookup", storage.get_user)
+
+ROUTES = [
+    ("GET", "/guest"),
+    ("GET", "/user"),
+    ("GET", "/protected_resource/bench_user"),
+    ("GET", "/protected_resource/bench_public"),
+]
+
+
+def run():
+    client = TestClient(main.app)
+    response = client.post("/login", auth=("bench_user", BENCH_PASSWORD))
+    assert response.status_code == 200, response.text
+    for method, path in ROUTES:
+        # лимиты сбрасываются вне замера, чтобы не упираться в 429
+        response = client.request(method, path)
+        assert response.status_code == 200, response.text
+        for key in counters:
+            counters[key] = 0
+        iterations = 2000
+        report = measure(
+            lambda: client.request(method, path), iterations, setup=main.limiter.reset
+        )
+        per_request = {key: value / iterations for key, value in counters.items()}
+        print_report("auth_path", {"route": f"{method} {path}", "users": USERS, **per_request, **report})
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,72 @@
+"""Чтение ресурсов многих юзеров: N запросов GET /protected_resource/{user_name}
+против POST /protected_resource/batch/get пачками.
+
+python -m bench.batch [resources] [batch_size]
+
+STORAGE_BACKEND=sqlite переключает хранилище.
+"""
+import asyncio
+import sys
+import time
+
+from bench.common import prepare_env, seed_users, seed_json, print_report, BENCH_PASSWORD
+
+root = prepare_env()
+RESOURCES = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+BATCH = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+names = seed_users(str(root / "db.json"), RESOURCES, extra={"bench_admin": ["admin"]})
+seed_json(
+    str(root / "resources.json"),
+    {name: {"content": "Мне 20 лет. " * 10, "is_public": False} for name in names},
+)
+seed_json(str(root / "db_refresh_tokens.json"), {})
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+import storage_cli  # noqa: E402
+from settings import settings  # noqa: E402
+
+if settings.storage_backend == "sqlite":
+    storage_cli.migrate(settings.sqlite_path)
+
+
+async def run():
+    main.limiter.enabled = False
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.post("/login", auth=("bench_admin", BENCH_PASSWORD))
+        token = response.json()["access_token"].removeprefix("Bearer ")
+        client.cookies.set("access_token", token)
+        client.headers["Authorization"] = f"Bearer {token}"
+
+        start = time.perf_counter()
+        for name in names:
+            response = await client.get(f"/protected_resource/{name}")
+            assert response.status_code == 200, response.text
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(0, len(names), BATCH):
+            response = await client.post(
+                "/protected_resource/batch/get", json={"usernames": names[i : i + BATCH]}
+            )
+            assert response.json()["failed"] == 0, response.text
+        batched = time.perf_counter() - start
+
+    print_report(
+        "batch",
+        {
+            "backend": settings.storage_backend,
+            "resources": RESOURCES,
+            "batch_size": BATCH,
+            "single_ms": round(single * 1000, 1),
+            "batch_ms": round(batched * 1000, 1),
+            "speedup": round(single / batched, 1),
+        },
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,91 @@
+"""Общие утилиты бенчмарков: синтетическая db во временной папке и замеры задержек"""
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+# хеш bcrypt для пароля BENCH_PASSWORD (rounds=4), чтобы не считать его на каждого юзера
+BENCH_PASSWORD = "password123"
+FAKE_HASH = "$2b$04$gpj2jocW7meLLTxwAgF1CeXmT1mxo6dgDEYG5x6v9ldtZmDKJOQqm"
+
+
+def prepare_env(tmpdir: str | None = None) -> Path:
+    """Настройки приложения через переменные окружения. Вызывать ДО импорта модулей приложения"""
+    root = Path(tmpdir or tempfile.mkdtemp(prefix="bench_db_"))
+    defaults = {
+        "SECRET_KEY": "bench-secret-key-of-at-least-32-bytes",
+        "ALGORITHM": "HS256",
+        "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+        "REFRESH_TOKEN_EXPIRE_MINUTES": "600",
+        "DB": str(root / "db.json"),
+        "DB_resources": str(root / "resources.json"),
+        "DB_REFRESH_TOKENS": str(root / "db_refresh_tokens.json"),
+        "JWT_decode_method": "cookie",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    return root
+
+
+def seed_users(path: str, count: int, roles=("guest",), extra: dict | None = None) -> list[str]:
+    """Пишет db.json с count юзерами user0..userN, возвращает их имена"""
+    names = [f"user{i}" for i in range(count)]
+    data = {
+        str(uuid.uuid4()): {
+            "username": name,
+            "hashed_password": FAKE_HASH,
+            "roles": list(roles),
+        }
+        for name in names
+    }
+    # отдельные юзеры с нужными ролями, например {"bench_admin": ["admin"]}
+    for name, user_roles in (extra or {}).items():
+        data[str(uuid.uuid4())] = {
+            "username": name,
+            "hashed_password": FAKE_HASH,
+            "roles": user_roles,
+        }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    return names
+
+
+def seed_json(path: str, data: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def measure(fn, iterations: int, *args, setup=None) -> dict:
+    """Прогоняет fn iterations раз, возвращает задержки в микросекундах.
+    setup вызывается перед каждым прогоном и в замер не входит"""
+    samples = []
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter_ns()
+        fn(*args)
+        samples.append((time.perf_counter_ns() - start) / 1000)
+    return summarize(samples)
+
+
+def summarize(samples_us: list[float]) -> dict:
+    samples_us = sorted(samples_us)
+    n = len(samples_us)
+
+    def pct(p):
+        return samples_us[min(n - 1, int(p * n))]
+
+    return {
+        "n": n,
+        "mean_us": round(statistics.fmean(samples_us), 2),
+        "p50_us": round(pct(0.50), 2),
+        "p95_us": round(pct(0.95), 2),
+        "p99_us": round(pct(0.99), 2),
+    }
+
+
+def print_report(name: str, report: dict):
+    print(json.dumps({"bench": name, **report}, ensure_ascii=False))
@@ -0,0 +1,88 @@
+"""500 одновременных клиентов: каждый читает и дописывает свой ресурс
+
+python -m bench.concurrency [clients] [rounds]
+
+Переменная STORAGE_BACKEND=sqlite переключает хранилище.
+"""
+import asyncio
+import sys
+import time
+
+from bench.common import (
+    prepare_env,
+    seed_users,
+    seed_json,
+    summarize,
+    print_report,
+    BENCH_PASSWORD,
+)
+
+root = prepare_env()
+CLIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+names = seed_users(str(root / "db.json"), CLIENTS, roles=("user",))
+seed_json(
+    str(root / "resources.json"),
+    {name: {"content": "", "is_public": False} for name in names},
+)
+seed_json(str(root / "db_refresh_tokens.json"), {})
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+import storage_cli  # noqa: E402
+from settings import settings  # noqa: E402
+
+if settings.storage_backend == "sqlite":
+    storage_cli.migrate(settings.sqlite_path)
+
+
+async def client_session(app, name: str, samples: dict, window: list):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # логины упираются в очередь bcrypt (503), клиент ждет Retry-After и повторяет
+        response = await client.post("/login", auth=(name, BENCH_PASSWORD))
+        while response.status_code == 503:
+            await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+            response = await client.post("/login", auth=(name, BENCH_PASSWORD))
+        assert response.status_code == 200, response.text
+        for i in range(ROUNDS):
+            for method, kwargs in (
+                ("GET", {}),
+                ("PUT", {"json": {"content": f"{i};", "is_public": False}}),
+            ):
+                start = time.perf_counter_ns()
+                response = await client.request(method, f"/protected_resource/{name}", **kwargs)
+                end = time.perf_counter_ns()
+                samples[method].append((end - start) / 1000)
+                window[0] = min(window[0], start)
+                window[1] = max(window[1], end)
+                assert response.status_code == 200, response.text
+
+
+async def run():
+    main.limiter.enabled = False
+    samples = {"GET": [], "PUT": []}
+    # время от первого до последнего замеренного запроса, без фазы логина
+    window = [float("inf"), 0]
+    await asyncio.gather(
+        *(client_session(main.app, name, samples, window) for name in names)
+    )
+    total = sum(len(v) for v in samples.values())
+    elapsed = (window[1] - window[0]) / 1e9
+    for method, values in samples.items():
+        print_report(
+            "concurrency",
+            {
+                "backend": settings.storage_backend,
+                "clients": CLIENTS,
+                "method": method,
+                "rps_total": round(total / elapsed, 1),
+                **summarize(values),
+            },
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
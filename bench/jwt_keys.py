@@ -0,0 +1,64 @@
+"""Подпись и проверка jwt по алгоритмам: HS256, RS256, PS256, ES256, EdDSA.
+
+python -m bench.jwt_keys [iterations]
+
+verify_pem - проверка с разбором pem на каждый токен, как было бы без KeyRing.
+Разница verify_pem и verify - цена разбора ключа, которую экономит предзагрузка.
+"""
+import sys
+import tempfile
+import time
+
+from bench.common import prepare_env, measure, print_report
+
+prepare_env()
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+import jwt  # noqa: E402
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+
+from keys import KeyRing, VerifyKey, write_key_pair  # noqa: E402
+
+ALGORITHMS = ("HS256", "RS256", "PS256", "ES256", "EdDSA")
+
+
+def make_ring(algorithm: str, directory: str) -> tuple[KeyRing, bytes | None]:
+    """KeyRing и открытый ключ в pem (для HS - None)"""
+    if algorithm == "HS256":
+        return KeyRing(algorithm, "bench", "bench-secret-key-of-at-least-32-bytes", []), None
+    private_path, public_path = write_key_pair(algorithm, f"bench_{algorithm}", directory)
+    private_key = serialization.load_pem_private_key(private_path.read_bytes(), None)
+    ring = KeyRing(
+        algorithm, "bench", private_key, [VerifyKey("bench", algorithm, private_key.public_key())]
+    )
+    return ring, public_path.read_bytes()
+
+
+def run():
+    claims = {"sub": "bench_user", "type": "ACCESS", "exp": int(time.time()) + 3600}
+    with tempfile.TemporaryDirectory() as directory:
+        for algorithm in ALGORITHMS:
+            ring, public_pem = make_ring(algorithm, directory)
+            token = ring.sign(claims)
+            sign = measure(ring.sign, ITERATIONS, claims)
+            verify = measure(ring.verify, ITERATIONS, token)
+            report = {
+                "algorithm": algorithm,
+                "token_bytes": len(token),
+                "sign_p50_us": sign["p50_us"],
+                "sign_per_s": round(1e6 / sign["mean_us"]),
+                "verify_p50_us": verify["p50_us"],
+                "verify_per_s": round(1e6 / verify["mean_us"]),
+            }
+            if public_pem is not None:
+
+                def verify_pem():
+                    key = serialization.load_pem_public_key(public_pem)
+                    jwt.decode(token, key, algorithms=[algorithm])
+
+                report["verify_pem_p50_us"] = measure(verify_pem, ITERATIONS)["p50_us"]
+            print_report("jwt_keys", report)
+
+
+if __name__ == "__main__":
+    run()
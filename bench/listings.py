@@ -0,0 +1,106 @@
+"""Списки для админки на N юзеров: страница по курсору и выгрузка NDJSON, json и sqlite.
+
+python -m bench.listings [users]
+
+index_build_ms - первая страница json бэкенда, когда строится индекс ролей.
+page_*_us - страница из 100 строк из середины: все юзеры, роль admin (1% юзеров),
+публичные ресурсы (половина из 10% юзеров с ресурсом). export_* - выгрузка всех юзеров
+через listings.ndjson_rows: время и пик памяти сверх уже загруженных данных
+(tracemalloc), против сборки всего списка сразу (materialized_peak_mb).
+"""
+import asyncio
+import sys
+import time
+import tracemalloc
+import uuid
+
+from bench.common import prepare_env, measure, print_report, seed_json, FAKE_HASH
+
+root = prepare_env()
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+# listings импортирует db, а тот открывает хранилище из настроек: пустые файлы
+for name in ("db.json", "resources.json", "db_refresh_tokens.json"):
+    seed_json(str(root / name), {})
+
+import listings  # noqa: E402
+from fastjson import dumps  # noqa: E402
+from sqlite_storage import SqliteStorage  # noqa: E402
+from storage import JsonStorage, chunked_resource, save_to_db  # noqa: E402
+
+PAGE = 100
+
+
+def seed(users_path: str, resources_path: str) -> tuple[dict, dict]:
+    users = {
+        str(uuid.uuid4()): {
+            "username": f"user{i:07d}",
+            "hashed_password": FAKE_HASH,
+            "roles": ["admin"] if i % 100 == 0 else ["guest"],
+        }
+        for i in range(USERS)
+    }
+    resources = {
+        f"user{i:07d}": chunked_resource("Мне 20 лет.", i % 20 == 0) for i in range(0, USERS, 10)
+    }
+    save_to_db(users_path, users)
+    save_to_db(resources_path, resources)
+    return users, resources
+
+
+def export(store) -> tuple[int, float]:
+    async def fetch(after, limit):
+        return store.list_users(None, after, limit)
+
+    async def drain():
+        size = 0
+        async for chunk in listings.ndjson_rows(fetch, "username"):
+            size += len(chunk)
+        return size
+
+    start = time.perf_counter()
+    size = asyncio.run(drain())
+    return size, (time.perf_counter() - start) * 1000
+
+
+def peak_mb(fn) -> float:
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return round(peak / 2**20, 1)
+
+
+def run():
+    users_path, resources_path = str(root / "list_users.json"), str(root / "list_resources.json")
+    seed_json(str(root / "list_tokens.json"), {})
+    users, resources = seed(users_path, resources_path)
+    json_store = JsonStorage(users_path, resources_path, str(root / "list_tokens.json"))
+    sqlite_store = SqliteStorage(str(root / "list.sqlite3"), pool_size=1)
+    sqlite_store.import_data(users, resources, {})
+    del users, resources
+    json_store.users.data()
+    json_store.resources.data()
+
+    middle = f"user{USERS // 2:07d}"
+    for name, store in (("json", json_store), ("sqlite", sqlite_store)):
+        report = {"backend": name, "users": USERS}
+        if name == "json":
+            start = time.perf_counter()
+            store.list_users(None, "", 1)
+            store.list_public_resources("", 1)
+            report["index_build_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        report["page_all_us"] = measure(store.list_users, 2000, None, middle, PAGE)["p50_us"]
+        report["page_admin_us"] = measure(store.list_users, 2000, "admin", middle, PAGE)["p50_us"]
+        report["page_public_us"] = measure(store.list_public_resources, 2000, middle, PAGE)["p50_us"]
+        size, elapsed = export(store)
+        report["export_mb"] = round(size / 2**20, 1)
+        report["export_ms"] = round(elapsed, 1)
+        report["export_peak_mb"] = peak_mb(lambda: export(store))
+        report["materialized_peak_mb"] = peak_mb(
+            lambda: b"\n".join(dumps(row) for row in store.list_users(None, "", USERS))
+        )
+        print_report("listings", report)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,96 @@
+"""p99 задержки /guest, пока в полете пачка логинов с bcrypt rounds=12
+
+python -m bench.password_pool [logins] [--inline]
+
+--inline считает bcrypt прямо в event loop, как было до пула
+"""
+import asyncio
+import json
+import sys
+import time
+
+from bench.common import prepare_env, seed_json, summarize, print_report, BENCH_PASSWORD
+
+root = prepare_env()
+
+from passlib.context import CryptContext  # noqa: E402
+
+SLOW_HASH = CryptContext(schemes=["bcrypt"], bcrypt__rounds=12).hash(BENCH_PASSWORD)
+seed_json(
+    str(root / "db.json"),
+    {
+        "bench-guest": {"username": "bench_guest", "hashed_password": SLOW_HASH, "roles": ["guest"]},
+    },
+)
+seed_json(str(root / "resources.json"), {})
+seed_json(str(root / "db_refresh_tokens.json"), {})
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from passwords import password_pool  # noqa: E402
+
+LOGINS = int(next((a for a in sys.argv[1:] if a.isdigit()), "32"))
+INLINE = "--inline" in sys.argv
+
+
+async def probe(client, stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        start = time.perf_counter_ns()
+        response = await client.get("/guest")
+        assert response.status_code == 200, response.text
+        samples.append((time.perf_counter_ns() - start) / 1000)
+        await asyncio.sleep(0.005)
+
+
+async def run():
+    if INLINE:
+        async def inline(fn, *args):
+            return fn(*args)
+
+        password_pool.run = inline
+    main.limiter.enabled = False
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.post("/login", auth=("bench_guest", BENCH_PASSWORD))
+        assert response.status_code == 200, response.text
+
+        idle = []
+        stop = asyncio.Event()
+        task = asyncio.create_task(probe(client, stop, idle))
+        await asyncio.sleep(1)
+        stop.set()
+        await task
+
+        busy = []
+        stop = asyncio.Event()
+        task = asyncio.create_task(probe(client, stop, busy))
+        started = time.perf_counter()
+        logins = await asyncio.gather(
+            *(
+                client.post("/login", auth=("bench_guest", BENCH_PASSWORD))
+                for _ in range(LOGINS)
+            )
+        )
+        burst_seconds = time.perf_counter() - started
+        stop.set()
+        await task
+
+    mode = "inline" if INLINE else f"pool_{password_pool.kind}"
+    print_report("password_pool", {"mode": mode, "phase": "idle", **summarize(idle)})
+    print_report(
+        "password_pool",
+        {
+            "mode": mode,
+            "phase": f"burst_{LOGINS}_logins",
+            "burst_seconds": round(burst_seconds, 3),
+            "login_statuses": sorted({r.status_code for r in logins}),
+            **summarize(busy),
+        },
+    )
+    if not INLINE:
+        print(json.dumps({"pool": password_pool.stats()}))
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,86 @@
+"""Сборка юзера из словаря хранилища: pydantic UserInDB против UserRecord, то же для ресурсов.
+
+python -m bench.records [users]
+
+blocks_per_lookup - сколько блоков памяти остается живыми на одну собранную запись
+(sys.getallocatedblocks), bytes_per_lookup - их размер по tracemalloc, table_mb - память
+под users собранных записей сразу (как если бы их держал кэш на 1M юзеров).
+Роли у половины юзеров guest, у остальных user и admin: как и в жизни, наборов ролей мало.
+"""
+import gc
+import sys
+import tracemalloc
+
+from bench.common import prepare_env, measure, print_report, FAKE_HASH
+
+prepare_env()
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+from models import UserInDB, Resourse_info  # noqa: E402
+from records import user_record, resource_record  # noqa: E402
+
+
+def pydantic_user(data: dict):
+    return UserInDB(
+        username=data["username"], hashed_password=data["hashed_password"], roles=data["roles"]
+    )
+
+
+def pydantic_resource(data: dict):
+    return Resourse_info(**data)
+
+
+def footprint(build, rows: list[dict]) -> dict:
+    """Блоки и байты, которые остаются живыми после сборки записей по всем rows"""
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    kept = [build(row) for row in rows]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks
+    del kept
+    return {
+        "blocks_per_lookup": round(blocks / len(rows), 2),
+        "bytes_per_lookup": round(size / len(rows), 1),
+        "table_mb": round(size / 2**20, 1),
+    }
+
+
+def run():
+    # словари как из хранилища: они уже есть до поиска и в замер не входят
+    users = [
+        {
+            "username": f"user{i}",
+            "hashed_password": FAKE_HASH,
+            "roles": ["guest"] if i % 2 else ["user", "admin"],
+        }
+        for i in range(USERS)
+    ]
+    resources = [
+        {"content": "Мне 20 лет.", "is_public": bool(i % 2), "version": f"v{i}"}
+        for i in range(min(USERS, 100_000))
+    ]
+    cases = (
+        ("user", "pydantic", pydantic_user, users),
+        ("user", "record", user_record, users),
+        ("resource", "pydantic", pydantic_resource, resources),
+        ("resource", "record", resource_record, resources),
+    )
+    for kind, name, build, rows in cases:
+        timing = measure(lambda: build(rows[0]), 200_000)
+        print_report(
+            "records",
+            {
+                "kind": kind,
+                "case": name,
+                "rows": len(rows),
+                "p50_us": timing["p50_us"],
+                "mean_us": timing["mean_us"],
+                **footprint(build, rows),
+            },
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,91 @@
+"""Хранилище рефреш токенов: ротация при разном числе токенов в хранилище и чистка истекших.
+
+python -m bench.refresh [tokens] [rotations]
+
+tokens - сколько токенов лежит в хранилище (половина уже истекла).
+Ротация идет по jti, поэтому ее p50 не должен зависеть от tokens.
+"""
+import os
+import sys
+import time
+import uuid
+
+from bench.common import prepare_env, seed_json, summarize, print_report
+
+root = prepare_env()
+TOKENS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+ROTATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+import sqlite_storage  # noqa: E402
+import storage  # noqa: E402
+
+
+def seed(count: int, now: float) -> dict:
+    """count токенов у count // 4 юзеров, четные уже истекли"""
+    return {
+        uuid.uuid4().hex: storage.refresh_record(
+            f"user{i // 4}", f"fam{i // 2}", int(now) + (-60 if i % 2 == 0 else 3600)
+        )
+        for i in range(count)
+    }
+
+
+def make(case: str, tokens: dict) -> storage.Storage:
+    users = str(root / "db.json")
+    resources = str(root / "resources.json")
+    # свой файл на каждый прогон, журнал от прошлого прогона не подхватывается
+    tokens_path = str(root / f"tokens_{case}_{len(tokens)}.json")
+    for path in (users, resources):
+        seed_json(path, {})
+    if case == "sqlite":
+        seed_json(tokens_path, {})
+        store = sqlite_storage.SqliteStorage(str(root / "bench.sqlite3"), pool_size=2)
+        store.import_data({}, {}, tokens)
+        return store
+    seed_json(tokens_path, tokens)
+    return storage.JsonStorage(
+        users, resources, tokens_path, wal=True, wal_compact_every=10**9, wal_fsync=False
+    )
+
+
+def run():
+    now = time.time()
+    for size in (TOKENS // 100, TOKENS):
+        tokens = seed(size, now)
+        for case in ("wal_no_fsync", "sqlite"):
+            store = make(case, tokens)
+            jti = uuid.uuid4().hex
+            store.save_refresh_token(jti, storage.refresh_record("bench", "bench", int(now) + 3600))
+            samples = []
+            for _ in range(ROTATIONS):
+                new_jti = uuid.uuid4().hex
+                record = storage.refresh_record("bench", "bench", int(now) + 3600)
+                start = time.perf_counter_ns()
+                status = store.rotate_refresh_token(jti, new_jti, record, now)
+                samples.append((time.perf_counter_ns() - start) / 1000)
+                assert status == "ok", status
+                jti = new_jti
+            # повтор уже замененного токена: семья отзывается
+            assert store.rotate_refresh_token(jti, "x", record, now) == "ok"
+            assert store.rotate_refresh_token(jti, "y", record, now) == "reused"
+            start = time.perf_counter()
+            swept = store.sweep_refresh_tokens(now)
+            sweep_ms = (time.perf_counter() - start) * 1000
+            print_report(
+                "refresh",
+                {
+                    "case": case,
+                    "tokens": size,
+                    "rotate_p50_us": summarize(samples)["p50_us"],
+                    "rotate_p99_us": summarize(samples)["p99_us"],
+                    "swept": swept,
+                    "sweep_ms": round(sweep_ms, 2),
+                },
+            )
+            store.close()
+            if case == "sqlite":
+                os.unlink(str(root / "bench.sqlite3"))
+
+
+if __name__ == "__main__":
+    run()
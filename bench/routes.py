@@ -0,0 +1,326 @@
+"""Нагрузочный прогон всех маршрутов main.py: пропускная способность и p50/p95/p99.
+
+python -m bench.routes [--transport asgi|http] [--users N] [--resources N]
+                       [--tokens N] [--requests N] [--concurrency N]
+                       [--only ИМЯ ...] [--out results.json] [--compare base.json]
+
+asgi - приложение вызывается в процессе через httpx.ASGITransport,
+http - через настоящий сокет uvicorn на 127.0.0.1 (поток в этом же процессе).
+Каждая строка вывода - JSON одного сценария, --out сохраняет весь прогон,
+--compare печатает изменение задержек и rps относительно сохраненного прогона.
+Лимитер на время прогона выключен, считаются только сами обработчики.
+Цена метрик: прогон с METRICS_ENABLED=0 --out base.json, затем с 1 и --compare base.json.
+"""
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+from bench.common import (
+    prepare_env,
+    seed_users,
+    seed_json,
+    summarize,
+    print_report,
+    BENCH_PASSWORD,
+)
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument("--transport", choices=("asgi", "http"), default="asgi")
+parser.add_argument("--users", type=int, default=10000, help="юзеров в db.json")
+parser.add_argument("--resources", type=int, default=10000, help="ресурсов в resources.json")
+parser.add_argument("--tokens", type=int, default=10000, help="рефреш токенов в db")
+parser.add_argument("--requests", type=int, default=2000, help="запросов на сценарий")
+parser.add_argument("--concurrency", type=int, default=20, help="одновременных клиентов")
+parser.add_argument("--only", nargs="*", help="прогнать только эти сценарии")
+parser.add_argument("--out", help="сохранить результаты в файл")
+parser.add_argument("--compare", help="сравнить с сохраненным прогоном")
+args = parser.parse_args()
+
+root = prepare_env()
+# клиенты бенчмарка: юзер с ролями user+guest и админ на каждого
+workers = [f"bench_user{i}" for i in range(args.concurrency)]
+admins = [f"bench_admin{i}" for i in range(args.concurrency)]
+names = seed_users(
+    str(root / "db.json"),
+    args.users,
+    extra={
+        **{name: ["user", "guest"] for name in workers},
+        **{name: ["admin"] for name in admins},
+    },
+)
+resources = {
+    name: {"content": "синтетический профиль;", "is_public": i % 2 == 0}
+    for i, name in enumerate(names[: args.resources])
+}
+resources.update({name: {"content": "", "is_public": False} for name in workers})
+seed_json(str(root / "resources.json"), resources)
+# сколько юзеров из names имеют ресурс
+seeded = max(1, min(args.resources, args.users))
+# рефреш токены остальных юзеров нужны только для объема хранилища
+seed_json(
+    str(root / "db_refresh_tokens.json"),
+    {
+        f"stale{i}": {
+            "sub": name,
+            "fam": f"stale{i}",
+            "exp": int(time.time()) + 3600,
+            "used": False,
+        }
+        for i, name in enumerate(names[: args.tokens])
+    },
+)
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+import main  # noqa: E402
+import storage_cli  # noqa: E402
+from settings import settings  # noqa: E402
+
+if settings.storage_backend == "sqlite":
+    storage_cli.migrate(settings.sqlite_path)
+
+
+class Session:
+    """Залогиненный клиент: токены в куке и в заголовке, подходит для обоих JWT_decode_method"""
+
+    def __init__(self, client: httpx.AsyncClient, username: str):
+        self.client = client
+        self.username = username
+        self.refresh_token = None
+        # счетчик для уникальных имен создаваемых ресурсов
+        self.counter = 0
+
+    async def login(self):
+        response = await self.client.post("/login", auth=(self.username, BENCH_PASSWORD))
+        # логины упираются в очередь bcrypt (503), ждем Retry-After и повторяем
+        while response.status_code == 503:
+            await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+            response = await self.client.post(
+                "/login", auth=(self.username, BENCH_PASSWORD)
+            )
+        assert response.status_code == 200, response.text
+        self.set_tokens(response.json())
+
+    def set_tokens(self, body: dict):
+        access_token = body["access_token"].removeprefix("Bearer ")
+        self.client.cookies.set("access_token", access_token)
+        self.client.headers["Authorization"] = f"Bearer {access_token}"
+        self.refresh_token = body["refresh_token"]
+
+
+# сценарии: имя -> (чья сессия, функция запроса, ожидаемый статус)
+# функция получает сессию и номер запроса и возвращает httpx.Response
+async def do_login(s: Session, i: int):
+    response = await s.client.post("/login", auth=(s.username, BENCH_PASSWORD))
+    # новый логин начинает новую семью, старый рефреш токен сессии тоже жив
+    if response.status_code == 200:
+        s.set_tokens(response.json())
+    return response
+
+
+async def do_refresh(s: Session, i: int):
+    response = await s.client.post("/refresh", json={"refresh_token": s.refresh_token})
+    if response.status_code == 200:
+        s.set_tokens(response.json())
+    return response
+
+
+async def do_get_own(s: Session, i: int):
+    return await s.client.get(f"/protected_resource/{s.username}")
+
+
+async def do_get_other(s: Session, i: int):
+    # чужие ресурсы: четные открыты, нечетные закрыты, админу можно все
+    return await s.client.get(f"/protected_resource/{names[i % seeded]}")
+
+
+async def do_get_public(s: Session, i: int):
+    # один и тот же публичный ресурс (names[0]) - кэш ответов
+    return await s.client.get(f"/protected_resource/{names[0]}")
+
+
+async def do_get_not_modified(s: Session, i: int):
+    # условный GET: клиент уже знает ETag, ждем 304
+    if not hasattr(s, "etag"):
+        s.etag = (await s.client.get(f"/protected_resource/{names[0]}")).headers["ETag"]
+    return await s.client.get(
+        f"/protected_resource/{names[0]}", headers={"If-None-Match": s.etag}
+    )
+
+
+async def do_post(s: Session, i: int):
+    s.counter += 1
+    return await s.client.post(
+        f"/protected_resource/{s.username}_new{s.counter}",
+        json={"content": "новый ресурс;", "is_public": False},
+    )
+
+
+async def do_put(s: Session, i: int):
+    return await s.client.put(
+        f"/protected_resource/{s.username}",
+        json={"content": f"{i};", "is_public": False},
+    )
+
+
+async def do_delete(s: Session, i: int):
+    # удаляет ресурсы, созданные сценарием post, по одному
+    if s.counter == 0:
+        return await s.client.delete(f"/protected_resource/{s.username}_missing")
+    name = f"{s.username}_new{s.counter}"
+    s.counter -= 1
+    return await s.client.delete(f"/protected_resource/{name}")
+
+
+def get_page(path: str):
+    async def do(s: Session, i: int):
+        return await s.client.get(path)
+
+    return do
+
+
+async def do_set_roles(s: Session, i: int):
+    return await s.client.post(
+        "/set_roles", json={"username": names[i % len(names)], "roles": ["guest"]}
+    )
+
+
+SCENARIOS = {
+    "login": ("user", do_login, 200),
+    "refresh": ("user", do_refresh, 200),
+    "get_own_resource": ("user", do_get_own, 200),
+    "get_other_resource": ("user", do_get_other, None),
+    "get_resource_admin": ("admin", do_get_other, 200),
+    "get_public_cached": ("user", do_get_public, 200),
+    "get_not_modified": ("user", do_get_not_modified, 304),
+    "post_resource": ("admin", do_post, 200),
+    "put_resource": ("user", do_put, 200),
+    "delete_resource": ("admin", do_delete, 200),
+    "guest_page": ("user", get_page("/guest"), 200),
+    "user_page": ("user", get_page("/user"), 200),
+    "admin_page": ("admin", get_page("/admin"), 200),
+    "protected_resource": ("admin", get_page("/protected_resource"), 200),
+    "set_roles": ("admin", do_set_roles, 200),
+    "jwks": ("user", get_page("/.well-known/jwks.json"), 200),
+}
+
+
+async def run_scenario(name: str, sessions: dict) -> dict:
+    kind, request, expected = SCENARIOS[name]
+    clients = sessions[kind]
+    per_client = max(1, args.requests // len(clients))
+    samples = []
+    errors = 0
+
+    async def worker(s: Session):
+        nonlocal errors
+        for i in range(per_client):
+            start = time.perf_counter_ns()
+            response = await request(s, i)
+            samples.append((time.perf_counter_ns() - start) / 1000)
+            if expected is None:
+                # для чужих ресурсов нормальны и 200, и 403
+                if response.status_code not in (200, 403):
+                    errors += 1
+            elif response.status_code != expected:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(s) for s in clients))
+    elapsed = time.perf_counter() - start
+    return {
+        "scenario": name,
+        "transport": args.transport,
+        "backend": settings.storage_backend,
+        "concurrency": len(clients),
+        "errors": errors,
+        "rps": round(len(samples) / elapsed, 1),
+        **summarize(samples),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server():
+    """uvicorn в отдельном потоке, возвращает сервер и base_url"""
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def make_client(base_url: str) -> httpx.AsyncClient:
+    if args.transport == "asgi":
+        return httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app), base_url="http://bench"
+        )
+    return httpx.AsyncClient(
+        base_url=base_url, limits=httpx.Limits(max_connections=None), timeout=60
+    )
+
+
+def compare(results: list[dict], path: str):
+    """Изменение относительно базового прогона в процентах, минус - быстрее"""
+    with open(path, encoding="utf-8") as f:
+        base = {r["scenario"]: r for r in json.load(f)["results"]}
+    for result in results:
+        old = base.get(result["scenario"])
+        if old is None:
+            continue
+        delta = {
+            key: round((result[key] - old[key]) / old[key] * 100, 1)
+            for key in ("rps", "p50_us", "p95_us", "p99_us")
+            if old.get(key)
+        }
+        print_report("routes_compare", {"scenario": result["scenario"], **delta})
+
+
+async def run():
+    main.limiter.enabled = False
+    server = thread = None
+    base_url = None
+    if args.transport == "http":
+        server, thread, base_url = start_server()
+    sessions = {"user": [], "admin": []}
+    try:
+        for kind, usernames in (("user", workers), ("admin", admins)):
+            for username in usernames:
+                sessions[kind].append(Session(make_client(base_url), username))
+            await asyncio.gather(*(s.login() for s in sessions[kind]))
+
+        results = []
+        for name in args.only or SCENARIOS:
+            result = await run_scenario(name, sessions)
+            results.append(result)
+            print_report("routes", result)
+    finally:
+        for s in sessions["user"] + sessions["admin"]:
+            await s.client.aclose()
+        if server is not None:
+            server.should_exit = True
+            thread.join()
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(
+                {"args": vars(args), "results": results}, f, ensure_ascii=False, indent=4
+            )
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,121 @@
+"""Поиск по контенту N ресурсов: обратный индекс (json) и FTS5 (sqlite) против перебора.
+
+python -m bench.search [resources]
+
+Контент - 40 слов из словаря на кириллице с частотами по Ципфу, половина ресурсов
+публичные. index_build_ms - первый поиск json бэкенда, когда строится индекс,
+sqlite_import_s - импорт с заполнением search_chunks. query_*_us - страница из 20
+лучших: rare - редкое слово, common - частое, and - два слова сразу; user - чужие
+только публичные, admin - все. scan_us - тот же rare перебором контента всех ресурсов.
+append_us - дописывание куска с обновлением индекса, json - только индекс в памяти
+(запись файла в нем не меряется), sqlite - вся транзакция с FTS5.
+"""
+import random
+import sys
+import time
+
+from bench.common import prepare_env, measure, print_report, seed_json
+
+root = prepare_env()
+RESOURCES = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+# storage импортирует настройки, а они проверяют файлы из окружения
+for name in ("db.json", "resources.json", "db_refresh_tokens.json"):
+    seed_json(str(root / name), {})
+
+from search import tokenize  # noqa: E402
+from sqlite_storage import SqliteStorage  # noqa: E402
+from storage import JsonStorage, chunked_resource, save_to_db  # noqa: E402
+
+WORDS_PER_RESOURCE = 40
+VOCABULARY = 20_000
+PAGE = 20
+LETTERS = "абвгдеёжзийклмнопрстуфхцчшщыэюя"
+
+
+def vocabulary(rnd: random.Random) -> list[str]:
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(rnd.choice(LETTERS) for _ in range(rnd.randint(2, 10))))
+    return sorted(words)
+
+
+def seed(path: str) -> tuple[dict, list[str]]:
+    rnd = random.Random(25)
+    words = vocabulary(rnd)
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY)]
+    resources = {}
+    for i in range(RESOURCES):
+        text = " ".join(rnd.choices(words, weights, k=WORDS_PER_RESOURCE))
+        resources[f"user{i:07d}"] = chunked_resource(text.capitalize() + ".", i % 2 == 0)
+    save_to_db(path, resources)
+    return resources, words
+
+
+def scan(resources: dict, term: str) -> list[str]:
+    return [
+        owner
+        for owner, item in resources.items()
+        if term in tokenize("".join(item["chunks"][: item["n"]]))
+    ]
+
+
+def run():
+    resources_path = str(root / "search_resources.json")
+    seed_json(str(root / "search_users.json"), {})
+    seed_json(str(root / "search_tokens.json"), {})
+    resources, words = seed(resources_path)
+    # редкое - из хвоста словаря, частое - третье по частоте
+    rare, common, second = words[VOCABULARY // 2], words[2], words[5]
+    json_store = JsonStorage(
+        str(root / "search_users.json"), resources_path, str(root / "search_tokens.json")
+    )
+    sqlite_store = SqliteStorage(str(root / "search.sqlite3"), pool_size=1)
+    start = time.perf_counter()
+    sqlite_store.import_data({}, resources, {})
+    sqlite_import_s = round(time.perf_counter() - start, 1)
+    json_store.resources.data()
+
+    queries = {"rare": [rare], "common": [common], "and": [common, second]}
+    for name, store in (("json", json_store), ("sqlite", sqlite_store)):
+        report = {"backend": name, "resources": RESOURCES}
+        if name == "json":
+            start = time.perf_counter()
+            store.search_resources([rare], None, True, 0, PAGE)
+            report["index_build_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            report["terms"] = len(store.content_search.index().postings)
+        else:
+            report["sqlite_import_s"] = sqlite_import_s
+        for query, terms in queries.items():
+            report[f"{query}_hits"] = len(store.search_resources(terms, None, True, 0, RESOURCES))
+            for who, viewer, see_all in (("user", "user0000001", False), ("admin", None, True)):
+                summary = measure(store.search_resources, 50, terms, viewer, see_all, 0, PAGE)
+                report[f"query_{query}_{who}_p50_us"] = summary["p50_us"]
+                report[f"query_{query}_{who}_p99_us"] = summary["p99_us"]
+        rnd = random.Random(1)
+        if name == "json":
+            index = store.content_search.index()
+            append = lambda: index.append(
+                f"user{rnd.randrange(RESOURCES):07d}", " " + rnd.choice(words), True
+            )
+        else:
+            append = lambda: store.append_resource(
+                f"user{rnd.randrange(RESOURCES):07d}", " " + rnd.choice(words), True
+            )
+        report["append_us"] = measure(append, 500)["p50_us"]
+        print_report("search", report)
+
+    start = time.perf_counter()
+    hits = scan(resources, rare)
+    print_report(
+        "search",
+        {
+            "backend": "scan",
+            "resources": RESOURCES,
+            "rare_hits": len(hits),
+            "scan_us": round((time.perf_counter() - start) * 1_000_000),
+        },
+    )
+
+
+if __name__ == "__main__":
+    run()
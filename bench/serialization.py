@@ -0,0 +1,89 @@
+"""Разбор и запись db.json на N юзеров и сериализация ответов: стандартный json против fastjson.
+
+python -m bench.serialization [users] [iterations]
+
+stdlib_pretty - как было: json.load и json.dump с indent=2.
+fastjson - open_db/save_to_db сейчас (orjson, если установлен, компактно),
+fastjson_pretty - то же с DB_PRETTY=1. Запись db.json целиком - цена каждого
+add_user и set_roles на json бэкенде без журнала.
+"""
+import json
+import os
+import sys
+
+from bench.common import prepare_env, seed_users, measure, print_report
+
+root = prepare_env()
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+ITERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import fastjson  # noqa: E402
+from storage import open_db, save_to_db  # noqa: E402
+
+
+def stdlib_load(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def stdlib_save(path: str, data: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def run():
+    path = str(root / "db.json")
+    seed_users(path, USERS)
+    data = open_db(path)
+    out = str(root / "out.json")
+    cases = {
+        "stdlib_pretty": (stdlib_load, stdlib_save),
+        "fastjson": (open_db, lambda p, d: save_to_db(p, d, pretty=False)),
+        "fastjson_pretty": (open_db, lambda p, d: save_to_db(p, d, pretty=True)),
+    }
+    for name, (load, save) in cases.items():
+        save(path, data)
+        print_report(
+            "serialization_db",
+            {
+                "case": name,
+                "users": USERS,
+                "orjson": fastjson.orjson is not None,
+                "file_bytes": os.path.getsize(path),
+                "parse_p50_ms": round(measure(load, ITERATIONS, path)["p50_us"] / 1000, 2),
+                "save_p50_ms": round(measure(save, ITERATIONS, out, data)["p50_us"] / 1000, 2),
+            },
+        )
+
+    # ответы: маленький словарь и пачка из 1000 ресурсов как у batch/get
+    small = {"guest success": "user0"}
+    batch = {
+        "results": [
+            {
+                "user_name": f"user{i}",
+                "status": 200,
+                "resource": {"content": "Мне 20 лет. " * 10, "is_public": True, "version": "v"},
+            }
+            for i in range(1000)
+        ],
+        "ok": 1000,
+        "failed": 0,
+    }
+    for name, content in (("small", small), ("batch_1000", batch)):
+        iterations = ITERATIONS * 1000 if name == "small" else ITERATIONS * 10
+        print_report(
+            "serialization_response",
+            {
+                "payload": name,
+                "json_response_p50_us": measure(JSONResponse, iterations, content)["p50_us"],
+                "fast_json_response_p50_us": measure(
+                    fastjson.FastJSONResponse, iterations, content
+                )["p50_us"],
+            },
+        )
+
+
+if __name__ == "__main__":
+    run()
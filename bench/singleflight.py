@@ -0,0 +1,110 @@
+"""Всплеск чтений одного популярного публичного профиля: склейка чтений (single-flight) вкл/выкл
+
+python -m bench.singleflight [clients] [rounds]
+
+clients клиентов одновременно делают по rounds GET /protected_resource/popular.
+store_calls - сколько раз на самом деле вызывались get_user, get_resource_meta и
+get_resource хранилища. Кэш готовых ответов выключен (RESPONSE_CACHE_SIZE=0), чтобы
+контент читался на каждый промах, как в худшем случае. STORAGE_BACKEND=sqlite
+переключает хранилище.
+"""
+import asyncio
+import os
+import sys
+import time
+
+from bench.common import prepare_env, seed_users, seed_json, summarize, print_report
+
+root = prepare_env()
+CLIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+os.environ.setdefault("RESPONSE_CACHE_SIZE", "0")
+
+names = seed_users(str(root / "db.json"), CLIENTS, extra={"popular": ["user"]})
+seed_json(
+    str(root / "resources.json"),
+    {"popular": {"content": "Мне 20 лет. " * 2000, "is_public": True}},
+)
+seed_json(str(root / "db_refresh_tokens.json"), {})
+
+import httpx  # noqa: E402
+
+import db  # noqa: E402
+import main  # noqa: E402
+import storage_cli  # noqa: E402
+from security import create_jwt_token  # noqa: E402
+from settings import settings  # noqa: E402
+
+if settings.storage_backend == "sqlite":
+    storage_cli.migrate(settings.sqlite_path)
+
+COUNTED = ("get_user", "get_resource_meta", "get_resource")
+store_calls = dict.fromkeys(COUNTED, 0)
+
+
+def count_store_calls():
+    """Обертки над методами хранилища процесса, чтобы видеть настоящие обращения"""
+    for name in COUNTED:
+        method = getattr(db.storage, name)
+
+        def counted(*args, _name=name, _method=method):
+            store_calls[_name] += 1
+            return _method(*args)
+
+        setattr(db.storage, name, counted)
+
+
+async def client_session(app, token: str, samples: list):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", cookies={"access_token": token}
+    ) as client:
+        for _ in range(ROUNDS):
+            start = time.perf_counter_ns()
+            response = await client.get("/protected_resource/popular")
+            samples.append((time.perf_counter_ns() - start) / 1000)
+            assert response.status_code == 200, response.text
+
+
+async def run_mode(app, tokens: list[str], enabled: bool):
+    for flight in db.flights.values():
+        flight.enabled = enabled
+    for name in COUNTED:
+        store_calls[name] = 0
+    coalesced = sum(f.coalesced for f in db.flights.values())
+    samples = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client_session(app, token, samples) for token in tokens))
+    elapsed = time.perf_counter() - start
+    summary = summarize(samples)
+    print_report(
+        "singleflight",
+        {
+            "backend": settings.storage_backend,
+            "singleflight": enabled,
+            "clients": CLIENTS,
+            "requests": len(samples),
+            "rps": round(len(samples) / elapsed),
+            "p50_ms": round(summary["p50_us"] / 1000, 2),
+            "p99_ms": round(summary["p99_us"] / 1000, 2),
+            "store_calls": sum(store_calls.values()),
+            **{f"{name}_calls": count for name, count in store_calls.items()},
+            "coalesced": sum(f.coalesced for f in db.flights.values()) - coalesced,
+        },
+    )
+
+
+async def run():
+    main.limiter.enabled = False
+    count_store_calls()
+    # токены подписываются напрямую: логин с bcrypt здесь не меряется
+    tokens = [await create_jwt_token({"sub": name}, type="ACCESS") for name in names]
+    app = main.app
+    # прогрев: импорт, первая загрузка файлов
+    await run_mode(app, tokens[:10], True)
+    for enabled in (False, True):
+        await run_mode(app, tokens, enabled)
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+"""Холодный старт: импорт main, сборка приложения и первый запрос, каждый прогон в новом процессе.
+
+python -m bench.startup [runs]
+
+import_ms - import main, app_ms - сборка приложения (create_app), first_request_ms -
+первый запрос через ASGI, process_ms - весь процесс вместе с запуском интерпретатора.
+Разброс между процессами большой, поэтому печатаются медиана и p95 по runs прогонам.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from bench.common import prepare_env, seed_users, seed_json, print_report
+
+root = prepare_env()
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+seed_users(str(root / "db.json"), 1000)
+seed_json(str(root / "resources.json"), {})
+seed_json(str(root / "db_refresh_tokens.json"), {})
+
+# код одного прогона. main.create_app есть не во всех версиях, тогда main.app
+CHILD = """
+import asyncio, json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app() if hasattr(main, "create_app") else main.app
+built = time.perf_counter()
+import httpx
+
+async def first_request():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await client.get("/guest")
+        return time.perf_counter() - start
+
+first = asyncio.run(first_request())
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "app_ms": (built - imported) * 1000,
+    "first_request_ms": first * 1000,
+}))
+"""
+
+
+def run_once(cwd: str) -> dict:
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        cwd=cwd,
+        env=os.environ,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def run():
+    # корень репозитория, чтобы import main нашел модули приложения
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [run_once(cwd) for _ in range(RUNS)]
+    report = {"runs": RUNS}
+    for key in ("import_ms", "app_ms", "first_request_ms", "process_ms"):
+        values = sorted(r[key] for r in runs)
+        report[f"{key}_p50"] = round(statistics.median(values), 1)
+        report[f"{key}_p95"] = round(values[min(len(values) - 1, int(0.95 * len(values)))], 1)
+    print_report("startup", report)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,40 @@
+"""Задержка поиска юзера: линейный проход по db.json против кэша JsonStorage
+
+python -m bench.users_lookup 10000 1000000
+"""
+import random
+import sys
+from secrets import compare_digest
+
+from bench.common import prepare_env, seed_users, measure, print_report
+
+root = prepare_env()
+
+import storage  # noqa: E402
+
+
+def linear_lookup(path, username):
+    # так работал get_user_from_db раньше: чтение файла и проход по всем юзерам
+    for user_id, data in storage.open_db(path).items():
+        if compare_digest(data["username"], username):
+            return data
+
+
+def run(count: int):
+    path = str(root / f"users_{count}.json")
+    names = seed_users(path, count)
+    store = storage.JsonStorage(path, str(root / "resources.json"), str(root / "tokens.json"))
+    store.get_user(names[0])  # прогрев, первая загрузка файла
+    probes = [random.choice(names) for _ in range(1000)]
+
+    # старый путь на 1M юзеров занимает секунды на вызов, поэтому мало итераций
+    linear_iterations = max(3, min(200, 2_000_000 // count))
+    linear = measure(lambda: linear_lookup(path, random.choice(probes)), linear_iterations)
+    cached = measure(lambda: store.get_user(random.choice(probes)), 100_000)
+    print_report("users_lookup", {"users": count, "path": "linear_json", **linear})
+    print_report("users_lookup", {"users": count, "path": "json_storage", **cached})
+
+
+if __name__ == "__main__":
+    for arg in sys.argv[1:] or ["10000", "1000000"]:
+        run(int(arg))
@@ -0,0 +1,98 @@
+"""Память воркера и поиск юзера: словарь из db.json против бинарного снапшота (USERS_SNAPSHOT).
+
+python -m bench.users_snapshot [users] [workers]
+
+Каждый режим в своем процессе, workers процессов одновременно, как воркеры uvicorn.
+anon_mb - своя память процесса (RssAnon), file_mb - страницы файлов в page cache
+(RssFile): для снапшота они общие у всех воркеров. Память только для linux (/proc).
+register_ms - add_user: запись db.json и, для снапшота, пересборка снапшота.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from bench.common import prepare_env, seed_users, seed_json, print_report
+
+root = prepare_env()
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+CHILD = """
+import json, random, sys, time
+from bench.common import measure
+
+def rss_mb():
+    fields = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value
+    return {k: round(int(fields[k].split()[0]) / 1024, 1) for k in ("RssAnon", "RssFile")}
+
+import storage
+users_path, snapshot_path, names_count, register = sys.argv[1], sys.argv[2] or None, int(sys.argv[3]), sys.argv[4] == "1"
+root = users_path.rsplit("/", 1)[0]
+before = rss_mb()
+start = time.perf_counter()
+store = storage.JsonStorage(users_path, root + "/resources.json", root + "/tokens.json", users_snapshot=snapshot_path)
+store.get_user("user0")
+load_ms = (time.perf_counter() - start) * 1000
+probes = [f"user{random.randrange(names_count)}" for _ in range(1000)]
+lookup = measure(lambda: store.get_user(random.choice(probes)), 100_000)
+after = rss_mb()
+report = {
+    "load_ms": round(load_ms, 1),
+    "lookup_p50_us": lookup["p50_us"],
+    "lookup_p99_us": lookup["p99_us"],
+    "anon_mb": round(after["RssAnon"] - before["RssAnon"], 1),
+    "file_mb": round(after["RssFile"] - before["RssFile"], 1),
+}
+if register:
+    start = time.perf_counter()
+    store.add_user("bench-new", {"username": "bench_new", "hashed_password": "h", "roles": ["guest"]})
+    report["register_ms"] = round((time.perf_counter() - start) * 1000, 1)
+print(json.dumps(report))
+"""
+
+
+def run_mode(users_path: str, snapshot_path: str) -> list[dict]:
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    args = [users_path, snapshot_path, str(USERS)]
+    if snapshot_path:
+        # снапшот пишет первый воркер, остальные стартуют на готовом, как после деплоя
+        subprocess.run([sys.executable, "-c", CHILD, *args, "0"], cwd=cwd, check=True, capture_output=True)
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-c", CHILD, *args, "1" if i == 0 else "0"],
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for i in range(WORKERS)
+    ]
+    return [json.loads(worker.communicate()[0].strip().splitlines()[-1]) for worker in workers]
+
+
+def run():
+    seed_json(str(root / "resources.json"), {})
+    seed_json(str(root / "tokens.json"), {})
+    for mode in ("json", "snapshot"):
+        users_path = str(root / f"users_{mode}.json")
+        seed_users(users_path, USERS)
+        snapshot_path = str(root / "users.snap") if mode == "snapshot" else ""
+        results = run_mode(users_path, snapshot_path)
+        report = {"mode": mode, "users": USERS, "workers": WORKERS}
+        for key in ("load_ms", "lookup_p50_us", "lookup_p99_us", "anon_mb", "file_mb"):
+            report[key] = round(statistics.median(r[key] for r in results), 1)
+        report["anon_mb_total"] = round(sum(r["anon_mb"] for r in results), 1)
+        report["register_ms"] = results[0]["register_ms"]
+        if snapshot_path:
+            report["snapshot_mb"] = round(os.path.getsize(snapshot_path) / 2**20, 1)
+        report["db_json_mb"] = round(os.path.getsize(users_path) / 2**20, 1)
+        print_report("users_snapshot", report)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,78 @@
+"""Журнал (DB_WAL=1) против полной перезаписи resources.json:
+скорость записи в установившемся режиме и время старта с проигрыванием журнала
+
+python -m bench.wal [resources] [writes]
+"""
+from contextlib import suppress
+import os
+import sys
+import time
+
+from bench.common import prepare_env, seed_json, print_report
+
+root = prepare_env()
+RESOURCES = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+WRITES = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+import storage  # noqa: E402
+
+
+def seed(path):
+    seed_json(
+        path,
+        {
+            f"user{i}": {"content": "Мне 20 лет. " * 20, "is_public": i % 2 == 0}
+            for i in range(RESOURCES)
+        },
+    )
+    with suppress(FileNotFoundError):
+        os.unlink(path + ".wal")
+
+
+def write_throughput(json_file) -> float:
+    start = time.perf_counter()
+    for i in range(WRITES):
+        with json_file.write_lock():
+            json_file.append_content(f"user{i % RESOURCES}", " ещё", True)
+    return WRITES / (time.perf_counter() - start)
+
+
+def startup_seconds(factory) -> float:
+    start = time.perf_counter()
+    factory().data()
+    return time.perf_counter() - start
+
+
+def run():
+    path = str(root / "resources.json")
+    cases = {
+        "full_rewrite": lambda: storage.JsonFile(
+            path, prepare=storage.normalize_resources
+        ),
+        "wal_fsync": lambda: storage.LoggedJsonFile(
+            path, compact_every=10**9, prepare=storage.normalize_resources
+        ),
+        "wal_no_fsync": lambda: storage.LoggedJsonFile(
+            path, compact_every=10**9, fsync=False, prepare=storage.normalize_resources
+        ),
+    }
+    for name, factory in cases.items():
+        seed(path)
+        json_file = factory()
+        json_file.data()
+        writes_per_second = write_throughput(json_file)
+        # старт: снапшот + журнал из WRITES записей (у full_rewrite журнала нет)
+        print_report(
+            "wal",
+            {
+                "case": name,
+                "resources": RESOURCES,
+                "writes": WRITES,
+                "writes_per_second": round(writes_per_second, 1),
+                "startup_ms": round(startup_seconds(factory) * 1000, 2),
+            },
+        )
+
+
+if __name__ == "__main__":
+    run()
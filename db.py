@@ -1,49 +1,80 @@
 from fastapi.exceptions import HTTPException
-import json
-from secrets import compare_digest
+import time
 
 # files
-from models import UserInDB, Resourse_info
-from settings import DB, DB_REFRESH_TOKENS, DB_resources
+from models import UserInDB
+from records import UserRecord, ResourceRecord, user_record, resource_record
+from singleflight import SingleFlight
+from storage import AsyncStorage, create_storage
 
+# settings
+from settings import settings
 
-def open_db(path: str) -> dict:
-    with open(path, "r", encoding="utf-8") as f:
-        cur_json = json.load(f)
-        return cur_json
+# одно хранилище на процесс, бэкенд из STORAGE_BACKEND
+storage = create_storage()
+# асинхронный доступ к нему для обработчиков: работа с диском идет вне event loop
+store = AsyncStorage(storage)
 
+# одинаковые чтения в полете склеиваются: сотня одновременных GET одного профиля -
+# одно чтение юзера, meta и контента. Статистика в /metrics и /admin/singleflight
+flights = {
+    name: SingleFlight(settings.singleflight_enabled, settings.singleflight_stats_keys)
+    for name in ("user", "resource_meta", "resource")
+}
 
-def save_to_db(path, data: dict):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
 
+def forget_resource(owner_name: str):
+    """После изменения ресурса новые чтения не присоединяются к начатым до него"""
+    flights["resource_meta"].forget(owner_name)
+    flights["resource"].forget(owner_name)
 
-# доработать идею юзать user_id
-def get_user_from_db(username_to_check: str):
-    cur_db = open_db(DB)
-    for user_id, data in cur_db.items():
-        if compare_digest(data["username"], username_to_check):
-            return UserInDB(
-                username=data["username"],
-                hashed_password=data["hashed_password"],
-                roles=data["roles"],
-            )
-    raise HTTPException(status_code=404, detail="User not found")
 
+async def get_user_from_db(username_to_check: str) -> UserRecord:
+    """Юзер из хранилища без валидации pydantic: она была при записи"""
+    data = await flights["user"].do(username_to_check, store.get_user, username_to_check)
+    if data is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user_record(data)
 
-def save_refresh_token_to_db(data: dict, new_token):
+
+async def add_user_to_db(user_id: str, user: UserInDB):
+    """Добавление нового юзера. 409, если username занят"""
+    await store.add_user(user_id, user.model_dump())
+    flights["user"].forget(user.username)
+
+
+async def set_user_roles_in_db(username: str, roles: list) -> bool:
+    """Смена ролей юзера. False, если такого юзера нет"""
+    changed = await store.set_user_roles(username, roles)
+    flights["user"].forget(username)
+    return changed
+
+
+async def save_refresh_token_to_db(jti: str, record: dict):
     """Сохранение рефреш токена в db"""
-    username = data["sub"]
-    cur_db = open_db(DB_REFRESH_TOKENS)
-    cur_db[username] = new_token
-    save_to_db(DB_REFRESH_TOKENS, cur_db)
-
-
-def get_resource_info(owner_name):
-    """Возвращение в pydantic контента юзера из db"""
-    cur_db = open_db(DB_resources)
-    try:
-        info = cur_db[owner_name]
-        return Resourse_info(**info)
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=f"Нет такого ресурса")
+    await store.save_refresh_token(jti, record)
+
+
+async def rotate_refresh_token_in_db(jti: str, new_jti: str, record: dict) -> str:
+    """Замена рефреш токена следующим из той же семьи, см. Storage.rotate_refresh_token"""
+    return await store.rotate_refresh_token(jti, new_jti, record, time.time())
+
+
+async def sweep_refresh_tokens_in_db() -> int:
+    return await store.sweep_refresh_tokens(time.time())
+
+
+async def get_resource_info(owner_name) -> ResourceRecord:
+    """Контент юзера из db"""
+    info = await flights["resource"].do(owner_name, store.get_resource, owner_name)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Нет такого ресурса")
+    return resource_record(info)
+
+
+async def get_resource_meta(owner_name) -> dict:
+    """Размер и публичность ресурса без чтения контента"""
+    meta = await flights["resource_meta"].do(owner_name, store.get_resource_meta, owner_name)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Нет такого ресурса")
+    return meta
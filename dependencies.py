@@ -1,26 +1,28 @@
 from fastapi import HTTPException, Request
-from functools import wraps
+from functools import wraps, lru_cache
 from contextvars import ContextVar
+from limits import parse_many
+from limits.storage import storage_from_string
+from limits.strategies import STRATEGIES
+from slowapi import Limiter
+from slowapi.util import get_remote_address
 
 # files
-from settings import DB
-from db import get_user_from_db, open_db, save_to_db
-from security import decode_jwt
+from db import set_user_roles_in_db
+from metrics import span
+from security import get_principal
 
+# settings
+from settings import settings
 
-def change_role(username: str, roles: list):
+
+async def change_role(username: str, roles: list):
     """меняет роль любого юзера"""
-    try:
-        cur_db = open_db(DB)
-        for user_id, user_data in cur_db.items():
-            if user_data["username"] == username:
-                cur_db[user_id]["roles"] = roles
-        save_to_db(DB, cur_db)
-        return {"success": "поменял роль"}
-    except Exception as e:
+    if not await set_user_roles_in_db(username, roles):
         raise HTTPException(
             status_code=404, detail="Не получилось поменять роль. Сорян :("
         )
+    return {"success": "поменял роль"}
 
 
 #
@@ -41,25 +43,70 @@ request_ctx_var: ContextVar[Request | None] = ContextVar(
 )
 
 
+def compile_rate_limit_tiers(config: str) -> dict[str, str]:
+    """Разбор RATE_LIMITS ("admin:1000/minute,user:50/minute") при старте.
+    Порядок важен: у юзера с несколькими ролями берется первая подходящая"""
+    tiers = {}
+    for item in config.split(","):
+        role, _, limit = item.strip().partition(":")
+        parse_many(limit)  # неверная строка лимита - ошибка сразу при запуске
+        tiers[role.strip()] = limit.strip()
+    return tiers
+
+
+RATE_LIMIT_TIERS = compile_rate_limit_tiers(settings.rate_limits)
+parse_many(settings.rate_limit_default)
+
+
+@lru_cache(maxsize=256)
+def limit_for_roles(roles: frozenset) -> str:
+    for role, limit in RATE_LIMIT_TIERS.items():
+        if role in roles:
+            return limit
+    return settings.rate_limit_default
+
+
+def get_rate_limit_key(request: Request) -> str:
+    """Ключ лимита: username для авторизованных, иначе ip"""
+    principal = get_principal(request)
+    if principal is not None:
+        return f"user:{principal.username}"
+    return get_remote_address(request)
+
+
 def get_rate_limit_by_role() -> str:
-    """Получение лимита количества запросов по роли"""
-    try:
-        request = request_ctx_var.get()
-        assert request
-        authorization = request.cookies.get("access_token")
-        assert authorization
-        scheme, _, token = authorization.partition(" ")
-        username = decode_jwt(authorization)["sub"]
-        user_roles = get_user_from_db(username).roles
-        if "admin" in user_roles:
-            return "1000/minute"
-        elif "user" in user_roles:
-            return "50/minute"
-        return "20/minute"
-    # при ошибке миниум возмлжностей
-    except Exception as e:
-        print(f"Ошибка получения лимита по времени,{e}")
-        return "20/minute"
+    """Получение лимита количества запросов по роли.
+    Принципал уже собран в decode_jwt_method (куки или заголовок), без диска и декодирования"""
+    request = request_ctx_var.get()
+    principal = get_principal(request) if request is not None else None
+    # без принципала миниум возмлжностей
+    if principal is None:
+        return settings.rate_limit_default
+    return limit_for_roles(principal.roles)
+
+
+class TimedLimiter(Limiter):
+    """Limiter slowapi с замером проверки лимита (ratelimit в /metrics).
+    При импорте лимиты считаются в памяти, настоящее хранилище подключает use_storage"""
+
+    def use_storage(self, storage_uri: str, strategy: str):
+        """Хранилище лимитов из настроек. Вызывается из create_app, а не при импорте:
+        sqlite:// и redis:// открывают соединения"""
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Неизвестная RATELIMIT_STRATEGY: {strategy!r}")
+        self._storage_uri = storage_uri
+        self._strategy = strategy
+        if storage_uri.startswith("sqlite://"):
+            from limiter_storage import SQLiteLimitStorage
+
+            self._storage = SQLiteLimitStorage(storage_uri, **self._storage_options)
+        else:
+            self._storage = storage_from_string(storage_uri, **self._storage_options)
+        self._limiter = STRATEGIES[strategy](self._storage)
+
+    def _check_request_limit(self, request, endpoint_func, in_middleware=True):
+        with span("ratelimit", "check"):
+            return super()._check_request_limit(request, endpoint_func, in_middleware)
 
 
 def get_ownership_by_role():
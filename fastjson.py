@@ -0,0 +1,37 @@
+"""Быстрый json: orjson, если установлен, иначе стандартный json с тем же результатом.
+
+dumps всегда отдает bytes в utf-8 без \\u-экранирования кириллицы, компактно
+или с отступом в 2 пробела (pretty=True). loads принимает str и bytes.
+"""
+import json
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+
+    def dumps(obj, pretty: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else None)
+
+    loads = orjson.loads
+
+else:
+
+    def dumps(obj, pretty: bool = False) -> bytes:
+        if pretty:
+            return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    loads = json.loads
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse через dumps: ответ по умолчанию для всех маршрутов (create_app)"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,182 @@
+"""Ключи подписи JWT: текущий ключ подписи и все ключи, которыми еще можно проверять.
+
+ALGORITHM HS256/HS384/HS512 - общий SECRET_KEY, как раньше. RS*/PS*/ES*/EdDSA -
+закрытый ключ JWT_PRIVATE_KEY_FILE подписывает, открытые ключи (его собственный и
+JWT_PUBLIC_KEYS для ротации) проверяют. Ключ выбирается по kid из заголовка токена,
+открытые ключи раздаются в /.well-known/jwks.json. Pem файлы разбираются один раз
+при старте, проверка токена работает с готовыми объектами ключей.
+
+Новый ключ:
+    python keys.py generate --alg EdDSA --kid 2026-10 --out db/keys
+"""
+from dataclasses import dataclass
+from pathlib import Path
+import argparse
+import json
+
+import jwt
+from jwt.algorithms import get_default_algorithms
+
+# settings
+from settings import settings
+
+SYMMETRIC_ALGORITHMS = ("HS256", "HS384", "HS512")
+# сколько разных заголовков токенов помнить. У всех токенов одного ключа заголовок
+# одинаковый, так что хватает на все ключи, а мусорные заголовки не раздувают память
+HEADER_CACHE_SIZE = 64
+
+
+@dataclass(frozen=True, slots=True)
+class VerifyKey:
+    kid: str
+    algorithm: str
+    key: object
+
+
+# cryptography импортируется только здесь и ниже: для HS* он не нужен
+def load_private_key(path: str):
+    from cryptography.hazmat.primitives import serialization
+
+    with open(path, "rb") as f:
+        return serialization.load_pem_private_key(f.read(), password=None)
+
+
+def load_public_key(path: str):
+    from cryptography.hazmat.primitives import serialization
+
+    with open(path, "rb") as f:
+        return serialization.load_pem_public_key(f.read())
+
+
+def parse_public_keys(config: str | None) -> list[tuple[str, str, str]]:
+    """"kid:ALG=путь,..." -> [(kid, алгоритм, путь)]. Без :ALG - алгоритм как у ALGORITHM"""
+    keys = []
+    for item in (config or "").split(","):
+        if not item.strip():
+            continue
+        name, _, path = item.partition("=")
+        kid, _, algorithm = name.strip().partition(":")
+        keys.append((kid, algorithm or settings.algorithm, path.strip()))
+    return keys
+
+
+class KeyRing:
+    """Ключ подписи и ключи проверки по kid. Строится один раз на процесс"""
+
+    def __init__(
+        self, algorithm: str, kid: str | None, signing_key, verify_keys: list[VerifyKey]
+    ):
+        if algorithm not in get_default_algorithms() or algorithm == "none":
+            raise ValueError(f"Неизвестный ALGORITHM: {algorithm!r}")
+        self.algorithm = algorithm
+        self.kid = kid
+        self.signing_key = signing_key
+        self.verify_keys = {key.kid: key for key in verify_keys}
+        # первая часть токена (заголовок в base64) -> ключ, без разбора json заголовка
+        self._by_header: dict[str, VerifyKey] = {}
+        # ответ /.well-known/jwks.json не меняется до перезапуска
+        self.jwks = json.dumps({"keys": [self._jwk(key) for key in verify_keys]}).encode()
+
+    @property
+    def symmetric(self) -> bool:
+        return self.algorithm in SYMMETRIC_ALGORITHMS
+
+    @staticmethod
+    def _jwk(key: VerifyKey) -> dict:
+        jwk = get_default_algorithms()[key.algorithm].to_jwk(key.key, as_dict=True)
+        return {**jwk, "kid": key.kid, "alg": key.algorithm, "use": "sig"}
+
+    def sign(self, claims: dict) -> str:
+        headers = {"kid": self.kid} if self.kid else None
+        return jwt.encode(claims, self.signing_key, algorithm=self.algorithm, headers=headers)
+
+    def verify(self, token: str) -> dict:
+        """Проверка подписи и exp. Ошибки - jwt.InvalidTokenError и его наследники"""
+        if self.symmetric:
+            return jwt.decode(token, self.signing_key, algorithms=[self.algorithm])
+        key = self._key_for(token)
+        # алгоритм берется из ключа, а не из заголовка токена
+        return jwt.decode(token, key.key, algorithms=[key.algorithm])
+
+    def _key_for(self, token: str) -> VerifyKey:
+        header = token.partition(".")[0]
+        key = self._by_header.get(header)
+        if key is not None:
+            return key
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self.verify_keys.get(kid)
+        if key is None:
+            raise jwt.InvalidKeyError(f"Неизвестный kid: {kid!r}")
+        if len(self._by_header) < HEADER_CACHE_SIZE:
+            self._by_header[header] = key
+        return key
+
+
+def build_key_ring() -> KeyRing:
+    if settings.algorithm in SYMMETRIC_ALGORITHMS:
+        # общий секрет наружу не отдается, jwks пустой
+        return KeyRing(settings.algorithm, settings.jwt_kid, settings.secret_key, [])
+    if not settings.jwt_private_key_file or not settings.jwt_kid:
+        raise ValueError(
+            f"Для ALGORITHM={settings.algorithm} нужны JWT_PRIVATE_KEY_FILE и JWT_KID,"
+            " ключ создается командой python keys.py generate"
+        )
+    private_key = load_private_key(settings.jwt_private_key_file)
+    verify_keys = [
+        VerifyKey(settings.jwt_kid, settings.algorithm, private_key.public_key())
+    ]
+    for kid, algorithm, path in parse_public_keys(settings.jwt_public_keys):
+        if kid != settings.jwt_kid:
+            verify_keys.append(VerifyKey(kid, algorithm, load_public_key(path)))
+    return KeyRing(settings.algorithm, settings.jwt_kid, private_key, verify_keys)
+
+
+def generate_private_key(algorithm: str):
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+    if algorithm == "EdDSA":
+        return ed25519.Ed25519PrivateKey.generate()
+    if algorithm.startswith(("RS", "PS")):
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    curves = {"ES256": ec.SECP256R1, "ES384": ec.SECP384R1, "ES512": ec.SECP521R1}
+    if algorithm in curves:
+        return ec.generate_private_key(curves[algorithm]())
+    raise ValueError(f"Для {algorithm} пара ключей не нужна или не поддерживается")
+
+
+def write_key_pair(algorithm: str, kid: str, directory: str) -> tuple[Path, Path]:
+    """Пишет <kid>.pem (закрытый) и <kid>.pub.pem (открытый), возвращает пути"""
+    from cryptography.hazmat.primitives import serialization
+
+    private_key = generate_private_key(algorithm)
+    out = Path(directory)
+    out.mkdir(parents=True, exist_ok=True)
+    private_path, public_path = out / f"{kid}.pem", out / f"{kid}.pub.pem"
+    private_path.write_bytes(
+        private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    private_path.chmod(0o600)
+    public_path.write_bytes(
+        private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+    )
+    return private_path, public_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ключи подписи JWT")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate_parser = commands.add_parser("generate", help="новая пара ключей")
+    generate_parser.add_argument("--alg", default="EdDSA")
+    generate_parser.add_argument("--kid", required=True)
+    generate_parser.add_argument("--out", default="db/keys")
+    args = parser.parse_args()
+    if args.command == "generate":
+        private_path, public_path = write_key_pair(args.alg, args.kid, args.out)
+        print(f"закрытый ключ: {private_path}, открытый: {public_path}")
+        print(f"ALGORITHM={args.alg} JWT_KID={args.kid} JWT_PRIVATE_KEY_FILE={private_path}")
@@ -0,0 +1,203 @@
+"""Общие счетчики лимитов в sqlite файле для нескольких воркеров uvicorn на одной машине.
+
+RATELIMIT_STORAGE_URI=sqlite:///tmp/ratelimits.sqlite3
+Для нескольких машин - redis://host:6379 (нужен пакет redis).
+Для sqlite:// TimedLimiter.use_storage создает SQLiteLimitStorage сам.
+"""
+from limits.storage import Storage
+from limits.storage.base import MovingWindowSupport, SlidingWindowCounterSupport
+import math
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    key TEXT NOT NULL,
+    at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_events_key_at ON events (key, at);
+CREATE INDEX IF NOT EXISTS ix_events_expires ON events (expires_at);
+"""
+SQL_INCR = """
+INSERT INTO counters (key, value, expires_at) VALUES (?1, ?2, ?3)
+ON CONFLICT (key) DO UPDATE SET
+    value = CASE WHEN counters.expires_at <= ?4 THEN ?2 ELSE counters.value + ?2 END,
+    expires_at = CASE WHEN counters.expires_at <= ?4 THEN ?3 ELSE counters.expires_at END
+"""
+SQL_GET = "SELECT value, expires_at FROM counters WHERE key = ? AND expires_at > ?"
+SQL_TOUCH = "UPDATE counters SET expires_at = ? WHERE key = ?"
+SQL_CLEAR = "DELETE FROM counters WHERE key = ?"
+SQL_SWEEP = "DELETE FROM counters WHERE expires_at <= ?"
+SQL_COUNT_EVENTS = "SELECT COUNT(*), MIN(at) FROM events WHERE key = ? AND at > ?"
+SQL_ADD_EVENT = "INSERT INTO events (key, at, expires_at) VALUES (?, ?, ?)"
+SQL_SWEEP_EVENTS = "DELETE FROM events WHERE key = ? AND at <= ?"
+# отметки всех ключей, в том числе тех, по которым больше не ходят
+SQL_SWEEP_ALL_EVENTS = "DELETE FROM events WHERE expires_at <= ?"
+
+# раз в сколько записей чистить протухшие счетчики и отметки
+SWEEP_EVERY = 1000
+
+
+class SQLiteLimitStorage(Storage, MovingWindowSupport, SlidingWindowCounterSupport):
+    """Хранилище limits в sqlite (WAL). Каждая проверка - одна локальная транзакция,
+    без сетевых запросов. Скользящее окно считается атомарно внутри транзакции"""
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = uri.split("://", 1)[1]
+        self._local = threading.local()
+        self._writes = 0
+        self._conn().executescript(SCHEMA)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _conn(self) -> sqlite3.Connection:
+        # соединение на поток, в режиме autocommit
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self) -> "_Transaction":
+        return _Transaction(self._conn())
+
+    def _maybe_sweep(self, conn, now: float):
+        """Раз в SWEEP_EVERY записей - протухшие счетчики и отметки всех ключей"""
+        self._writes += 1
+        if self._writes % SWEEP_EVERY == 0:
+            conn.execute(SQL_SWEEP, (now,))
+            conn.execute(SQL_SWEEP_ALL_EVENTS, (now,))
+
+    def _incr(self, conn, key: str, expiry: float, amount: int, now: float) -> int:
+        conn.execute(SQL_INCR, (key, amount, now + expiry, now))
+        return conn.execute(SQL_GET, (key, now)).fetchone()[0]
+
+    def _get(self, conn, key: str, now: float) -> tuple[int, float]:
+        row = conn.execute(SQL_GET, (key, now)).fetchone()
+        return (0, now) if row is None else row
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        with self._transaction() as conn:
+            self._maybe_sweep(conn, now)
+            value = self._incr(conn, key, expiry, amount, now)
+            if elastic_expiry:
+                conn.execute(SQL_TOUCH, (now + expiry, key))
+            return value
+
+    def decr(self, key: str, amount: int = 1) -> int:
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE counters SET value = MAX(value - ?, 0) WHERE key = ?", (amount, key)
+            )
+            return self._get(conn, key, time.time())[0]
+
+    def get(self, key: str) -> int:
+        return self._get(self._conn(), key, time.time())[0]
+
+    def get_expiry(self, key: str) -> float:
+        return self._get(self._conn(), key, time.time())[1]
+
+    def check(self) -> bool:
+        try:
+            self._conn().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> int | None:
+        with self._transaction() as conn:
+            removed = conn.execute("DELETE FROM counters").rowcount
+            conn.execute("DELETE FROM events")
+        return removed
+
+    def clear(self, key: str) -> None:
+        with self._transaction() as conn:
+            conn.execute(SQL_CLEAR, (key,))
+            conn.execute("DELETE FROM events WHERE key = ?", (key,))
+
+    # moving window: отметки времени в events
+    def acquire_entry(self, key: str, limit: int, expiry: int, amount: int = 1) -> bool:
+        if amount > limit:
+            return False
+        now = time.time()
+        with self._transaction() as conn:
+            self._maybe_sweep(conn, now)
+            conn.execute(SQL_SWEEP_EVENTS, (key, now - expiry))
+            count = conn.execute(SQL_COUNT_EVENTS, (key, now - expiry)).fetchone()[0]
+            if count + amount > limit:
+                return False
+            conn.executemany(SQL_ADD_EVENT, [(key, now, now + expiry)] * amount)
+            return True
+
+    def get_moving_window(self, key: str, limit: int, expiry: int) -> tuple[float, int]:
+        now = time.time()
+        count, oldest = self._conn().execute(SQL_COUNT_EVENTS, (key, now - expiry)).fetchone()
+        return (oldest if oldest is not None else now), count
+
+    # sliding window counter: счетчики текущего и прошлого окна
+    @staticmethod
+    def _window_keys(key: str, expiry: int, now: float) -> tuple[str, str]:
+        return f"{key}/{int((now - expiry) / expiry)}", f"{key}/{int(now / expiry)}"
+
+    def _sliding_window(self, conn, key: str, expiry: int, now: float):
+        previous_key, current_key = self._window_keys(key, expiry, now)
+        previous_count = self._get(conn, previous_key, now)[0]
+        current_count = self._get(conn, current_key, now)[0]
+        previous_ttl = 0.0 if previous_count == 0 else (1 - (((now - expiry) / expiry) % 1)) * expiry
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    def acquire_sliding_window_entry(
+        self, key: str, limit: int, expiry: int, amount: int = 1
+    ) -> bool:
+        if amount > limit:
+            return False
+        now = time.time()
+        with self._transaction() as conn:
+            self._maybe_sweep(conn, now)
+            previous_count, previous_ttl, current_count, _ = self._sliding_window(
+                conn, key, expiry, now
+            )
+            weighted = previous_count * previous_ttl / expiry + current_count
+            if math.floor(weighted) + amount > limit:
+                return False
+            # счетчик окна живет два окна, чтобы стать "прошлым" для следующего
+            self._incr(conn, self._window_keys(key, expiry, now)[1], 2 * expiry, amount, now)
+            return True
+
+    def get_sliding_window(self, key: str, expiry: int) -> tuple[int, float, int, float]:
+        return self._sliding_window(self._conn(), key, expiry, time.time())
+
+    def clear_sliding_window(self, key: str, expiry: int) -> None:
+        with self._transaction() as conn:
+            for window_key in self._window_keys(key, expiry, time.time()):
+                conn.execute(SQL_CLEAR, (window_key,))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT: проверка и инкремент атомарны между процессами"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
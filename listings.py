@@ -0,0 +1,66 @@
+"""Списки для админки: юзеры (все или с ролью) и публичные ресурсы.
+
+Постранично: ?cursor=<next_cursor прошлой страницы>&limit=N. Курсор - последний ключ
+страницы (username или хозяин ресурса), поэтому вставки и удаления между запросами
+не сдвигают страницы. Выгрузка целиком - NDJSON потоком: хранилище читается
+страницами по EXPORT_PAGE_SIZE, в памяти только одна страница.
+"""
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+# files
+from db import store
+from fastjson import dumps
+from policy import ROLE_NAMES
+
+# сколько строк читать из хранилища за раз при выгрузке
+EXPORT_PAGE_SIZE = 1000
+NDJSON = "application/x-ndjson"
+
+
+def check_role(role: str | None):
+    if role is not None and role not in ROLE_NAMES:
+        raise HTTPException(status_code=422, detail=f"Нет такой роли {role!r}, есть: {ROLE_NAMES}")
+
+
+async def page(fetch, key: str, cursor: str | None, limit: int) -> dict:
+    """Страница и курсор следующей. next_cursor=None - это последняя страница"""
+    items = await fetch(cursor or "", limit)
+    next_cursor = items[-1][key] if len(items) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+
+async def ndjson_rows(fetch, key: str):
+    after = ""
+    while True:
+        items = await fetch(after, EXPORT_PAGE_SIZE)
+        if items:
+            # одна отправка на страницу, а не на строку
+            yield b"".join(dumps(item) + b"\n" for item in items)
+        if len(items) < EXPORT_PAGE_SIZE:
+            return
+        after = items[-1][key]
+
+
+def users_fetch(role: str | None):
+    return lambda after, limit: store.list_users(role, after, limit)
+
+
+async def users_page(role: str | None, cursor: str | None, limit: int) -> dict:
+    check_role(role)
+    return await page(users_fetch(role), "username", cursor, limit)
+
+
+def users_export(role: str | None) -> StreamingResponse:
+    check_role(role)
+    return StreamingResponse(ndjson_rows(users_fetch(role), "username"), media_type=NDJSON)
+
+
+async def public_resources_page(cursor: str | None, limit: int) -> dict:
+    return await page(store.list_public_resources, "user_name", cursor, limit)
+
+
+def public_resources_export() -> StreamingResponse:
+    return StreamingResponse(
+        ndjson_rows(store.list_public_resources, "user_name"), media_type=NDJSON
+    )
@@ -1,95 +1,152 @@
-import uvicorn as uvicorn
-from fastapi import FastAPI, Depends, Request, Response
+from fastapi import APIRouter, FastAPI, Depends, Query, Request, Response
+from fastapi.responses import PlainTextResponse
 from fastapi.exceptions import HTTPException
 from uuid import uuid4
-from contextlib import asynccontextmanager
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from settings import ACCESS_TOKEN_EXPIRE_MINUTES
+from contextlib import asynccontextmanager, suppress
+import asyncio
+import time
 from typing import Callable, Awaitable, Optional
 
 # files
-from dependencies import request_ctx_var, get_rate_limit_by_role
-from models import UserInDB, User, RefreshToken, UserToSetRoles, Resourse_info
+import metrics
+from fastjson import FastJSONResponse
+from dependencies import (
+    request_ctx_var,
+    get_rate_limit_by_role,
+    get_rate_limit_key,
+    TimedLimiter,
+)
+from models import (
+    UserInDB,
+    User,
+    RefreshToken,
+    UserToSetRoles,
+    Resourse_info,
+    BatchUsernames,
+    BatchCreateResources,
+)
+from listings import users_page, users_export, public_resources_page, public_resources_export
 from rbac import PermissionChecker
-from db import open_db, save_to_db
+from records import UserRecord
+from db import add_user_to_db, flights, storage, sweep_refresh_tokens_in_db
+from passwords import hash_password, password_pool
 from security import (
-    pwd_context,
+    jwt_cache,
+    key_ring,
     auth_user,
     create_jwt_token,
     decode_jwt_method,
     validate_refresh_token,
 )
-from settings import DB
-from dependencies import change_role, know_the_args
+from dependencies import change_role
 from resources import (
     OwnershipCheck,
     get_resource,
     create_resource,
     put_info_to_resource,
     delete_resource,
+    batch_get_resources,
+    batch_create_resources,
+    batch_delete_resources,
+    search_resources,
+    response_cache,
 )
 
+# settings
+from settings import settings
+
+# маршруты приложения, само приложение собирает create_app
+router = APIRouter()
+# декораторам лимиттер нужен уже при импорте, хранилище лимитов подключает create_app
+limiter = TimedLimiter(key_func=get_rate_limit_key)
+
+
+async def sweep_refresh_tokens(interval: float):
+    """Фоновая чистка истекших рефреш токенов, чтобы хранилище не росло вечно"""
+    while True:
+        await asyncio.sleep(interval)
+        # неудачная чистка не страшна: истекшие токены уйдут в следующий раз
+        with suppress(Exception):
+            await sweep_refresh_tokens_in_db()
+
 
-# что происходит при закрытии приложения
+# что происходит при запуске и закрытии приложения
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    sweeper = None
+    if settings.refresh_sweep_interval > 0:
+        sweeper = asyncio.create_task(
+            sweep_refresh_tokens(settings.refresh_sweep_interval)
+        )
     yield
-
-
-app = FastAPI(lifespan=lifespan)
-# лимиттер
-limiter = Limiter(key_func=get_remote_address)
+    if sweeper is not None:
+        sweeper.cancel()
+        with suppress(asyncio.CancelledError):
+            await sweeper
+    password_pool.shutdown()
+    storage.close()
 
 
 # включение request в переменную контекста
-@app.middleware("http")
 async def request_context_middleware(
     request: Request, call_next: Callable[[Request], Awaitable[Response]]
 ) -> Response:
     request_ctx = request_ctx_var.set(request)
-    response = await call_next(request)
-    request_ctx_var.reset(request_ctx)
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        request_ctx_var.reset(request_ctx)
+        # шаблон маршрута, а не путь: /protected_resource/{user_name} - одна серия на всех
+        route = request.scope.get("route")
+        metrics.observe(
+            metrics.REQUEST_METRIC,
+            (request.method, route.path if route else "unmatched", status_code),
+            time.perf_counter() - start,
+        )
     return response
 
 
-@app.post("/register")
+@router.post("/register")
 @limiter.limit("1/minute")
 async def register(request: Request, user: User):
     """регистрация"""
     try:
         userindb = UserInDB(
             username=user.username,
-            hashed_password=pwd_context.hash(user.password),
+            hashed_password=await hash_password(user.password),
             roles=["guest"],
         )
-        cur_db = open_db(DB)
-        if userindb.username in tuple(map(lambda x: x["username"], cur_db.values())):
-            raise HTTPException(status_code=409, detail="User already exists")
-        cur_db[str(uuid4())] = userindb.model_dump()
-        save_to_db(DB, cur_db)
+        await add_user_to_db(str(uuid4()), userindb)
         return {"success": f"{user.username} is registered"}
+    # 503 перегруженного пула паролей и 409 за занятое имя доходят до клиента
+    except HTTPException:
+        raise
     except Exception as e:
         return {"reg_eroor": e}
 
 
-@app.post("/login")
+@router.post("/login")
 @limiter.limit("5/minute")
-async def login(request: Request, response: Response, user: User = Depends(auth_user)):
+async def login(request: Request, response: Response, user: UserRecord = Depends(auth_user)):
     """логин и получение токенов. Установка access токена в куки"""
-    access_token = create_jwt_token({"sub": user.username}, type="ACCESS")
-    refresh_token = create_jwt_token({"sub": user.username}, type="REFRESH")
+    # у access и рефреш токена одна семья: отзыв семьи отзывает оба
+    family = uuid4().hex
+    access_token = await create_jwt_token({"sub": user.username, "fam": family}, type="ACCESS")
+    refresh_token = await create_jwt_token({"sub": user.username, "fam": family}, type="REFRESH")
     response.set_cookie(
         key="access_token",
         value=access_token,
-        max_age=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        max_age=settings.access_token_expire_minutes * 60,
         httponly=True,
     )
     return {"access_token": f"Bearer {access_token}", "refresh_token": refresh_token}
 
 
-@app.get("/protected_resource")
-@PermissionChecker(["admin"])
+@router.get("/protected_resource")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
 async def protected_resource(
     request: Request, username: str = Depends(decode_jwt_method)
@@ -101,18 +158,29 @@ async def protected_resource(
 
 # объектно-ориентированный контроль доступа
 # ______________________________________________________________________________________
-@app.get("/protected_resource/{user_name}")
-@PermissionChecker(["admin", "user", "guest"])
+@router.get("/protected_resource/{user_name}")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
 @OwnershipCheck()
 async def get_info(
-    request: Request, user_name: str, username: str = Depends(decode_jwt_method)
+    request: Request,
+    user_name: str,
+    offset: Optional[int] = Query(None, ge=0),
+    length: Optional[int] = Query(None, ge=0),
+    username: str = Depends(decode_jwt_method),
 ):
-    return get_resource(user_name)
+    """ресурс целиком (json) или диапазон байт: заголовок Range или offset/length"""
+    return await get_resource(
+        user_name,
+        request,
+        getattr(request.state, "resource_meta", None),
+        offset,
+        length,
+    )
 
 
-@app.post("/protected_resource/{user_name}")
-@PermissionChecker(["admin", "user"])
+@router.post("/protected_resource/{user_name}")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
 @OwnershipCheck()
 async def post_info(
@@ -124,11 +192,11 @@ async def post_info(
     if resourse_info is None:
         raise HTTPException(status_code=422, detail="Нет информации")
 
-    return {"api_method": "post", "success": create_resource(user_name, resourse_info)}
+    return {"api_method": "post", "success": await create_resource(user_name, resourse_info)}
 
 
-@app.put("/protected_resource/{user_name}")
-@PermissionChecker(["admin", "user"])
+@router.put("/protected_resource/{user_name}")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
 @OwnershipCheck()
 async def put_info(
@@ -137,73 +205,233 @@ async def put_info(
     user_name: str,
     username: str = Depends(decode_jwt_method),
 ):
-    return put_info_to_resource(user_name, content_to_put)
+    return await put_info_to_resource(user_name, content_to_put)
 
 
-@app.delete("/protected_resource/{user_name}")
-@PermissionChecker(["admin", "user"])
+@router.delete("/protected_resource/{user_name}")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
 @OwnershipCheck()
 async def delete_info(
     request: Request, user_name: str, username: str = Depends(decode_jwt_method)
 ):
-    return delete_resource(user_name)
+    return await delete_resource(user_name)
+
+
+# пачки ресурсов: одна авторизация и одно обращение к хранилищу на пачку,
+# результат и статус по каждому элементу
+# ______________________________________________________________________________________
+@router.post("/protected_resource/batch/get")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def batch_get_info(
+    request: Request, batch: BatchUsernames, username: str = Depends(decode_jwt_method)
+):
+    """ресурсы пачкой: resource элемента - {content, is_public, version}. version есть
+    только в пачке: одиночный GET отдает то же значение заголовком ETag (в кавычках),
+    а у элементов пачки своих заголовков нет"""
+    return await batch_get_resources(request, batch.usernames)
+
+
+@router.post("/protected_resource/batch/create")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def batch_post_info(
+    request: Request,
+    batch: BatchCreateResources,
+    username: str = Depends(decode_jwt_method),
+):
+    return await batch_create_resources(request, batch.items)
+
+
+@router.post("/protected_resource/batch/delete")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def batch_delete_info(
+    request: Request, batch: BatchUsernames, username: str = Depends(decode_jwt_method)
+):
+    return await batch_delete_resources(request, batch.usernames)
+
+
+# поиск по контенту ресурсов, страницы по курсору
+# ______________________________________________________________________________________
+@router.get("/search")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def search(
+    request: Request,
+    q: str = Query(..., max_length=1000),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=settings.batch_max_items),
+    username: str = Depends(decode_jwt_method),
+):
+    """поиск по контенту ресурсов: свой ресурс и публичные, админу все"""
+    return await search_resources(request, q, cursor, limit)
 
 
 # обновление JWT токена
 # ______________________________________________________________________________________
 
 
-@app.post("/refresh")
+@router.post("/refresh")
 @limiter.limit("5/minute")
 async def validate_refresh(
     request: Request, response: Response, refresh_token: RefreshToken
 ):
     """обнолвение токенов по refresh токену"""
-    return validate_refresh_token(refresh_token.refresh_token, response)
+    return await validate_refresh_token(refresh_token.refresh_token, response)
 
 
 # Роли
 # ______________________________________________________________________________________
 
 
-@app.post("/set_roles")
-@PermissionChecker(["admin"])
+@router.post("/set_roles")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
 async def set_roles(
     request: Request,
     user_to_set: UserToSetRoles,
     username: str = Depends(decode_jwt_method),
 ):
-    change_role(user_to_set.username, user_to_set.roles)
+    await change_role(user_to_set.username, user_to_set.roles)
     return {
         "success": f"{user_to_set.username} roles is changed to {user_to_set.roles}"
     }
 
 
-@app.get("/admin")
-@PermissionChecker(["admin"])
+@router.get("/admin")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
 async def admin_page(request: Request, username: str = Depends(decode_jwt_method)):
     """админская конечная точка"""
     return {"admin success": username}
 
 
-@app.get("/user")
-@PermissionChecker(["user"])
+# списки для админки: страницы по курсору и выгрузка NDJSON потоком
+@router.get("/admin/users")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
-async def guest_page(request: Request, username: str = Depends(decode_jwt_method)):
+async def admin_users(
+    request: Request,
+    role: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=settings.batch_max_items),
+    username: str = Depends(decode_jwt_method),
+):
+    """юзеры по username, role - только с этой ролью"""
+    return await users_page(role, cursor, limit)
+
+
+@router.get("/admin/users/export")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def admin_users_export(
+    request: Request, role: Optional[str] = None, username: str = Depends(decode_jwt_method)
+):
+    return users_export(role)
+
+
+@router.get("/admin/resources/public")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def admin_public_resources(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=settings.batch_max_items),
+    username: str = Depends(decode_jwt_method),
+):
+    """публичные ресурсы по имени хозяина, без контента"""
+    return await public_resources_page(cursor, limit)
+
+
+@router.get("/admin/resources/public/export")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def admin_public_resources_export(
+    request: Request, username: str = Depends(decode_jwt_method)
+):
+    return public_resources_export()
+
+
+@router.get("/user")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def user_page(request: Request, username: str = Depends(decode_jwt_method)):
     """юзерская конечная точка"""
     return {"user success": username}
 
 
-@app.get("/guest")
-@PermissionChecker(["guest"])
+@router.get("/guest")
+@PermissionChecker()
 @limiter.limit(get_rate_limit_by_role)
 async def guest_page(request: Request, username: str = Depends(decode_jwt_method)):
     """гостевая конечная точка"""
     return {"guest success": username}
 
 
+# метрики
+# ______________________________________________________________________________________
+
+
+@router.get("/metrics")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def metrics_page(request: Request, username: str = Depends(decode_jwt_method)):
+    """гистограммы задержек в формате Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/admin/singleflight")
+@PermissionChecker()
+@limiter.limit(get_rate_limit_by_role)
+async def singleflight_page(
+    request: Request,
+    top: int = Query(20, ge=1, le=1000),
+    username: str = Depends(decode_jwt_method),
+):
+    """склейка одинаковых чтений: итоги и ключи, где склеено больше всего"""
+    return {
+        name: {**flight.stats(), "top_keys": flight.top_keys(top)}
+        for name, flight in flights.items()
+    }
+
+
+@router.get("/.well-known/jwks.json")
+async def jwks():
+    """открытые ключи подписи jwt, чтобы другие сервисы проверяли токены сами"""
+    return Response(
+        key_ring.jwks,
+        media_type="application/json",
+        headers={"Cache-Control": f"public, max-age={settings.jwks_max_age}"},
+    )
+
+
+def create_app() -> FastAPI:
+    """Сборка приложения: uvicorn main:create_app --factory"""
+    limiter.use_storage(settings.ratelimit_storage_uri, settings.ratelimit_strategy)
+    # ответы-словари сериализует orjson (если установлен), а не json.dumps
+    app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+    app.middleware("http")(request_context_middleware)
+    app.include_router(router)
+    # текущие значения кэша jwt и пула bcrypt в /metrics
+    metrics.register_collector("jwt_cache", jwt_cache.stats)
+    metrics.register_collector("password_pool", password_pool.stats)
+    metrics.register_collector("response_cache", response_cache.stats)
+    for name, flight in flights.items():
+        metrics.register_collector(f"singleflight_{name}", flight.stats)
+    return app
+
+
+def __getattr__(name: str):
+    """main.app для uvicorn main:app и бенчмарков: собирается при первом обращении"""
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8080)
+    import uvicorn
+
+    uvicorn.run(create_app(), host="127.0.0.1", port=8080)
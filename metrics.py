@@ -0,0 +1,155 @@
+"""Метрики приложения: гистограммы задержек запросов и участков кода (auth, ratelimit, db, hashing).
+
+Каждый поток пишет в свой шард без блокировок, /metrics складывает шарды при чтении
+и отдает их в текстовом формате Prometheus. METRICS_ENABLED=0 выключает запись.
+"""
+from bisect import bisect_left
+import threading
+import time
+
+# settings
+from settings import settings
+
+# границы корзин гистограмм в секундах, как у prometheus_client по умолчанию
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_METRIC = "http_request_duration_seconds"
+REQUEST_LABELS = ("method", "route", "status")
+SPAN_METRIC = "span_duration_seconds"
+SPAN_LABELS = ("span", "op")
+
+# описания метрик для # HELP
+_HELP = {
+    REQUEST_METRIC: ("Длительность запроса по маршруту и статусу", REQUEST_LABELS),
+    SPAN_METRIC: ("Длительность участков обработки запроса", SPAN_LABELS),
+}
+
+_local = threading.local()
+# все шарды всех потоков. Лок только на создание шарда, запись идет без него
+_shards: list[dict] = []
+_shards_lock = threading.Lock()
+# функции, отдающие текущие значения (кэш jwt, пул bcrypt и т.д.)
+_collectors: dict = {}
+
+
+def _shard() -> dict:
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _local.shard = {}
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def observe(metric: str, labels: tuple, seconds: float):
+    """Записать одно значение в гистограмму metric с метками labels"""
+    if not settings.metrics_enabled:
+        return
+    shard = _shard()
+    key = (metric, labels)
+    series = shard.get(key)
+    if series is None:
+        # счетчики по корзинам (+Inf последняя), затем сумма и количество
+        series = shard[key] = [0] * (len(BUCKETS) + 3)
+    series[bisect_left(BUCKETS, seconds)] += 1
+    series[-2] += seconds
+    series[-1] += 1
+
+
+class _Span:
+    __slots__ = ("labels", "start")
+
+    def __init__(self, labels: tuple):
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(SPAN_METRIC, self.labels, time.perf_counter() - self.start)
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def span(name: str, op: str = ""):
+    """Замер участка кода: with span("db", "get_user"): ...
+    Работает и вокруг await, время считается по стене"""
+    if not settings.metrics_enabled:
+        return _no_span
+    return _Span((name, op))
+
+
+def register_collector(prefix: str, fn):
+    """fn() -> dict. Числовые значения попадут в /metrics как prefix_ключ"""
+    _collectors[prefix] = fn
+
+
+def snapshot() -> dict:
+    """Сумма всех шардов: (metric, labels) -> [корзины..., сумма, количество]"""
+    with _shards_lock:
+        shards = list(_shards)
+    total = {}
+    for shard in shards:
+        # копия под GIL: поток-владелец может добавлять ключи прямо сейчас
+        for key, series in list(shard.items()):
+            acc = total.get(key)
+            if acc is None:
+                total[key] = list(series)
+            else:
+                for i, value in enumerate(series):
+                    acc[i] += value
+    return total
+
+
+def reset():
+    for shard in list(_shards):
+        shard.clear()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render() -> str:
+    """Текстовый формат Prometheus 0.0.4"""
+    lines = []
+    by_metric: dict = {}
+    for (metric, labels), series in sorted(snapshot().items()):
+        by_metric.setdefault(metric, []).append((labels, series))
+    for metric, rows in by_metric.items():
+        help_text, names = _HELP.get(metric, ("", ()))
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} histogram")
+        for labels, series in rows:
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{metric}_bucket{_labels(names, labels, le)} {cumulative}")
+            lines.append(f"{metric}_sum{_labels(names, labels)} {series[-2]}")
+            lines.append(f"{metric}_count{_labels(names, labels)} {series[-1]}")
+    for prefix, fn in _collectors.items():
+        for key, value in fn().items():
+            # bool тоже int, но в метриках не нужен
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+    return "\n".join(lines) + "\n"
@@ -2,15 +2,22 @@ from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
 
 
+# files
+from policy import ROLE_NAMES
+
+# settings
+from settings import settings
+
+
 class RoleValidatorMixin(BaseModel):
-    roles: List[str] = Field(..., description="List of roles: admin, user, guest")
+    roles: List[str] = Field(..., description=f"List of roles: {', '.join(ROLE_NAMES)}")
 
     @field_validator("roles")
     def validate_roles(cls, roles):
         if not isinstance(roles, list):
             raise ValueError("Roles must be a list")
 
-        valid_roles = {"admin", "user", "guest"}
+        valid_roles = set(ROLE_NAMES)
         invalid_roles = set(roles) - valid_roles
 
         if invalid_roles:
@@ -43,3 +50,17 @@ class RefreshToken(BaseModel):
 class Resourse_info(BaseModel):
     content: str = ""
     is_public: Optional[bool] = False
+
+
+class BatchUsernames(BaseModel):
+    usernames: List[str] = Field(min_length=1, max_length=settings.batch_max_items)
+
+
+class BatchResourceItem(Resourse_info):
+    user_name: str = Field(min_length=1)
+
+
+class BatchCreateResources(BaseModel):
+    items: List[BatchResourceItem] = Field(
+        min_length=1, max_length=settings.batch_max_items
+    )
@@ -0,0 +1,130 @@
+"""Хеширование и проверка паролей bcrypt в отдельном пуле, чтобы не блокировать event loop"""
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi.exceptions import HTTPException
+from functools import cache
+import asyncio
+import time
+
+# files
+from metrics import span
+
+# settings
+from settings import settings
+
+
+@cache
+def pwd_context():
+    """passlib и bcrypt грузятся при первом пароле, а не при импорте.
+    В ProcessPoolExecutor каждый воркер создает свой контекст"""
+    from passlib.context import CryptContext
+
+    return CryptContext(
+        schemes=["bcrypt"],
+        bcrypt__rounds=settings.bcrypt_rounds,
+        deprecated="auto",
+    )
+
+
+# функции уровня модуля, чтобы их можно было отдать в ProcessPoolExecutor
+def _hash(password: str) -> str:
+    return pwd_context().hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return pwd_context().verify(password, hashed_password)
+
+
+def _timed(fn, *args):
+    return time.monotonic(), fn(*args)
+
+
+class PasswordPool:
+    """Пул воркеров для bcrypt с ограничением очереди.
+    Если в работе и в очереди уже max_pending задач, отвечает 503"""
+
+    def __init__(self, kind: str, workers: int, max_pending: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Executor | None = None
+        # метрики. Меняются только из event loop, поэтому без блокировок
+        self.pending = 0
+        self.max_pending_seen = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def _get_executor(self) -> Executor:
+        # пул создается при первом хешировании, а не при импорте
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="bcrypt"
+                )
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Сервер занят, попробуйте позже",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        self.submitted += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        queued_at = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            started_at, result = await loop.run_in_executor(
+                self._get_executor(), _timed, fn, *args
+            )
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.queue_wait_seconds += started_at - queued_at
+        self.run_seconds += time.monotonic() - started_at
+        return result
+
+    def stats(self) -> dict:
+        done = self.completed or 1
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "max_pending_seen": self.max_pending_seen,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_queue_wait_ms": self.queue_wait_seconds / done * 1000,
+            "avg_run_ms": self.run_seconds / done * 1000,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+password_pool = PasswordPool(
+    settings.password_pool_kind,
+    settings.password_pool_workers,
+    settings.password_pool_max_pending,
+)
+
+
+async def hash_password(password: str) -> str:
+    # вместе с ожиданием в очереди пула
+    with span("hashing", "hash"):
+        return await password_pool.run(_hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    with span("hashing", "verify"):
+        return await password_pool.run(_verify, password, hashed_password)
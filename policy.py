@@ -0,0 +1,176 @@
+"""Политика доступа: маршрут x метод -> разрешенные роли, проверка владельца и публичное чтение.
+
+Таблица собирается при старте в битовые маски ролей, решение для
+(набор ролей, маршрут, метод) считается один раз и кэшируется.
+Роли (ROLES), иерархия (ROLE_HIERARCHY) и сама таблица (POLICY_FILE, json
+того же вида, что DEFAULT_POLICY) задаются в настройках, без правки кода.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+import json
+
+# settings
+from settings import settings
+
+# "*" - любой авторизованный, даже без ролей
+ANY = "*"
+
+# allow - кому можно, owner - только хозяину ресурса {user_name},
+# public_read - чужой ресурс можно читать, если он публичный
+DEFAULT_POLICY = {
+    "/protected_resource": {"GET": {"allow": ["admin"]}},
+    "/protected_resource/{user_name}": {
+        "GET": {"allow": [ANY], "owner": True, "public_read": True},
+        "POST": {"allow": ["user"], "owner": True},
+        "PUT": {"allow": ["user"], "owner": True},
+        "DELETE": {"allow": ["user"], "owner": True},
+    },
+    # пачки: те же правила, проверка владельца и публичности на каждый элемент
+    "/protected_resource/batch/get": {
+        "POST": {"allow": [ANY], "owner": True, "public_read": True}
+    },
+    "/protected_resource/batch/create": {"POST": {"allow": ["user"], "owner": True}},
+    "/protected_resource/batch/delete": {"POST": {"allow": ["user"], "owner": True}},
+    # поиск по контенту: чужие ресурсы в выдаче только публичные
+    "/search": {"GET": {"allow": [ANY], "owner": True, "public_read": True}},
+    "/set_roles": {"POST": {"allow": ["admin"]}},
+    "/admin": {"GET": {"allow": ["admin"]}},
+    "/admin/users": {"GET": {"allow": ["admin"]}},
+    "/admin/users/export": {"GET": {"allow": ["admin"]}},
+    "/admin/resources/public": {"GET": {"allow": ["admin"]}},
+    "/admin/resources/public/export": {"GET": {"allow": ["admin"]}},
+    "/user": {"GET": {"allow": ["user"]}},
+    "/guest": {"GET": {"allow": [ANY]}},
+    "/metrics": {"GET": {"allow": ["admin"]}},
+    "/admin/singleflight": {"GET": {"allow": ["admin"]}},
+}
+
+
+def parse_roles(config: str) -> tuple[str, ...]:
+    return tuple(role.strip() for role in config.split(",") if role.strip())
+
+
+# допустимые роли в порядке из настроек, номер роли - номер ее бита
+ROLE_NAMES = parse_roles(settings.roles)
+ROLE_BITS = {role: 1 << i for i, role in enumerate(ROLE_NAMES)}
+
+
+def _role_bit(role: str) -> int:
+    try:
+        return ROLE_BITS[role]
+    except KeyError:
+        raise ValueError(f"Неизвестная роль {role!r}, есть: {ROLE_NAMES}") from None
+
+
+def compile_hierarchy(config: str) -> dict[str, int]:
+    """"admin>user,user>guest" -> роль: маска ее самой и всех ролей, которые она включает"""
+    children = {role: set() for role in ROLE_NAMES}
+    for item in config.split(","):
+        if not item.strip():
+            continue
+        parent, _, child = item.partition(">")
+        parent, child = parent.strip(), child.strip()
+        _role_bit(parent), _role_bit(child)
+        children[parent].add(child)
+
+    def expand(role: str, seen: frozenset) -> int:
+        if role in seen:
+            raise ValueError(f"Цикл в ROLE_HIERARCHY на роли {role!r}")
+        mask = ROLE_BITS[role]
+        for child in children[role]:
+            mask |= expand(child, seen | {role})
+        return mask
+
+    return {role: expand(role, frozenset()) for role in ROLE_NAMES}
+
+
+EFFECTIVE_MASKS = compile_hierarchy(settings.role_hierarchy)
+
+
+def roles_mask(roles) -> int:
+    """Маска для списка разрешенных ролей, без раскрытия иерархии"""
+    mask = 0
+    for role in roles:
+        mask |= _role_bit(role)
+    return mask
+
+
+OWNER_BYPASS_MASK = roles_mask(parse_roles(settings.owner_bypass_roles))
+
+
+@dataclass(frozen=True, slots=True)
+class Rule:
+    allow_any: bool
+    allow_mask: int
+    owner: bool = False
+    public_read: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class Decision:
+    """allowed - пускать ли вообще, need_owner - дальше проверить хозяина ресурса"""
+
+    allowed: bool
+    need_owner: bool = False
+    public_read: bool = False
+
+
+DENY = Decision(allowed=False)
+
+
+def compile_rule(spec: dict) -> Rule:
+    allow = spec.get("allow", [])
+    return Rule(
+        allow_any=ANY in allow,
+        allow_mask=roles_mask(role for role in allow if role != ANY),
+        owner=bool(spec.get("owner", False)),
+        public_read=bool(spec.get("public_read", False)),
+    )
+
+
+def compile_policy(policy: dict) -> dict[tuple[str, str], Rule]:
+    """Таблица -> {(маршрут, МЕТОД): Rule}. Ошибки в ролях всплывают при старте"""
+    return {
+        (route, method.upper()): compile_rule(spec)
+        for route, methods in policy.items()
+        for method, spec in methods.items()
+    }
+
+
+def load_policy(path: str | None) -> dict:
+    if not path:
+        return DEFAULT_POLICY
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+RULES = compile_policy(load_policy(settings.policy_file))
+
+
+@lru_cache(maxsize=1024)
+def principal_mask(roles: frozenset) -> int:
+    """Маска ролей юзера с учетом иерархии. Неизвестные роли не дают ничего"""
+    mask = 0
+    for role in roles:
+        mask |= EFFECTIVE_MASKS.get(role, 0)
+    return mask
+
+
+def decide_rule(rule: Rule, roles: frozenset) -> Decision:
+    if rule.allow_any:
+        allowed = True
+    else:
+        allowed = bool(principal_mask(roles) & rule.allow_mask)
+    if not allowed:
+        return DENY
+    need_owner = rule.owner and not principal_mask(roles) & OWNER_BYPASS_MASK
+    return Decision(allowed=True, need_owner=need_owner, public_read=rule.public_read)
+
+
+@lru_cache(maxsize=4096)
+def decide(roles: frozenset, route: str, method: str) -> Decision:
+    """Решение по таблице. Маршрута нет в таблице - доступа нет"""
+    rule = RULES.get((route, method))
+    if rule is None:
+        return DENY
+    return decide_rule(rule, roles)
@@ -1,34 +1,46 @@
 from fastapi import HTTPException, status
 from functools import wraps
-from db import get_user_from_db
+from policy import compile_rule, decide, decide_rule, ANY
+from security import get_principal
 
 
 class PermissionChecker:
-    """Декоратор проверки ролей"""
+    """Декоратор проверки ролей по таблице policy (маршрут x метод).
+    Список ролей в аргументе - правило прямо на месте, мимо таблицы"""
 
-    def __init__(self, roles: list[str]):
+    def __init__(self, roles: list[str] | None = None):
         self.roles = roles  # Список разрешённых ролей из списка
+        # "guest" в списке раньше означал "пускать всех", так и осталось
+        self.rule = (
+            compile_rule({"allow": [ANY if role == "guest" else role for role in roles]})
+            if roles is not None
+            else None
+        )
 
     def __call__(self, func):
 
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            if "guest" in self.roles:
-                return await func(*args, **kwargs)
-            # получение ролей пользователя из db
+            # роли пользователя уже загружены в decode_jwt_method
             try:
-                # username как в названии переменной. Напрмиер, username: dict = Depends(...)
-                user = get_user_from_db(kwargs["username"])
-                user_roles = user.roles
-                if user_roles == []:
-                    raise
+                # request как в названии переменной. Напрмиер, request: Request
+                request = kwargs["request"]
+                principal = get_principal(request)
+                user_roles = principal.roles if principal is not None else frozenset()
+                if self.rule is not None:
+                    decision = decide_rule(self.rule, user_roles)
+                else:
+                    decision = decide(
+                        user_roles, request.scope["route"].path, request.method
+                    )
             except Exception as e:
                 raise HTTPException(
                     status_code=403, detail=f"Ошибка получения username,{e}"
                 )
-            # проверка
-            if "admin" in user_roles or any(role in user_roles for role in self.roles):
-                return await func(*args, **kwargs)
-            raise HTTPException(status_code=403, detail="нет доступа")
+            if not decision.allowed:
+                raise HTTPException(status_code=403, detail="нет доступа")
+            # решение нужно OwnershipCheck, если он стоит ниже
+            request.state.decision = decision
+            return await func(*args, **kwargs)
 
         return wrapper
@@ -0,0 +1,38 @@
+"""Внутренние записи юзеров и ресурсов, прочитанных из хранилища.
+
+Данные в хранилище уже проверены pydantic моделями (models.py) при записи, поэтому
+чтения не валидируют их заново, а собирают легкие записи: slots, без __dict__,
+роли - общий frozenset на каждый набор ролей. Pydantic остается на входе и выходе API.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+
+
+@lru_cache(maxsize=256)
+def intern_roles(roles: tuple) -> frozenset:
+    """Один frozenset на каждый набор ролей: у всех юзеров с ролью guest он общий,
+    и principal_mask/limit_for_roles находят его в своих кэшах по готовому хешу"""
+    return frozenset(roles)
+
+
+@dataclass(frozen=True, slots=True)
+class UserRecord:
+    username: str
+    hashed_password: str
+    roles: frozenset
+
+
+@dataclass(frozen=True, slots=True)
+class ResourceRecord:
+    content: str
+    is_public: bool
+    version: str = ""
+
+
+def user_record(data: dict) -> UserRecord:
+    """Запись из словаря хранилища {username, hashed_password, roles}"""
+    return UserRecord(data["username"], data["hashed_password"], intern_roles(tuple(data["roles"])))
+
+
+def resource_record(data: dict) -> ResourceRecord:
+    return ResourceRecord(data["content"], bool(data["is_public"]), data.get("version", ""))
@@ -1,42 +1,96 @@
 from functools import wraps
-from fastapi import HTTPException
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+import time
 
 # files
-from db import open_db, save_to_db, get_user_from_db, get_resource_info
-from settings import DB_resources
-from models import Resourse_info
+from cache import TTLCache
+from fastjson import dumps
+from db import store, get_resource_meta, get_resource_info, forget_resource
+from security import get_principal
+from policy import decide
+from models import Resourse_info, BatchResourceItem
+from search import MAX_QUERY_TERMS, query_terms
 
+# settings
+from settings import settings
 
+# сколько байт собирать в одну отправку при потоковой отдаче
+STREAM_BATCH_BYTES = 64 * 1024
+
+# готовые json ответы публичных ресурсов: owner -> (etag, тело).
+# Перед отдачей etag сверяется с текущей версией, так что чужие процессы
+# не отдадут устаревшее; свои изменения сразу выкидывают запись
+response_cache = TTLCache(settings.response_cache_size)
+
+
+def invalidate_resource(user_name: str):
+    response_cache.pop(user_name)
+    forget_resource(user_name)
+
+
+def resource_etag(version: str) -> str:
+    return f'"{version}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match: "a", W/"b" или * (сравнение слабое, как требует RFC 9110)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip().removeprefix("W/")
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+
+def cache_control(is_public: bool) -> str:
+    # no-cache: хранить можно, но перед использованием сверить ETag
+    if not is_public:
+        return "private, no-cache"
+    if settings.resource_cache_max_age > 0:
+        return f"public, max-age={settings.resource_cache_max_age}"
+    return "public, no-cache"
 
 
 class OwnershipCheck:
-    """Проверка принадлежности ресурса пользователю. Админам можно все"""
+    """Проверка принадлежности ресурса пользователю по таблице policy.
+    Кому хозяин не важен (админы), решает правило, а не этот декоратор"""
 
     def __call__(self, func):
 
         @wraps(func)
         async def wrapper(*args, **kwargs):
             try:
-                http_method = kwargs.get("request").method
+                request = kwargs.get("request")
                 # хозяин ресурса
                 resource_owner = kwargs.get("user_name")
-                # данные ресурса
                 # тот кто открыл ссылку
-                current_user = get_user_from_db(kwargs.get("username"))  # Pydantic
-                # админам можно все
-            except Exception as e:
+                principal = get_principal(request)
+                current_user = principal.user  # UserRecord
+                if current_user is None:
+                    raise
+                # решение уже посчитал PermissionChecker, иначе считаем сами
+                decision = getattr(request.state, "decision", None) or decide(
+                    principal.roles, request.scope["route"].path, request.method
+                )
+            except Exception:
                 raise HTTPException(
                     status_code=409,
                     detail="Ошибка получения resource_owner или current_user",
                 )
-            if "admin" in current_user.roles:
-                return await func(*args, **kwargs)
-                # роли
-
-            if http_method == "GET" and get_resource_info(resource_owner).is_public:
-                return await func(*args, **kwargs)
-            if resource_owner == current_user.username:
+            if not decision.allowed:
+                raise HTTPException(status_code=403, detail=f"В доступе отказано")
+            # хозяину и тем, кому хозяин не важен, диск не нужен
+            if not decision.need_owner or resource_owner == current_user.username:
                 return await func(*args, **kwargs)
+            if decision.public_read:
+                # для проверки хватает размера и флага, контент не читается.
+                # Обработчик возьмет их из request.state
+                meta = await get_resource_meta(resource_owner)
+                request.state.resource_meta = meta
+                if meta["is_public"]:
+                    return await func(*args, **kwargs)
             raise HTTPException(status_code=403, detail=f"В доступе отказано")
 
         return wrapper
@@ -44,43 +98,270 @@ class OwnershipCheck:
 
 # GET
 # просто получение инфы
-def get_resource(user_name):
-    """"""
-    return get_resource_info(user_name).model_dump()
+def parse_byte_range(header: str, size: int) -> tuple[int, int] | None:
+    """Range: bytes=a-b | bytes=a- | bytes=-n -> [start, stop).
+    Несколько диапазонов и непонятный заголовок - весь ресурс, как разрешает RFC 9110"""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            suffix = int(last)
+            if suffix <= 0:
+                raise HTTPException(
+                    status_code=416, headers={"Content-Range": f"bytes */{size}"}
+                )
+            return max(0, size - suffix), size
+        start = int(first)
+        stop = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+    if start >= size or start >= stop:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, stop
+
+
+def batched(chunks, limit: int = STREAM_BATCH_BYTES):
+    """Склейка мелких кусков, чтобы не ходить в пул потоков за каждым"""
+    parts, size = [], 0
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            yield b"".join(parts)
+            parts, size = [], 0
+    if parts:
+        yield b"".join(parts)
+
+
+def json_stream(chunks, is_public: bool):
+    """Тот же json, что и без потока, но контент экранируется по кускам.
+    Куски целые (диапазон - весь ресурс), поэтому utf-8 не рвется"""
+    yield b'{"content":"'
+    for chunk in chunks:
+        yield dumps(chunk.decode("utf-8"))[1:-1]
+    yield b'","is_public":' + (b"true" if is_public else b"false") + b"}"
+
+
+async def get_resource(
+    user_name,
+    request: Request,
+    meta: dict | None = None,
+    offset: int | None = None,
+    length: int | None = None,
+):
+    """meta - уже прочитанные размер и флаг (OwnershipCheck), чтобы не читать второй раз.
+    Range или offset/length - кусок контента байтами (text/plain), иначе json.
+    Большие ресурсы отдаются потоком и не собираются в памяти целиком.
+    If-None-Match с текущим ETag - 304 без чтения контента"""
+    if meta is None:
+        meta = await get_resource_meta(user_name)
+    size = meta["size"]
+    etag = resource_etag(meta["version"])
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Cache-Control": cache_control(meta["is_public"]),
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header:
+        byte_range = parse_byte_range(range_header, size)
+    elif offset is not None or length is not None:
+        start = offset or 0
+        byte_range = start, size if length is None else min(size, start + length)
+    if byte_range is not None:
+        start, stop = byte_range
+        chunks = await store.read_resource(user_name, start, stop)
+        if chunks is None:
+            raise HTTPException(status_code=404, detail="Нет такого ресурса")
+        status_code = 200
+        if range_header:
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        return StreamingResponse(
+            batched(chunks),
+            status_code=status_code,
+            media_type="text/plain; charset=utf-8",
+            headers=headers,
+        )
+
+    if size <= settings.resource_stream_threshold:
+        return await small_resource_response(user_name, meta, etag, headers)
+    chunks = await store.read_resource(user_name, 0, size)
+    if chunks is None:
+        raise HTTPException(status_code=404, detail="Нет такого ресурса")
+    return StreamingResponse(
+        json_stream(chunks, meta["is_public"]),
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+async def small_resource_response(user_name, meta: dict, etag: str, headers: dict):
+    """json целиком. Публичные ресурсы берутся из response_cache, если версия совпала"""
+    if meta["is_public"]:
+        cached = response_cache.get(user_name)
+        if cached is not None and cached[0] == etag:
+            return Response(cached[1], media_type="application/json", headers=headers)
+    # одновременные промахи по одному ресурсу читают его один раз
+    info = await get_resource_info(user_name)
+    # между чтением meta и контента ресурс мог поменяться: ETag по прочитанному
+    etag = headers["ETag"] = resource_etag(info.version)
+    headers["Cache-Control"] = cache_control(info.is_public)
+    # тот же json, что дала бы модель Resourse_info, но без ее сборки
+    body = dumps({"content": info.content, "is_public": info.is_public})
+    if info.is_public:
+        response_cache.put(user_name, (etag, body), time.time() + settings.response_cache_ttl)
+    return Response(body, media_type="application/json", headers=headers)
 
 
 # POST
 # создание данных для чела. Если данный чел есть в ресурсах, вызвать ошибку
-def create_resource(user_name: str, data: Resourse_info):
-    cur_db = open_db(DB_resources)
-    if user_name in cur_db:
-        raise HTTPException(status_code=409, detail="Resource already exist")
+async def create_resource(user_name: str, data: Resourse_info):
     try:
-        cur_db[user_name] = data.model_dump()
-        save_to_db(DB_resources, cur_db)
+        created = await store.create_resource(user_name, data.model_dump())
     except:
         raise HTTPException(status_code=404, detail="Ошибка в создании ресурса")
+    if not created:
+        raise HTTPException(status_code=409, detail="Resource already exist")
+    invalidate_resource(user_name)
 
     return {"success": f"profile with data {data} is created"}
 
 
 # PUT
 # проверка наличия чела в ресурсах и если он есть, то обновить его данные
-def put_info_to_resource(user_name, content_to_put: Resourse_info):
-    cur_db = open_db(DB_resources)
-    new_content = cur_db[user_name].get("content", "") + content_to_put.content
-    cur_db[user_name] = {"content": new_content, "is_public": content_to_put.is_public}
-    save_to_db(DB_resources, cur_db)
-    return {"success": new_content}
+async def put_info_to_resource(user_name, content_to_put: Resourse_info):
+    """Дописывает кусок. Весь контент в ответ не отдается, только новый размер"""
+    size = await store.append_resource(
+        user_name, content_to_put.content, content_to_put.is_public
+    )
+    invalidate_resource(user_name)
+    if size is None:
+        raise HTTPException(status_code=404, detail="Нет такого ресурса")
+    return {"success": "контент дописан", "size": size}
 
 
 # DELETE
 # удаление данных
-def delete_resource(user_name):
-    try:
-        cur_db = open_db(DB_resources)
-        cur_db.pop(user_name)
-        save_to_db(DB_resources, cur_db)
+async def delete_resource(user_name):
+    deleted = await store.delete_resource(user_name)
+    invalidate_resource(user_name)
+    if deleted:
         return {"success": f"Данные {user_name} удалены."}
-    except KeyError:
-        return {"error": f"resurce doesnt exist (Nothing to delete)"}
+    return {"error": "resurce doesnt exist (Nothing to delete)"}
+
+
+# пачки
+# ______________________________________________________________________________________
+def batch_caller(request: Request) -> tuple:
+    """Решение policy (его посчитал PermissionChecker) и имя того, кто спрашивает"""
+    principal = get_principal(request)
+    decision = getattr(request.state, "decision", None)
+    if principal is None or principal.user is None or decision is None:
+        raise HTTPException(
+            status_code=409,
+            detail="Ошибка получения resource_owner или current_user",
+        )
+    return decision, principal.username
+
+
+def batch_report(results: list[dict]) -> dict:
+    ok = sum(1 for result in results if result["status"] == 200)
+    return {"results": results, "ok": ok, "failed": len(results) - ok}
+
+
+def item_result(user_name: str, status: int, detail: str | None = None, **extra) -> dict:
+    result = {"user_name": user_name, "status": status, **extra}
+    if detail is not None:
+        result["detail"] = detail
+    return result
+
+
+async def batch_get_resources(request: Request, usernames: list[str]) -> dict:
+    """Одно чтение хранилища на всю пачку, права проверяются по каждому элементу"""
+    decision, current = batch_caller(request)
+    found = await store.get_resources(usernames)
+    results = []
+    for user_name in usernames:
+        info = found[user_name]
+        if info is None:
+            results.append(item_result(user_name, 404, "Нет такого ресурса"))
+        elif (
+            decision.need_owner
+            and user_name != current
+            and not (decision.public_read and info["is_public"])
+        ):
+            results.append(item_result(user_name, 403, "В доступе отказано"))
+        else:
+            results.append(item_result(user_name, 200, resource=info))
+    return batch_report(results)
+
+
+async def batch_create_resources(request: Request, items: list[BatchResourceItem]) -> dict:
+    decision, current = batch_caller(request)
+    allowed = [not decision.need_owner or item.user_name == current for item in items]
+    # чужие ресурсы отсекаются до записи, остальные создаются одной транзакцией
+    to_create = [
+        (item.user_name, {"content": item.content, "is_public": item.is_public})
+        for item, ok in zip(items, allowed)
+        if ok
+    ]
+    created = iter(await store.create_resources(to_create) if to_create else [])
+    for user_name, _ in to_create:
+        invalidate_resource(user_name)
+    results = []
+    for item, ok in zip(items, allowed):
+        if not ok:
+            results.append(item_result(item.user_name, 403, "В доступе отказано"))
+        elif next(created):
+            results.append(item_result(item.user_name, 200))
+        else:
+            results.append(item_result(item.user_name, 409, "Resource already exist"))
+    return batch_report(results)
+
+
+async def batch_delete_resources(request: Request, usernames: list[str]) -> dict:
+    decision, current = batch_caller(request)
+    allowed = [not decision.need_owner or user_name == current for user_name in usernames]
+    to_delete = [user_name for user_name, ok in zip(usernames, allowed) if ok]
+    deleted = iter(await store.delete_resources(to_delete) if to_delete else [])
+    for user_name in to_delete:
+        invalidate_resource(user_name)
+    results = []
+    for user_name, ok in zip(usernames, allowed):
+        if not ok:
+            results.append(item_result(user_name, 403, "В доступе отказано"))
+        elif next(deleted):
+            results.append(item_result(user_name, 200))
+        else:
+            results.append(item_result(user_name, 404, "Нет такого ресурса"))
+    return batch_report(results)
+
+
+# поиск
+# ______________________________________________________________________________________
+async def search_resources(request: Request, q: str, cursor: str | None, limit: int) -> dict:
+    """Ресурсы со всеми словами q по убыванию BM25. Кому нужен хозяин (owner в policy),
+    видит свой ресурс и публичные, остальные - все. cursor - сколько результатов уже отдано"""
+    decision, current = batch_caller(request)
+    terms = query_terms(q)
+    if not terms:
+        raise HTTPException(status_code=422, detail="В запросе нет ни одного слова")
+    if len(terms) > MAX_QUERY_TERMS:
+        raise HTTPException(
+            status_code=422, detail=f"В запросе больше {MAX_QUERY_TERMS} разных слов"
+        )
+    offset = 0
+    if cursor:
+        if not cursor.isdigit():
+            raise HTTPException(status_code=422, detail="Плохой cursor")
+        offset = int(cursor)
+    items = await store.search_resources(terms, current, not decision.need_owner, offset, limit)
+    next_cursor = str(offset + limit) if len(items) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
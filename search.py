@@ -0,0 +1,213 @@
+"""Полнотекстовый поиск по контенту ресурсов: токенизация и обратный индекс с BM25.
+
+Токены - буквы и цифры любого алфавита (кириллица тоже) в нижнем регистре, ё = е.
+Так же режет unicode61 в sqlite FTS5, поэтому оба бэкенда находят одно и то же.
+Запрос из нескольких слов - ресурсы, где есть все слова. Морфологии нет:
+"лет" не найдет "лета".
+
+SearchIndex обновляется точечно: новый ресурс, дописанный кусок, удаление.
+При дописывании пересчитывается только новый кусок и слово на его стыке.
+rank - BM25 по спискам {документ: частота} для SearchIndex. sqlite считает те же очки
+в SQL с весами из bm25_params.
+"""
+from collections import Counter
+from dataclasses import dataclass
+import heapq
+import math
+import re
+
+# буквы и цифры без "_": как разделители unicode61
+TOKEN_RE = re.compile(r"[^\W_]+")
+# слово на стыке кусков склеивается, только если его конец не длиннее. Иначе ресурс из
+# одного огромного "слова" при каждом дописывании переиндексировал бы его целиком
+MAX_JOINED_WORD = 100
+# параметры BM25, как у bm25() в FTS5
+K1 = 1.2
+B = 0.75
+# sqlite соединяет подзапрос на каждое слово, а в одном запросе не больше 64 таблиц
+MAX_QUERY_TERMS = 32
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_RE.findall(normalize(text))
+
+
+def query_terms(query: str) -> list[str]:
+    """Уникальные слова запроса по порядку"""
+    return list(dict.fromkeys(tokenize(query)))
+
+
+def split_tail(text: str) -> tuple[str, str]:
+    """Текст без последнего слова и само слово, если текст кончается буквой или цифрой
+    и слово не длиннее MAX_JOINED_WORD. Иначе (текст, "")"""
+    start = len(text)
+    while start and text[start - 1].isalnum():
+        start -= 1
+        if len(text) - start > MAX_JOINED_WORD:
+            return text, ""
+    return text[:start], text[start:]
+
+
+def chunk_rows(chunks) -> list[str]:
+    """Тексты для поиска по кускам ресурса, по одному на кусок. Слово на стыке кусков
+    целиком уходит в текст следующего куска: слова те же, что у склеенного контента"""
+    rows = []
+    for chunk in chunks:
+        text = normalize(chunk)
+        if rows and text[:1].isalnum():
+            rows[-1], tail = split_tail(rows[-1])
+            text = tail + text
+        rows.append(text)
+    return rows
+
+
+def bm25_params(
+    doc_freqs: list[int], n: int, total_length: int
+) -> tuple[list[float], float, float]:
+    """(веса слов, base, per_token): очки документа длины length -
+    сумма weight * tf / (tf + base + per_token * length) по словам запроса"""
+    avg_length = total_length / n if total_length else 1.0
+    # idf как у FTS5: слово почти во всех документах весит чуть больше нуля.
+    # Множитель K1 + 1 сразу в весе
+    weights = [
+        max(math.log((n - df + 0.5) / (df + 0.5)), 1e-6) * (K1 + 1) for df in doc_freqs
+    ]
+    return weights, K1 * (1 - B), K1 * B / avg_length
+
+
+def rank(
+    postings: list[dict], doc_freqs: list[int], candidates, n: int, total_length: int,
+    offset: int, limit: int,
+) -> list[tuple[object, float]]:
+    """BM25 как у bm25() в FTS5. postings - {документ: частота} на каждое слово запроса,
+    doc_freqs - в скольких документах слово, candidates - (документ, длина) тех, где есть
+    все слова и которые можно показать. [(документ, очки)] по убыванию очков,
+    при равных - по документу, не больше limit после offset лучших"""
+    weights, base, per_token = bm25_params(doc_freqs, n, total_length)
+    pairs = list(zip(weights, postings))
+    scored = []
+    for key, length in candidates:
+        norm = base + per_token * length
+        score = 0.0
+        for weight, posting in pairs:
+            tf = posting[key]
+            score += weight * tf / (tf + norm)
+        scored.append((-score, key))
+    # при равных очках - по документу, чтобы страницы не менялись от запроса к запросу
+    top = heapq.nsmallest(offset + limit, scored)
+    return [(key, -score) for score, key in top[offset:]]
+
+
+@dataclass(slots=True)
+class _Doc:
+    terms: set
+    length: int
+    is_public: bool
+    # недописанное слово в конце контента: следующий кусок может его продолжить
+    tail: str
+
+
+class SearchIndex:
+    """Терм -> {хозяин: частота} и длины документов. Не потокобезопасен сам по себе:
+    изменения и поиск вызываются под блокировкой хранилища"""
+
+    def __init__(self):
+        self.postings: dict[str, dict[str, int]] = {}
+        self.docs: dict[str, _Doc] = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, owner: str, text: str, is_public: bool):
+        self.remove(owner)
+        doc = self.docs[owner] = _Doc(set(), 0, bool(is_public), "")
+        self._index_text(owner, doc, text, fresh=True)
+
+    def append(self, owner: str, text: str, is_public: bool):
+        doc = self.docs.get(owner)
+        if doc is None:
+            return self.add(owner, text, is_public)
+        doc.is_public = bool(is_public)
+        if doc.tail:
+            # слово на стыке: старый хвост плюс начало куска - одно слово
+            self._drop_token(owner, doc, doc.tail)
+            text = doc.tail + text
+        self._index_text(owner, doc, text, fresh=False)
+
+    def _index_text(self, owner: str, doc: _Doc, text: str, fresh: bool):
+        """fresh - документа еще нет ни в одном списке, прибавлять не к чему"""
+        tokens = tokenize(text)
+        doc.tail = (
+            tokens[-1]
+            if tokens and text[-1:].isalnum() and len(tokens[-1]) <= MAX_JOINED_WORD
+            else ""
+        )
+        postings = self.postings
+        counts = Counter(tokens)
+        for token, tf in counts.items():
+            posting = postings.get(token)
+            if posting is None:
+                postings[token] = {owner: tf}
+            elif fresh:
+                posting[owner] = tf
+            else:
+                posting[owner] = posting.get(owner, 0) + tf
+        doc.terms.update(counts)
+        doc.length += len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, owner: str):
+        doc = self.docs.pop(owner, None)
+        if doc is None:
+            return
+        self.total_length -= doc.length
+        for term in doc.terms:
+            posting = self.postings[term]
+            del posting[owner]
+            if not posting:
+                del self.postings[term]
+
+    def _drop_token(self, owner: str, doc: _Doc, token: str):
+        posting = self.postings[token]
+        if posting[owner] > 1:
+            posting[owner] -= 1
+        else:
+            del posting[owner]
+            doc.terms.discard(token)
+            if not posting:
+                del self.postings[token]
+        doc.length -= 1
+        self.total_length -= 1
+
+    def search(
+        self, terms: list[str], viewer: str | None, see_all: bool, offset: int, limit: int
+    ) -> list[tuple[str, float]]:
+        """[(хозяин, очки)] по убыванию очков, не больше limit после offset лучших.
+        Видны публичные, свои (viewer) и все при see_all"""
+        postings = [self.postings.get(term) for term in terms]
+        if not terms or not all(postings):
+            return []
+        # обход по самому короткому списку, остальные слова проверяются поиском в dict
+        postings.sort(key=len)
+        first, rest = postings[0], postings[1:]
+        docs = self.docs
+        candidates = (
+            (owner, doc.length)
+            for owner, doc in zip(first, map(docs.__getitem__, first))
+            if (see_all or doc.is_public or owner == viewer)
+            and all(owner in posting for posting in rest)
+        )
+        return rank(
+            postings,
+            [len(posting) for posting in postings],
+            candidates,
+            len(docs),
+            self.total_length,
+            offset,
+            limit,
+        )
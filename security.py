@@ -6,60 +6,99 @@ from fastapi.security import (
 )
 from fastapi.exceptions import HTTPException
 import jwt
-from passlib.context import CryptContext
+from dataclasses import dataclass, field
 import datetime
-
-
-import secrets
+import hashlib
+import uuid
 
 # files
-from db import get_user_from_db, open_db, save_refresh_token_to_db
-from models import UserInDB
+from cache import TTLCache
+from keys import build_key_ring
+from metrics import span
+from db import get_user_from_db, rotate_refresh_token_in_db, save_refresh_token_to_db
+from storage import refresh_record
+from records import UserRecord
+from passwords import verify_password
 
 # settings
-from settings import (
-    DB_REFRESH_TOKENS,
-    SECRET_KEY,
-    ALGORITHM,
-    ACCESS_TOKEN_EXPIRE_MINUTES,
-    REFRESH_TOKEN_EXPIRE_MINUTES,
-    JWT_decode_method,
-)
+from settings import settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 security = HTTPBasic()
-pwd_context = CryptContext(
-    schemes=["bcrypt"],
-    bcrypt__rounds=4,
-    deprecated="auto",
-)
+
+# ключи подписи и проверки jwt, pem разбираются один раз при импорте
+key_ring = build_key_ring()
 
 
-def create_jwt_token(data: dict, type: str) -> str:
+def new_refresh_token(username: str, family: str | None = None) -> tuple[str, str, dict]:
+    """Рефреш токен с jti и семьей -> (токен, jti, запись для хранилища).
+    Без family начинается новая семья (новый логин, новое устройство)"""
+    expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        minutes=settings.refresh_token_expire_minutes
+    )
+    jti = uuid.uuid4().hex
+    family = family or uuid.uuid4().hex
+    to_encode = {"sub": username, "exp": expire, "type": "REFRESH", "jti": jti, "fam": family}
+    token = key_ring.sign(to_encode)
+    return token, jti, refresh_record(username, family, int(expire.timestamp()))
+
+
+async def create_jwt_token(data: dict, type: str) -> str:
+    """data["fam"] - семья рефреш токена. Access токен с семьей перестает приниматься,
+    когда семью отзывают"""
     to_encode = data.copy()
     if type == "REFRESH":
-        expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
-            minutes=REFRESH_TOKEN_EXPIRE_MINUTES
-        )
-        to_encode.update({"exp": expire, "type": type})
-        token = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-        save_refresh_token_to_db(data, new_token=token)
+        token, jti, record = new_refresh_token(data["sub"], data.get("fam"))
+        await save_refresh_token_to_db(jti, record)
         return token
     elif type == "ACCESS":
         expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
-            minutes=ACCESS_TOKEN_EXPIRE_MINUTES
+            minutes=settings.access_token_expire_minutes
         )
         to_encode.update({"exp": expire, "type": type})
-        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+        return key_ring.sign(to_encode)
     else:
         raise HTTPException(status_code=401, detail="ошибка названия вида токена")
 
 
+# кэш проверенных токенов: sha256 токена -> claims, живет до exp. JWT_CACHE_SIZE=0 выключает
+jwt_cache = TTLCache(settings.jwt_cache_size)
+# семьи, отозванные за повтор рефреш токена: fam -> до какого времени помнить.
+# Токены этих семей не принимаются ни из кэша, ни после проверки подписи. Другой воркер
+# узнает об отзыве, когда к нему придет рефреш токен этой семьи
+REVOKED_FAMILIES_SIZE = 10000
+revoked_families = TTLCache(REVOKED_FAMILIES_SIZE)
+
+
+def _token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+def revoke_cached_token(token: str):
+    """Убрать токен из кэша, чтобы следующая проверка снова шла через jwt.decode"""
+    jwt_cache.pop(_token_key(token))
+
+
+def revoke_family(family: str, expires_at: float):
+    revoked_families.put(family, True, expires_at)
+
+
+def _not_revoked(claims: dict) -> dict:
+    if "fam" in claims and revoked_families.get(claims["fam"]) is not None:
+        raise HTTPException(status_code=401, detail="токен отозван. Залогиньтесь заново")
+    return dict(claims)
+
+
 def decode_jwt(token: str):
+    if jwt_cache.maxsize > 0:
+        cached = jwt_cache.get(_token_key(token))
+        if cached is not None:
+            return _not_revoked(cached)
     try:
-        decoded_token = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return decoded_token
+        decoded_token = key_ring.verify(token)
+        if "exp" in decoded_token:
+            jwt_cache.put(_token_key(token), decoded_token, decoded_token["exp"])
     except jwt.ExpiredSignatureError as e:
         raise HTTPException(
             status_code=401,
@@ -67,13 +106,49 @@ def decode_jwt(token: str):
         )
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"{e},ошибки декодирования токена")
+    return _not_revoked(decoded_token)
+
+
+@dataclass
+class Principal:
+    """Кто делает запрос. Считается один раз на запрос и лежит в request.state.principal"""
+
+    claims: dict
+    user: UserRecord | None
+    roles: frozenset = field(default_factory=frozenset)
+
+    @property
+    def username(self) -> str:
+        return self.claims["sub"]
+
+
+async def resolve_principal(request: Request, claims: dict) -> Principal:
+    """Один поиск юзера на запрос. Дальше декораторы и лимитер берут его из request.state"""
+    try:
+        user = await get_user_from_db(claims["sub"])
+    except HTTPException:
+        user = None
+    principal = Principal(
+        claims=claims,
+        user=user,
+        roles=user.roles if user else frozenset(),
+    )
+    request.state.principal = principal
+    return principal
 
 
-def decode_jwt_from_Header(token: str = Depends(oauth2_scheme)):
-    decoded_token = decode_jwt(token)
-    if decoded_token["type"] != "ACCESS":
-        raise HTTPException(status_code=404, detail="не тот тип токена")
-    return decoded_token["sub"]
+def get_principal(request: Request) -> Principal | None:
+    return getattr(request.state, "principal", None)
+
+
+async def decode_jwt_from_Header(
+    request: Request, token: str = Depends(oauth2_scheme)
+):
+    with span("auth", "jwt"):
+        decoded_token = decode_jwt(token)
+        if decoded_token["type"] != "ACCESS":
+            raise HTTPException(status_code=404, detail="не тот тип токена")
+        return (await resolve_principal(request, decoded_token)).username
 
 
 # способы получения токена из куки
@@ -82,14 +157,15 @@ def decode_jwt_from_Header(token: str = Depends(oauth2_scheme)):
 #    return decode_jwt(access_token)
 
 
-def decode_jwt_from_Cookie(request: Request):
+async def decode_jwt_from_Cookie(request: Request):
     access_token = request.cookies.get("access_token")
     if access_token is None:
         raise HTTPException(status_code=403, detail=f"Истечение срока действия куки")
-    decoded_token = decode_jwt(access_token)
-    if decoded_token["type"] != "ACCESS":
-        raise HTTPException(status_code=404, detail="не тот тип токена")
-    return decoded_token["sub"]
+    with span("auth", "jwt"):
+        decoded_token = decode_jwt(access_token)
+        if decoded_token["type"] != "ACCESS":
+            raise HTTPException(status_code=404, detail="не тот тип токена")
+        return (await resolve_principal(request, decoded_token)).username
 
 
 # способ декодирования jwt токена. Куки или заголовок
@@ -97,22 +173,41 @@ try:
     decode_jwt_method = {
         "cookie": decode_jwt_from_Cookie,
         "headers": decode_jwt_from_Header,
-    }[JWT_decode_method]
+    }[settings.jwt_decode_method]
 except:
     decode_jwt_method = decode_jwt_from_Cookie
 
 
-def validate_refresh_token(token: str, response: Response):
+# почему rotate_refresh_token не принял токен
+REFRESH_REJECTED = {
+    "missing": "рефреш токен не найден или истек. Залогиньтесь заново",
+    "revoked": "рефреш токен отозван. Залогиньтесь заново",
+    "reused": "рефреш токен уже использован, все токены этого входа отозваны",
+}
+
+
+async def validate_refresh_token(token: str, response: Response):
+    """Ротация: одна запись по jti вместо сравнения строк токенов.
+    Повторное предъявление уже замененного токена отзывает всю семью"""
     try:
         coded_token = token
         token = decode_jwt(coded_token)
         username = token["sub"]
         if token["type"] != "REFRESH":
             raise TypeError("Тип токена не REFRESH")
-        cur_db = open_db(DB_REFRESH_TOKENS)
-        if secrets.compare_digest(cur_db[username], coded_token):
-            access_token = create_jwt_token({"sub": username}, type="ACCESS")
-            refresh_token = create_jwt_token({"sub": username}, type="REFRESH")
+        if "jti" not in token or "fam" not in token:
+            raise TypeError("рефреш токен старого вида. Залогиньтесь заново")
+        refresh_token, new_jti, record = new_refresh_token(username, token["fam"])
+        status = await rotate_refresh_token_in_db(token["jti"], new_jti, record)
+        # старый рефреш токен больше не годится, его не должно быть в кэше
+        revoke_cached_token(coded_token)
+        if status in ("reused", "revoked"):
+            # и access токены этой семьи, в том числе уже лежащие в кэше
+            revoke_family(token["fam"], record["exp"])
+        if status == "ok":
+            access_token = await create_jwt_token(
+                {"sub": username, "fam": token["fam"]}, type="ACCESS"
+            )
             response.set_cookie(
                 key="Authorization", value=access_token, httponly=True, secure=True
             )
@@ -120,7 +215,7 @@ def validate_refresh_token(token: str, response: Response):
                 "access_token": f"Bearer {access_token}",
                 "refresh_token": refresh_token,
             }
-        raise jwt.ExpiredSignatureError
+        raise TypeError(REFRESH_REJECTED[status])
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail=f"ошибка декодирования токена")
     except jwt.ExpiredSignatureError as e:
@@ -132,14 +227,18 @@ def validate_refresh_token(token: str, response: Response):
         raise HTTPException(status_code=401, detail=f"{e}")
 
 
-def auth_user(credentials: HTTPBasicCredentials = Depends(security)) -> UserInDB:
-    user = get_user_from_db(credentials.username)
-    if user is None or not pwd_context.verify(
-        credentials.password, user.hashed_password
-    ):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Basic"},
-        )
-    return user
+async def auth_user(
+    credentials: HTTPBasicCredentials = Depends(security),
+) -> UserRecord:
+    with span("auth", "basic"):
+        user = await get_user_from_db(credentials.username)
+        # bcrypt считается в пуле, event loop в это время обслуживает других
+        if user is None or not await verify_password(
+            credentials.password, user.hashed_password
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect username or password",
+                headers={"WWW-Authenticate": "Basic"},
+            )
+        return user
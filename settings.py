@@ -1,22 +1,178 @@
-from dotenv import load_dotenv
-import os
+"""Настройки приложения: переменные окружения и settings.env, читаются один раз при импорте.
+
+Все значения лежат в одном объекте settings с типами: from settings import settings.
+Переменные окружения важнее settings.env. Обязательные настройки (без значения
+по умолчанию) и значения не того типа роняют старт одной ошибкой со списком всех проблем.
+"""
+from dataclasses import dataclass, field, fields, MISSING
 from pathlib import Path
+import os
+
+BASE_DIR = Path(__file__).parent
+ENV_FILE = BASE_DIR / "settings.env"
+
+
+class SettingsError(ValueError):
+    pass
+
+
+def env(name: str, default=MISSING):
+    """Поле, у которого имя переменной не равно имени поля в верхнем регистре"""
+    return field(default=default, metadata={"env": name})
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    # jwt
+    algorithm: str
+    access_token_expire_minutes: int
+    refresh_token_expire_minutes: int
+    secret_key: str | None = None
+    # откуда брать access токен: cookie или headers
+    jwt_decode_method: str = env("JWT_decode_method", "cookie")
+    # размер кэша проверенных jwt, 0 - без кэша
+    jwt_cache_size: int = 10000
+    # асимметричная подпись jwt (ALGORITHM RS256, ES256, EdDSA...): kid и закрытый ключ pem,
+    # JWT_PUBLIC_KEYS - старые открытые ключи для проверки, "kid=путь,kid:ALG=путь"
+    jwt_kid: str | None = None
+    jwt_private_key_file: str | None = None
+    jwt_public_keys: str = ""
+    # сколько секунд клиенты могут кэшировать /.well-known/jwks.json
+    jwks_max_age: int = 300
+    # раз в сколько секунд удалять истекшие рефреш токены, 0 - не удалять
+    refresh_sweep_interval: float = 300.0
+
+    # хранилище: json (файлы DB, DB_resources, DB_REFRESH_TOKENS) или sqlite
+    storage_backend: str = "json"
+    db: str | None = None
+    db_resources: str | None = env("DB_resources", None)
+    db_refresh_tokens: str | None = None
+    sqlite_path: str = str(BASE_DIR / "db" / "db.sqlite3")
+    sqlite_pool_size: int = 4
+    # json: раз в сколько секунд сбрасывать накопленные изменения, 0 - писать сразу
+    db_flush_interval: float = 0.0
+    # json: журнал изменений для ресурсов и рефреш токенов вместо перезаписи файлов
+    db_wal: bool = False
+    db_wal_compact_every: int = 10000
+    db_wal_fsync: bool = True
+    # json файлы с отступами, чтобы читать глазами. По умолчанию компактно
+    db_pretty: bool = False
+    # json: бинарный снапшот юзеров (snapshot.py), общий для всех воркеров через mmap
+    users_snapshot: str | None = None
+
+    # bcrypt: стоимость хеша и пул, в котором он считается (thread или process)
+    bcrypt_rounds: int = 4
+    password_pool_kind: str = "thread"
+    password_pool_workers: int = os.cpu_count() or 1
+    password_pool_max_pending: int = 64
+
+    # лимиты slowapi: memory:// (в каждом процессе свои), sqlite:///путь (общие на машине) или redis://
+    ratelimit_storage_uri: str = "memory://"
+    # fixed-window, moving-window или sliding-window-counter
+    ratelimit_strategy: str = "fixed-window"
+    # лимиты запросов по ролям, первая подходящая роль выигрывает. Без роли - RATE_LIMIT_DEFAULT
+    rate_limits: str = "admin:1000/minute,user:50/minute,guest:20/minute"
+    rate_limit_default: str = "20/minute"
+
+    # метрики запросов и участков кода для /metrics, 0 - не записывать
+    metrics_enabled: bool = True
+
+    # роли и иерархия: "admin>user" - admin получает все, что разрешено user
+    roles: str = "admin,user,guest"
+    role_hierarchy: str = "admin>user,user>guest"
+    # кому можно чужие ресурсы (проверка владельца не нужна)
+    owner_bypass_roles: str = "admin"
+    # json с таблицей доступа маршрут -> метод -> правило, по умолчанию policy.DEFAULT_POLICY
+    policy_file: str | None = None
+
+    # склейка одинаковых чтений юзеров и ресурсов в полете (singleflight.py)
+    singleflight_enabled: bool = True
+    # по скольким последним ключам хранить статистику склейки
+    singleflight_stats_keys: int = 1024
+
+    # ресурсы больше стольких байт отдаются потоком, а не одним json
+    resource_stream_threshold: int = 65536
+    # сколько ресурсов можно запросить, создать или удалить одной пачкой
+    batch_max_items: int = 1000
+    # кэш готовых ответов публичных ресурсов: сколько штук и сколько секунд живут
+    response_cache_size: int = 1024
+    response_cache_ttl: float = 60.0
+    # Cache-Control: max-age для публичных ресурсов, 0 - клиент сверяет ETag каждый раз
+    resource_cache_max_age: int = 0
+
+
+FIELDS = {f.name: f for f in fields(Settings)}
+
+
+def env_name(f) -> str:
+    return f.metadata.get("env", f.name.upper())
+
+
+def parse_value(raw: str, type_):
+    if type_ is bool:
+        value = raw.strip().lower()
+        if value in ("1", "true", "yes", "on"):
+            return True
+        if value in ("0", "false", "no", "off"):
+            return False
+        raise ValueError(raw)
+    if type_ in (int, float):
+        return type_(raw)
+    # str и str | None
+    return raw
+
+
+def check(settings: Settings) -> list[str]:
+    """Проверки, которые зависят от нескольких настроек сразу"""
+    errors = []
+    if settings.storage_backend not in ("json", "sqlite"):
+        errors.append(f"STORAGE_BACKEND: json или sqlite, а не {settings.storage_backend!r}")
+    if settings.storage_backend == "json":
+        for name in ("db", "db_resources", "db_refresh_tokens"):
+            if not getattr(settings, name):
+                errors.append(f"{env_name(FIELDS[name])}: обязателен для STORAGE_BACKEND=json")
+    if settings.users_snapshot and settings.storage_backend != "json":
+        errors.append("USERS_SNAPSHOT: только для STORAGE_BACKEND=json")
+    if settings.algorithm.startswith("HS") and not settings.secret_key:
+        errors.append(f"SECRET_KEY: обязателен для ALGORITHM={settings.algorithm}")
+    if settings.password_pool_kind not in ("thread", "process"):
+        errors.append(
+            f"PASSWORD_POOL_KIND: thread или process, а не {settings.password_pool_kind!r}"
+        )
+    return errors
+
+
+def read_env_file(path: Path = ENV_FILE) -> dict:
+    if not path.exists():
+        return {}
+    # dotenv нужен только если файл есть
+    from dotenv import dotenv_values
+
+    return {key: value for key, value in dotenv_values(path).items() if value is not None}
 
 
-# режим окржуения
-def get_settings(setting):
-    load_dotenv(Path(__file__).parent / "settings.env")
-    try:
-        return os.getenv(setting)
-    except:
-        raise
+def load_settings(environ=None) -> Settings:
+    """settings.env, поверх него environ (по умолчанию os.environ), все ошибки сразу"""
+    source = {**read_env_file(), **(os.environ if environ is None else environ)}
+    values, errors = {}, []
+    for f in FIELDS.values():
+        name = env_name(f)
+        raw = source.get(name)
+        if raw is None:
+            if f.default is MISSING:
+                errors.append(f"{name}: не задан")
+            continue
+        try:
+            values[f.name] = parse_value(raw, f.type)
+        except ValueError:
+            type_name = getattr(f.type, "__name__", f.type)
+            errors.append(f"{name}: ожидалось {type_name}, а не {raw!r}")
+    if not errors:
+        settings = Settings(**values)
+        errors = check(settings)
+    if errors:
+        raise SettingsError("Ошибки в настройках:\n  " + "\n  ".join(errors))
+    return settings
 
 
-SECRET_KEY = get_settings("SECRET_KEY")
-ALGORITHM = get_settings("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(get_settings("ACCESS_TOKEN_EXPIRE_MINUTES"))
-REFRESH_TOKEN_EXPIRE_MINUTES = int(get_settings("REFRESH_TOKEN_EXPIRE_MINUTES"))
-DB = get_settings("DB")
-DB_resources = get_settings("DB_resources")
-DB_REFRESH_TOKENS = get_settings("DB_REFRESH_TOKENS")
-JWT_decode_method = get_settings("JWT_decode_method")
+settings = load_settings()
@@ -0,0 +1,91 @@
+"""Склейка одинаковых чтений в полете (single-flight) для asyncio обработчиков.
+
+Пока загрузка по ключу идет, остальные вызовы с тем же ключом не запускают свою,
+а ждут ту же задачу и получают тот же результат (или ту же ошибку). Результат
+не кэшируется: после завершения следующий вызов снова идет в хранилище.
+Результат общий для всех ждущих, поэтому отдавать можно только то, что не меняют
+на месте (UserRecord, ResourceRecord, словари meta только на чтение).
+"""
+from collections import OrderedDict
+import asyncio
+
+
+class SingleFlight:
+    """flight.do(key, fn, *args): fn(*args) - корутина загрузки, одна на ключ в полете.
+
+    Загрузка идет отдельной задачей: отмена первого вызова (клиент ушел) не роняет
+    остальных. Статистика: всего и по ключам (последние stats_keys ключей, LRU)"""
+
+    def __init__(self, enabled: bool = True, stats_keys: int = 1024):
+        self.enabled = enabled
+        self.stats_keys = stats_keys
+        self._flights: dict = {}
+        # key -> [вызовов, склеено]
+        self._key_stats: OrderedDict = OrderedDict()
+        self.calls = 0
+        self.loads = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+        self._waiters: dict = {}
+
+    async def do(self, key, fn, *args):
+        if not self.enabled:
+            return await fn(*args)
+        self.calls += 1
+        task = self._flights.get(key)
+        if task is None:
+            self.loads += 1
+            task = self._flights[key] = asyncio.ensure_future(fn(*args))
+            self._waiters[task] = 1
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self._count(key, coalesced=False)
+        else:
+            self.coalesced += 1
+            waiters = self._waiters[task] = self._waiters[task] + 1
+            self.max_waiters = max(self.max_waiters, waiters)
+            self._count(key, coalesced=True)
+        return await asyncio.shield(task)
+
+    def forget(self, key):
+        """После записи: новые вызовы пойдут за свежими данными, а не присоединятся
+        к чтению, начатому до записи. Уже ждущие получат его результат"""
+        self._flights.pop(key, None)
+
+    def _finish(self, key, task: asyncio.Future):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        self._waiters.pop(task, None)
+        # ошибку забирают ждущие; если их всех отменили, не пишем "never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    def _count(self, key, coalesced: bool):
+        if self.stats_keys <= 0:
+            return
+        stats = self._key_stats.get(key)
+        if stats is None:
+            stats = self._key_stats[key] = [0, 0]
+            if len(self._key_stats) > self.stats_keys:
+                self._key_stats.popitem(last=False)
+        else:
+            self._key_stats.move_to_end(key)
+        stats[0] += 1
+        stats[1] += coalesced
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights),
+            "max_waiters": self.max_waiters,
+            "coalesced_ratio": self.coalesced / self.calls if self.calls else 0.0,
+        }
+
+    def top_keys(self, n: int = 20) -> list[dict]:
+        """Ключи с наибольшим числом склеенных вызовов"""
+        items = sorted(self._key_stats.items(), key=lambda item: item[1][1], reverse=True)
+        return [
+            {"key": key, "calls": calls, "coalesced": coalesced}
+            for key, (calls, coalesced) in items[:n]
+        ]
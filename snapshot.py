@@ -0,0 +1,195 @@
+"""Бинарный снапшот юзеров для нескольких воркеров: один файл в page cache на всю машину.
+
+USERS_SNAPSHOT=db/users.snap (только STORAGE_BACKEND=json). Воркеры не парсят db.json
+ради чтения, а отображают снапшот в память (mmap) и ищут юзера по хеш-таблице прямо
+в файле. Снапшот переписывается целиком и атомарно после каждой записи db.json,
+а в файл <снапшот>.gen увеличивается поколение. Читатель сверяет 8 байт поколения
+на каждом поиске (тоже mmap, без системных вызовов) и переоткрывает снапшот, только
+если оно поменялось.
+
+Формат (little-endian):
+    заголовок  HEADER: magic, версия, поколение, inode/mtime_ns/size db.json, юзеров, слотов
+    таблица    slots * u32: смещение записи или 0, слот = crc32(username) & (slots - 1)
+    записи     RECORD: длины (u32) username, id, hashed_password, roles, затем сами байты utf-8,
+               roles через запятую
+"""
+from array import array
+from zlib import crc32
+import mmap
+import os
+import struct
+import sys
+import threading
+
+MAGIC = b"USNP"
+VERSION = 2
+HEADER = struct.Struct("<4sHHQQQQII")
+# длины полей u32: размер username моделью не ограничен
+RECORD = struct.Struct("<IIII")
+SLOT = struct.Struct("<I")
+GENERATION = struct.Struct("<Q")
+EMPTY_STAMP = (0, 0, 0)
+# смещения записей в таблице u32
+MAX_SIZE = 0xFFFFFFFF
+
+
+def generation_path(path: str) -> str:
+    return path + ".gen"
+
+
+def table_slots(users: int) -> int:
+    # заполнение таблицы не больше половины: поиск в среднем за 1-2 пробы
+    return 1 << max(3, (2 * users - 1).bit_length())
+
+
+def record_size(user_id: str, user: dict) -> int:
+    """Байт записи юзера в снапшоте"""
+    return (
+        RECORD.size
+        + len(user["username"].encode())
+        + len(user_id.encode())
+        + len(user["hashed_password"].encode())
+        + len(",".join(user["roles"]).encode())
+    )
+
+
+def snapshot_size(users: int, records_size: int) -> int:
+    """Размер снапшота по числу юзеров и сумме record_size"""
+    return HEADER.size + SLOT.size * table_slots(users) + records_size
+
+
+def pack_users(users: dict, generation: int, source_stamp=EMPTY_STAMP) -> bytearray:
+    """Снапшот из словаря db.json {id: {username, hashed_password, roles}}.
+    ValueError, если юзеры в формат не влезают"""
+    slots = table_slots(len(users))
+    mask = slots - 1
+    table = array("I", bytes(SLOT.size * slots))
+    body = bytearray()
+    start = HEADER.size + SLOT.size * slots
+    for user_id, user in users.items():
+        name = user["username"].encode()
+        uid = user_id.encode()
+        hashed_password = user["hashed_password"].encode()
+        roles = ",".join(user["roles"]).encode()
+        slot = crc32(name) & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = start + len(body)
+        # одна растущая bytearray вместо миллиона отдельных bytes: в полтора раза быстрее
+        body += RECORD.pack(len(name), len(uid), len(hashed_password), len(roles))
+        body += name
+        body += uid
+        body += hashed_password
+        body += roles
+    offset = start + len(body)
+    if offset > MAX_SIZE:
+        raise ValueError("Снапшот юзеров больше 4 ГБ")
+    if sys.byteorder == "big":
+        table.byteswap()
+    header = HEADER.pack(MAGIC, VERSION, 0, generation, *source_stamp, len(users), slots)
+    return bytearray().join((header, table.tobytes(), body))
+
+
+def stamp_source(payload: bytearray, source_stamp):
+    """stamp db.json в заголовок уже собранного снапшота: снапшот собирается до
+    записи db.json, а stamp известен только после нее"""
+    magic, version, pad, generation, *_, users, slots = HEADER.unpack_from(payload)
+    HEADER.pack_into(payload, 0, magic, version, pad, generation, *source_stamp, users, slots)
+
+
+def read_header(path: str) -> tuple | None:
+    """(поколение, stamp db.json) из заголовка или None, если снапшота нет или он чужой"""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read(HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(raw) < HEADER.size:
+        return None
+    magic, version, _, generation, ino, mtime_ns, size, _, _ = HEADER.unpack(raw)
+    if magic != MAGIC or version != VERSION:
+        return None
+    return generation, (ino, mtime_ns, size)
+
+
+def read_generation(path: str) -> int:
+    try:
+        with open(generation_path(path), "rb") as f:
+            raw = f.read(GENERATION.size)
+    except FileNotFoundError:
+        return 0
+    return GENERATION.unpack(raw)[0] if len(raw) == GENERATION.size else 0
+
+
+def set_generation(path: str, generation: int):
+    """Новое поколение на месте, чтобы читатели видели его через уже открытый mmap.
+    Вызывать после rename нового снапшота"""
+    fd = os.open(generation_path(path), os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, "r+b") as f:
+        f.write(GENERATION.pack(generation))
+
+
+class UserSnapshot:
+    """Поиск юзеров по снапшоту. Потокобезопасный, открывается при первом поиске"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self._generation_map = None
+        # (mmap, маска таблицы, поколение) одним объектом: потоки берут его целиком
+        self._view = None
+
+    def generation(self) -> int:
+        if self._generation_map is None:
+            with self.lock:
+                if self._generation_map is None:
+                    with open(generation_path(self.path), "rb") as f:
+                        self._generation_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return GENERATION.unpack_from(self._generation_map)[0]
+
+    def _open(self, generation: int):
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, *_, slots = HEADER.unpack_from(mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path}: не снапшот юзеров версии {VERSION}")
+        # старый mmap не закрываем: его могут читать другие потоки, закроет сборщик мусора
+        self._view = (mm, slots - 1, generation)
+
+    def view(self) -> tuple:
+        generation = self.generation()
+        view = self._view
+        if view is None or view[2] != generation:
+            with self.lock:
+                view = self._view
+                if view is None or view[2] != generation:
+                    self._open(generation)
+                    view = self._view
+        return view
+
+    def get(self, username: str) -> dict | None:
+        mm, mask, _ = self.view()
+        name = username.encode()
+        slot = crc32(name) & mask
+        while True:
+            (offset,) = SLOT.unpack_from(mm, HEADER.size + SLOT.size * slot)
+            if offset == 0:
+                return None
+            name_len, id_len, hash_len, roles_len = RECORD.unpack_from(mm, offset)
+            start = offset + RECORD.size
+            if name_len == len(name) and mm[start : start + name_len] == name:
+                start += name_len + id_len
+                hashed_password = mm[start : start + hash_len].decode()
+                start += hash_len
+                roles = mm[start : start + roles_len].decode()
+                return {
+                    "username": username,
+                    "hashed_password": hashed_password,
+                    "roles": roles.split(",") if roles else [],
+                }
+            slot = (slot + 1) & mask
+
+    def close(self):
+        with self.lock:
+            self._view = None
+            self._generation_map = None
@@ -0,0 +1,600 @@
+"""SQLite бэкенд хранилища: STORAGE_BACKEND=sqlite, файл SQLITE_PATH.
+
+Режим WAL и пул соединений, можно запускать несколько воркеров. Перенос json из db/:
+    python storage_cli.py migrate
+"""
+from contextlib import contextmanager
+from fastapi.exceptions import HTTPException
+import queue
+import sqlite3
+
+# files
+from fastjson import dumps, loads
+from search import bm25_params, chunk_rows, normalize, split_tail, tokenize
+from storage import (
+    FAMILY_PREFIX,
+    Storage,
+    new_resource_gen,
+    normalize_resource,
+    resource_view,
+    search_hit,
+    slice_chunks,
+)
+
+
+# запросы sqlite. Строки постоянные, поэтому sqlite3 держит их скомпилированными в кэше соединения
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    hashed_password TEXT NOT NULL,
+    roles TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username);
+CREATE TABLE IF NOT EXISTS user_roles (
+    role TEXT NOT NULL,
+    username TEXT NOT NULL,
+    PRIMARY KEY (role, username)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_user_roles_username ON user_roles (username);
+CREATE TABLE IF NOT EXISTS resources (
+    owner TEXT PRIMARY KEY,
+    is_public INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    gen TEXT NOT NULL DEFAULT '',
+    version INTEGER NOT NULL DEFAULT 1,
+    search_tokens INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_resources_public ON resources (owner) WHERE is_public = 1;
+CREATE TABLE IF NOT EXISTS resource_chunks (
+    owner TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    end_at INTEGER NOT NULL,
+    PRIMARY KEY (owner, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_resource_chunks_end ON resource_chunks (owner, end_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_chunks USING fts5 (
+    body,
+    tokenize = 'unicode61 remove_diacritics 0'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_chunk_terms USING fts5vocab (search_chunks, 'instance');
+CREATE TABLE IF NOT EXISTS search_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    docs INTEGER NOT NULL,
+    tokens INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO search_stats (id, docs, tokens) VALUES (1, 0, 0);
+CREATE TABLE IF NOT EXISTS refresh_tokens (
+    jti TEXT PRIMARY KEY,
+    sub TEXT NOT NULL,
+    fam TEXT NOT NULL,
+    exp INTEGER NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_refresh_tokens_exp ON refresh_tokens (exp);
+CREATE TABLE IF NOT EXISTS refresh_families (
+    fam TEXT PRIMARY KEY,
+    exp INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_refresh_families_exp ON refresh_families (exp);
+"""
+SQL_GET_USER = "SELECT id, username, hashed_password, roles FROM users WHERE username = ?"
+SQL_GET_USER_BY_ID = "SELECT id, username, hashed_password, roles FROM users WHERE id = ?"
+SQL_ADD_USER = "INSERT INTO users (id, username, hashed_password, roles) VALUES (?, ?, ?, ?)"
+SQL_IMPORT_USER = (
+    "INSERT OR REPLACE INTO users (id, username, hashed_password, roles) VALUES (?, ?, ?, ?)"
+)
+SQL_SET_ROLES = "UPDATE users SET roles = ? WHERE username = ?"
+SQL_ADD_USER_ROLE = "INSERT OR IGNORE INTO user_roles (role, username) VALUES (?, ?)"
+SQL_DELETE_USER_ROLES = "DELETE FROM user_roles WHERE username = ?"
+SQL_LIST_USERS = "SELECT username, roles FROM users WHERE username > ? ORDER BY username LIMIT ?"
+SQL_LIST_USERS_BY_ROLE = (
+    "SELECT u.username, u.roles FROM user_roles r JOIN users u ON u.username = r.username"
+    " WHERE r.role = ? AND r.username > ? ORDER BY r.username LIMIT ?"
+)
+SQL_GET_RESOURCE_META = (
+    "SELECT size, chunks, is_public, gen, version FROM resources WHERE owner = ?"
+)
+SQL_CREATE_RESOURCE = (
+    "INSERT OR IGNORE INTO resources"
+    " (owner, is_public, size, chunks, gen, version, search_tokens)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_IMPORT_RESOURCE = (
+    "INSERT OR REPLACE INTO resources"
+    " (owner, is_public, size, chunks, gen, version, search_tokens)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_UPDATE_RESOURCE = (
+    "UPDATE resources SET size = ?, chunks = ?, is_public = ?, version = ? WHERE owner = ?"
+)
+SQL_DELETE_RESOURCE = "DELETE FROM resources WHERE owner = ?"
+SQL_ADD_CHUNK = "INSERT INTO resource_chunks (owner, seq, data, end_at) VALUES (?, ?, ?, ?)"
+SQL_GET_CHUNKS = "SELECT data FROM resource_chunks WHERE owner = ? AND seq < ? ORDER BY seq"
+# первый кусок, который кончается после байта start
+SQL_FIND_CHUNK = (
+    "SELECT seq FROM resource_chunks WHERE owner = ? AND end_at > ? ORDER BY end_at LIMIT 1"
+)
+SQL_READ_CHUNKS = (
+    "SELECT seq, data, end_at FROM resource_chunks"
+    " WHERE owner = ? AND seq >= ? AND seq < ? ORDER BY seq LIMIT ?"
+)
+SQL_DELETE_CHUNKS = "DELETE FROM resource_chunks WHERE owner = ?"
+# пачки: список имен одним параметром (json), без ограничения на число "?"
+SQL_GET_RESOURCES_META = (
+    "SELECT owner, is_public, gen, version FROM resources"
+    " WHERE owner IN (SELECT value FROM json_each(?))"
+)
+SQL_GET_RESOURCES_CHUNKS = (
+    "SELECT owner, seq, data FROM resource_chunks"
+    " WHERE owner IN (SELECT value FROM json_each(?)) ORDER BY owner, seq"
+)
+SQL_LIST_PUBLIC_RESOURCES = (
+    "SELECT owner, size, gen, version FROM resources"
+    " WHERE is_public = 1 AND owner > ? ORDER BY owner LIMIT ?"
+)
+# поиск: строка search_chunks на кусок ресурса, rowid = rowid ресурса << 32 | seq
+# (rowid ресурса до 2**31), все строки ресурса - один диапазон rowid. Слово на стыке кусков лежит целиком в строке
+# следующего куска (search.chunk_rows), так что дописывание трогает только новый кусок и
+# предыдущую строку. Текст нормализуется в python (search.normalize), иначе unicode61
+# не считает ё за е. Очки BM25 - по ресурсу целиком, как в json: частоты слов по ресурсам
+# из search_chunk_terms, длины - resources.search_tokens и search_stats. Считаются
+# в SQL (_search_sql), в python приезжает только страница
+SEARCH_SEQ_MASK = 0xFFFFFFFF
+SQL_GET_RESOURCE_SEARCH = "SELECT rowid, search_tokens FROM resources WHERE owner = ?"
+SQL_INDEX_CHUNK = "INSERT INTO search_chunks (rowid, body) VALUES (?, ?)"
+SQL_GET_CHUNK_TEXT = "SELECT body FROM search_chunks WHERE rowid = ?"
+SQL_SET_CHUNK_TEXT = "UPDATE search_chunks SET body = ? WHERE rowid = ?"
+SQL_UNINDEX_CHUNKS = "DELETE FROM search_chunks WHERE rowid BETWEEN ? AND ?"
+SQL_ADD_SEARCH_TOKENS = "UPDATE resources SET search_tokens = search_tokens + ? WHERE rowid = ?"
+SQL_GET_SEARCH_STATS = "SELECT docs, tokens FROM search_stats"
+# WHERE id = 1: запрос меняет не больше одной строки и обходится без журнала оператора.
+# Иначе FTS5 перед ним сбрасывал бы на диск только что вставленные строки поиска
+SQL_ADD_SEARCH_STATS = (
+    "UPDATE search_stats SET docs = docs + ?, tokens = tokens + ? WHERE id = 1"
+)
+SQL_SEARCH_DOC_FREQ = "SELECT count(DISTINCT doc >> 32) FROM search_chunk_terms WHERE term = ?"
+# частоты слова :t{i} по ресурсам
+SQL_SEARCH_TERM_HITS = (
+    "(SELECT doc >> 32 AS rid, count(*) AS tf FROM search_chunk_terms"
+    " WHERE term = :t{i} GROUP BY rid) h{i}"
+)
+SQL_SEARCH_TERM_SCORE = ":w{i} * h{i}.tf / (h{i}.tf + (:base + :per_token * r.search_tokens))"
+SQL_GET_REFRESH_TOKEN = "SELECT sub, fam, exp, used FROM refresh_tokens WHERE jti = ?"
+SQL_SAVE_REFRESH_TOKEN = (
+    "INSERT OR REPLACE INTO refresh_tokens (jti, sub, fam, exp, used) VALUES (?, ?, ?, ?, ?)"
+)
+SQL_USE_REFRESH_TOKEN = "UPDATE refresh_tokens SET used = 1 WHERE jti = ?"
+SQL_FAMILY_REVOKED = "SELECT 1 FROM refresh_families WHERE fam = ?"
+SQL_REVOKE_FAMILY = "INSERT OR REPLACE INTO refresh_families (fam, exp) VALUES (?, ?)"
+SQL_SWEEP_REFRESH_TOKENS = "DELETE FROM refresh_tokens WHERE exp <= ?"
+SQL_SWEEP_REFRESH_FAMILIES = "DELETE FROM refresh_families WHERE exp <= ?"
+
+
+def _search_sql(terms: int) -> str:
+    """Страница поиска по terms словам: подзапрос на слово, JOIN - ресурсы со всеми словами.
+    Текст зависит только от числа слов, так что sqlite3 держит его в кэше, как и остальные.
+    Слагаемые очков в том же порядке, что и в search.rank: очки совпадают с json до бита"""
+    hits = " JOIN ".join(
+        SQL_SEARCH_TERM_HITS.format(i=i) + (f" ON h{i}.rid = h0.rid" if i else "")
+        for i in range(terms)
+    )
+    score = " + ".join(SQL_SEARCH_TERM_SCORE.format(i=i) for i in range(terms))
+    return (
+        f"SELECT r.owner, r.is_public, r.size, {score} AS score FROM {hits}"
+        " JOIN resources r ON r.rowid = h0.rid"
+        " WHERE :see_all OR r.is_public = 1 OR r.owner = :viewer"
+        " ORDER BY score DESC, r.owner LIMIT :limit OFFSET :offset"
+    )
+
+
+def _refresh_row(record: dict) -> tuple:
+    return record["sub"], record["fam"], record["exp"], bool(record["used"])
+
+
+def _user_row_to_dict(row) -> dict:
+    return {
+        "username": row[1],
+        "hashed_password": row[2],
+        "roles": loads(row[3]),
+    }
+
+
+class SqliteStorage(Storage):
+    """SQLite в режиме WAL с пулом соединений. Можно запускать несколько воркеров"""
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        with self._connection() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+
+    @classmethod
+    def _insert_resource(cls, conn, sql: str, owner: str, data: dict) -> bool:
+        """Ресурс одним куском. sql - SQL_CREATE_RESOURCE или SQL_IMPORT_RESOURCE"""
+        content = data.get("content", "")
+        size = len(content.encode("utf-8"))
+        rows = chunk_rows([content] if content else [])
+        tokens = sum(len(tokenize(text)) for text in rows)
+        cursor = conn.execute(
+            sql,
+            (
+                owner,
+                bool(data.get("is_public")),
+                size,
+                1 if content else 0,
+                data.get("gen") or new_resource_gen(),
+                data.get("version", 1),
+                tokens,
+            ),
+        )
+        if cursor.rowcount == 0:
+            return False
+        # куски от удаленного раньше ресурса с тем же именем
+        conn.execute(SQL_DELETE_CHUNKS, (owner,))
+        if content:
+            conn.execute(SQL_ADD_CHUNK, (owner, 0, content, size))
+        cls._index_rows(conn, cursor.lastrowid, rows, tokens)
+        return True
+
+    @staticmethod
+    def _index_rows(conn, rowid: int, rows: list[str], tokens: int):
+        """Строки поиска нового ресурса: search.chunk_rows его кусков, tokens - слов в них"""
+        conn.executemany(
+            SQL_INDEX_CHUNK, ((rowid << 32 | seq, text) for seq, text in enumerate(rows))
+        )
+        conn.execute(SQL_ADD_SEARCH_STATS, (1, tokens))
+
+    @staticmethod
+    def _index_appended(conn, owner: str, seq: int, content: str):
+        """Строка поиска дописанного куска seq. Недописанное слово в конце предыдущей
+        строки переезжает в новую, остальные строки не трогаются"""
+        rowid = conn.execute(SQL_GET_RESOURCE_SEARCH, (owner,)).fetchone()[0]
+        text = normalize(content)
+        tokens = len(tokenize(text))
+        if seq and text[:1].isalnum():
+            previous = rowid << 32 | seq - 1
+            head, tail = split_tail(conn.execute(SQL_GET_CHUNK_TEXT, (previous,)).fetchone()[0])
+            if tail:
+                conn.execute(SQL_SET_CHUNK_TEXT, (head, previous))
+                text = tail + text
+                # хвост и начало куска были двумя словами, стали одним
+                tokens -= 1
+        conn.execute(SQL_INDEX_CHUNK, (rowid << 32 | seq, text))
+        conn.execute(SQL_ADD_SEARCH_TOKENS, (tokens, rowid))
+        conn.execute(SQL_ADD_SEARCH_STATS, (0, tokens))
+
+    @staticmethod
+    def _unindex_resource(conn, owner: str):
+        """Убирает строки поиска ресурса до его удаления или замены"""
+        row = conn.execute(SQL_GET_RESOURCE_SEARCH, (owner,)).fetchone()
+        if row is None:
+            return
+        rowid, tokens = row
+        conn.execute(SQL_UNINDEX_CHUNKS, (rowid << 32, rowid << 32 | SEARCH_SEQ_MASK))
+        conn.execute(SQL_ADD_SEARCH_STATS, (-1, -tokens))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,  # транзакции открываем сами
+            check_same_thread=False,
+            cached_statements=64,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def get_user(self, username):
+        with self._connection() as conn:
+            row = conn.execute(SQL_GET_USER, (username,)).fetchone()
+        return None if row is None else _user_row_to_dict(row)
+
+    def get_user_by_id(self, user_id):
+        with self._connection() as conn:
+            row = conn.execute(SQL_GET_USER_BY_ID, (user_id,)).fetchone()
+        return None if row is None else _user_row_to_dict(row)
+
+    def add_user(self, user_id, data):
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    SQL_ADD_USER,
+                    (
+                        user_id,
+                        data["username"],
+                        data["hashed_password"],
+                        dumps(data["roles"]).decode(),
+                    ),
+                )
+                self._index_roles(conn, data["username"], data["roles"])
+        except sqlite3.IntegrityError:
+            raise HTTPException(status_code=409, detail="User already exists")
+
+    @staticmethod
+    def _index_roles(conn, username: str, roles: list):
+        """user_roles - индекс роль -> username, в той же транзакции, что и users"""
+        conn.execute(SQL_DELETE_USER_ROLES, (username,))
+        conn.executemany(SQL_ADD_USER_ROLE, ((role, username) for role in roles))
+
+    def set_user_roles(self, username, roles):
+        with self._transaction() as conn:
+            cursor = conn.execute(SQL_SET_ROLES, (dumps(roles).decode(), username))
+            if cursor.rowcount > 0:
+                self._index_roles(conn, username, roles)
+        return cursor.rowcount > 0
+
+    def list_users(self, role, after, limit):
+        with self._connection() as conn:
+            if role is None:
+                rows = conn.execute(SQL_LIST_USERS, (after, limit)).fetchall()
+            else:
+                rows = conn.execute(SQL_LIST_USERS_BY_ROLE, (role, after, limit)).fetchall()
+        return [{"username": row[0], "roles": loads(row[1])} for row in rows]
+
+    def list_public_resources(self, after, limit):
+        with self._connection() as conn:
+            rows = conn.execute(SQL_LIST_PUBLIC_RESOURCES, (after, limit)).fetchall()
+        return [
+            {"user_name": row[0], "size": row[1], "version": f"{row[2]}.{row[3]}"}
+            for row in rows
+        ]
+
+    def search_resources(self, terms, viewer, see_all, offset, limit):
+        if not terms:
+            return []
+        with self._connection() as conn:
+            # одна читающая транзакция: частоты, длины и ресурсы из одного снимка базы
+            conn.execute("BEGIN")
+            try:
+                doc_freqs = {}
+                for term in terms:
+                    (doc_freq,) = conn.execute(SQL_SEARCH_DOC_FREQ, (term,)).fetchone()
+                    if not doc_freq:
+                        return []
+                    doc_freqs[term] = doc_freq
+                docs, tokens = conn.execute(SQL_GET_SEARCH_STATS).fetchone()
+                # от редкого слова к частому, как SearchIndex.search
+                terms = sorted(terms, key=doc_freqs.__getitem__)
+                weights, base, per_token = bm25_params(
+                    [doc_freqs[term] for term in terms], docs, tokens
+                )
+                params = {
+                    "base": base,
+                    "per_token": per_token,
+                    "see_all": see_all,
+                    "viewer": viewer,
+                    "limit": limit,
+                    "offset": offset,
+                }
+                for i, (term, weight) in enumerate(zip(terms, weights)):
+                    params[f"t{i}"] = term
+                    params[f"w{i}"] = weight
+                rows = conn.execute(_search_sql(len(terms)), params).fetchall()
+            finally:
+                conn.execute("COMMIT")
+        return [
+            search_hit(owner, score, is_public, size) for owner, is_public, size, score in rows
+        ]
+
+    def get_resource(self, owner):
+        with self._connection() as conn:
+            row = conn.execute(SQL_GET_RESOURCE_META, (owner,)).fetchone()
+            if row is None:
+                return None
+            chunks = conn.execute(SQL_GET_CHUNKS, (owner, row[1])).fetchall()
+        return {
+            "content": "".join(chunk[0] for chunk in chunks),
+            "is_public": bool(row[2]),
+            "version": f"{row[3]}.{row[4]}",
+        }
+
+    def get_resource_meta(self, owner):
+        with self._connection() as conn:
+            row = conn.execute(SQL_GET_RESOURCE_META, (owner,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "size": row[0],
+            "chunks": row[1],
+            "is_public": bool(row[2]),
+            "version": f"{row[3]}.{row[4]}",
+        }
+
+    def read_resource(self, owner, start=0, stop=None, batch=64):
+        meta = self.get_resource_meta(owner)
+        if meta is None:
+            return None
+        if stop is None:
+            stop = meta["size"]
+        return slice_chunks(self._iter_chunks(owner, start, meta["chunks"], batch), start, stop)
+
+    def _iter_chunks(self, owner, start, chunks, batch):
+        # соединение берется на одну пачку кусков, а не на весь ответ
+        with self._connection() as conn:
+            row = conn.execute(SQL_FIND_CHUNK, (owner, start)).fetchone()
+        seq = chunks if row is None else row[0]
+        while seq < chunks:
+            with self._connection() as conn:
+                rows = conn.execute(SQL_READ_CHUNKS, (owner, seq, chunks, batch)).fetchall()
+            if not rows:
+                return
+            for row_seq, data, end_at in rows:
+                yield data, end_at
+            seq = rows[-1][0] + 1
+
+    def create_resource(self, owner, data):
+        with self._transaction() as conn:
+            return self._insert_resource(
+                conn, SQL_CREATE_RESOURCE, owner, {**data, "gen": None, "version": 1}
+            )
+
+    def append_resource(self, owner, content, is_public):
+        # новый кусок и его строка поиска, без чтения и перезаписи старого контента
+        with self._transaction() as conn:
+            row = conn.execute(SQL_GET_RESOURCE_META, (owner,)).fetchone()
+            if row is None:
+                return None
+            size, chunks, was_public, version = row[0], row[1], bool(row[2]), row[4]
+            if content:
+                size += len(content.encode("utf-8"))
+                conn.execute(SQL_ADD_CHUNK, (owner, chunks, content, size))
+                self._index_appended(conn, owner, chunks, content)
+                chunks += 1
+            if content or bool(is_public) != was_public:
+                version += 1
+            conn.execute(
+                SQL_UPDATE_RESOURCE, (size, chunks, bool(is_public), version, owner)
+            )
+        return size
+
+    def delete_resource(self, owner):
+        with self._transaction() as conn:
+            self._unindex_resource(conn, owner)
+            cursor = conn.execute(SQL_DELETE_RESOURCE, (owner,))
+            conn.execute(SQL_DELETE_CHUNKS, (owner,))
+        return cursor.rowcount > 0
+
+    def get_resources(self, owners):
+        # текст, а не bytes: blob sqlite принял бы за jsonb
+        names = dumps(list(owners)).decode()
+        with self._connection() as conn:
+            # одна читающая транзакция: ресурсы и куски из одного снимка базы
+            conn.execute("BEGIN")
+            try:
+                meta = conn.execute(SQL_GET_RESOURCES_META, (names,)).fetchall()
+                rows = conn.execute(SQL_GET_RESOURCES_CHUNKS, (names,)).fetchall()
+            finally:
+                conn.execute("COMMIT")
+        chunks: dict[str, list[str]] = {}
+        for owner, seq, data in rows:
+            chunks.setdefault(owner, []).append(data)
+        found = {
+            owner: {
+                "content": "".join(chunks.get(owner, ())),
+                "is_public": bool(is_public),
+                "version": f"{gen}.{version}",
+            }
+            for owner, is_public, gen, version in meta
+        }
+        return {owner: found.get(owner) for owner in owners}
+
+    def create_resources(self, items):
+        created = []
+        with self._transaction() as conn:
+            for owner, data in items:
+                created.append(
+                    self._insert_resource(
+                        conn, SQL_CREATE_RESOURCE, owner, {**data, "gen": None, "version": 1}
+                    )
+                )
+        return created
+
+    def delete_resources(self, owners):
+        deleted = []
+        with self._transaction() as conn:
+            for owner in owners:
+                self._unindex_resource(conn, owner)
+                deleted.append(conn.execute(SQL_DELETE_RESOURCE, (owner,)).rowcount > 0)
+                conn.execute(SQL_DELETE_CHUNKS, (owner,))
+        return deleted
+
+    def get_refresh_token(self, jti):
+        with self._connection() as conn:
+            row = conn.execute(SQL_GET_REFRESH_TOKEN, (jti,)).fetchone()
+        if row is None:
+            return None
+        return {"sub": row[0], "fam": row[1], "exp": row[2], "used": bool(row[3])}
+
+    def save_refresh_token(self, jti, record):
+        with self._transaction() as conn:
+            conn.execute(SQL_SAVE_REFRESH_TOKEN, (jti, *_refresh_row(record)))
+
+    def rotate_refresh_token(self, jti, new_jti, record, now):
+        with self._transaction() as conn:
+            row = conn.execute(SQL_GET_REFRESH_TOKEN, (jti,)).fetchone()
+            if row is None or row[2] <= now:
+                return "missing"
+            fam = row[1]
+            if conn.execute(SQL_FAMILY_REVOKED, (fam,)).fetchone() is not None:
+                return "revoked"
+            if row[3]:
+                conn.execute(SQL_REVOKE_FAMILY, (fam, record["exp"]))
+                return "reused"
+            conn.execute(SQL_USE_REFRESH_TOKEN, (jti,))
+            conn.execute(SQL_SAVE_REFRESH_TOKEN, (new_jti, *_refresh_row(record)))
+            return "ok"
+
+    def sweep_refresh_tokens(self, now):
+        with self._transaction() as conn:
+            swept = conn.execute(SQL_SWEEP_REFRESH_TOKENS, (now,)).rowcount
+            return swept + conn.execute(SQL_SWEEP_REFRESH_FAMILIES, (now,)).rowcount
+
+    def import_data(self, users, resources, refresh_tokens):
+        with self._transaction() as conn:
+            conn.executemany(
+                SQL_IMPORT_USER,
+                (
+                    (
+                        user_id,
+                        data["username"],
+                        data["hashed_password"],
+                        dumps(data["roles"]).decode(),
+                    )
+                    for user_id, data in users.items()
+                ),
+            )
+            conn.executemany(SQL_DELETE_USER_ROLES, ((data["username"],) for data in users.values()))
+            conn.executemany(
+                SQL_ADD_USER_ROLE,
+                ((role, data["username"]) for data in users.values() for role in data["roles"]),
+            )
+            for owner, data in resources.items():
+                # в sqlite ресурс приезжает одним куском, версия сохраняется
+                item = normalize_resource(data)
+                # REPLACE даст ресурсу новый rowid, старые строки поиска осиротели бы
+                self._unindex_resource(conn, owner)
+                self._insert_resource(
+                    conn,
+                    SQL_IMPORT_RESOURCE,
+                    owner,
+                    {**resource_view(item), "gen": item["gen"], "version": item["version"]},
+                )
+            for key, record in refresh_tokens.items():
+                if not isinstance(record, dict):
+                    continue
+                if key.startswith(FAMILY_PREFIX):
+                    conn.execute(
+                        SQL_REVOKE_FAMILY, (key.removeprefix(FAMILY_PREFIX), record["exp"])
+                    )
+                else:
+                    conn.execute(SQL_SAVE_REFRESH_TOKEN, (key, *_refresh_row(record)))
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
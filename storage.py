@@ -0,0 +1,1105 @@
+"""Хранилища данных. JSON файлы из db/ или SQLite (sqlite_storage.py), выбирается
+STORAGE_BACKEND в settings.env. Перенос json в sqlite и свертка журналов - storage_cli.py
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from contextlib import contextmanager, suppress
+from fastapi.exceptions import HTTPException
+from starlette.concurrency import run_in_threadpool
+import gc
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# files
+from fastjson import dumps, loads
+from metrics import span
+from search import SearchIndex
+from snapshot import (
+    MAX_SIZE,
+    UserSnapshot,
+    pack_users,
+    record_size,
+    read_header,
+    read_generation,
+    set_generation,
+    snapshot_size,
+    stamp_source,
+)
+
+# settings
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+
+def open_db(path: str) -> dict:
+    with open(path, "rb") as f:
+        raw = f.read()
+    # разбор создает миллион словарей без циклов, сборщик мусора на них только тратит время
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return loads(raw)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def save_to_db(path, data: dict, pretty: bool = settings.db_pretty):
+    """Атомарная запись: временный файл рядом, fsync, rename поверх старого.
+    При падении посреди записи на диске остается старая версия файла.
+    С отступами только при DB_PRETTY=1, компактный файл в разы быстрее"""
+    write_file_atomic(path, dumps(data, pretty))
+
+
+def write_file_atomic(path, payload: bytes):
+    """Запись через временный файл рядом, fsync и rename поверх старого"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        with suppress(FileNotFoundError):
+            # mkstemp создает файл 0600, оставляем права старого файла
+            os.chmod(tmp_path, os.stat(path).st_mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+    _fsync_dir(directory)
+
+
+def _fsync_dir(directory: str):
+    # rename попадает на диск только после fsync папки. На windows так нельзя
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Межпроцессная блокировка на path.lock (flock). На windows только блокировка потоков"""
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class Storage(ABC):
+    """Интерфейс хранилища юзеров, ресурсов и рефреш токенов"""
+
+    # юзеры
+    @abstractmethod
+    def get_user(self, username: str) -> dict | None: ...
+
+    @abstractmethod
+    def get_user_by_id(self, user_id: str) -> dict | None: ...
+
+    @abstractmethod
+    def add_user(self, user_id: str, data: dict):
+        """409, если username занят"""
+
+    @abstractmethod
+    def set_user_roles(self, username: str, roles: list) -> bool: ...
+
+    # ресурсы
+    @abstractmethod
+    def get_resource(self, owner: str) -> dict | None:
+        """{"content": ..., "is_public": ..., "version": ...}"""
+
+    @abstractmethod
+    def create_resource(self, owner: str, data: dict) -> bool:
+        """False, если ресурс уже есть"""
+
+    @abstractmethod
+    def get_resource_meta(self, owner: str) -> dict | None:
+        """{"size": байт, "chunks": кусков, "is_public": ..., "version": ...} без чтения контента.
+        version меняется при любом изменении ресурса, в том числе при пересоздании"""
+
+    @abstractmethod
+    def read_resource(self, owner: str, start: int = 0, stop: int | None = None) -> Iterator[bytes] | None:
+        """Байты контента [start, stop) в utf-8 по кускам, не собирая весь ресурс в памяти"""
+
+    @abstractmethod
+    def append_resource(self, owner: str, content: str, is_public: bool) -> int | None:
+        """Дописывает контент новым куском, возвращает новый размер в байтах
+        или None, если ресурса нет"""
+
+    @abstractmethod
+    def delete_resource(self, owner: str) -> bool: ...
+
+    # пачки: одно чтение или одна запись на всю пачку
+    @abstractmethod
+    def get_resources(self, owners: list[str]) -> dict[str, dict | None]:
+        """owner -> {"content": ..., "is_public": ...} или None, если ресурса нет"""
+
+    @abstractmethod
+    def create_resources(self, items: list[tuple[str, dict]]) -> list[bool]:
+        """Создание по порядку, False - ресурс уже был (или повтор в той же пачке)"""
+
+    @abstractmethod
+    def delete_resources(self, owners: list[str]) -> list[bool]: ...
+
+    # списки для админки: страница по возрастанию ключа, after - последний ключ прошлой страницы
+    @abstractmethod
+    def list_users(self, role: str | None, after: str, limit: int) -> list[dict]:
+        """[{"username", "roles"}] по username. role=None - все юзеры"""
+
+    @abstractmethod
+    def list_public_resources(self, after: str, limit: int) -> list[dict]:
+        """[{"user_name", "size", "version"}] публичных ресурсов по имени хозяина"""
+
+    # поиск по контенту, см. search.py
+    @abstractmethod
+    def search_resources(
+        self, terms: list[str], viewer: str | None, see_all: bool, offset: int, limit: int
+    ) -> list[dict]:
+        """[{"user_name", "score", "is_public", "size"}] ресурсов со всеми словами terms,
+        по убыванию BM25. Видны публичные, ресурс viewer и все при see_all"""
+
+    # рефреш токены: jti -> {"sub", "fam", "exp", "used"}, см. refresh_record
+    @abstractmethod
+    def get_refresh_token(self, jti: str) -> dict | None: ...
+
+    @abstractmethod
+    def save_refresh_token(self, jti: str, record: dict): ...
+
+    @abstractmethod
+    def rotate_refresh_token(self, jti: str, new_jti: str, record: dict, now: float) -> str:
+        """Атомарно: старый токен помечается использованным, новый сохраняется.
+        "ok", "missing" (нет или истек), "revoked" (семья отозвана) или
+        "reused" (токен уже меняли - семья отзывается целиком)"""
+
+    @abstractmethod
+    def sweep_refresh_tokens(self, now: float) -> int:
+        """Удаляет истекшие токены и метки отозванных семей, возвращает сколько"""
+
+    # перенос данных
+    @abstractmethod
+    def import_data(self, users: dict, resources: dict, refresh_tokens: dict): ...
+
+    def flush(self):
+        """сброс на диск отложенных изменений"""
+
+    def close(self):
+        pass
+
+
+# ресурсы хранятся кусками: {"chunks": [...], "ends": [...], "n": 2, "is_public": false,
+# "gen": "...", "version": 3}. ends - конец каждого куска в байтах utf-8 от начала
+# контента, n - сколько кусков действительно в ресурсе. Списки только растут,
+# дописывание - append в конец и новая запись с n+1, поэтому старые записи у читателей
+# остаются целыми. gen выдается при создании, version растет с каждым изменением:
+# вместе они дают ETag, который меняется и при пересоздании ресурса
+def new_resource_gen() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def chunked_resource(content: str, is_public: bool, gen: str | None = None) -> dict:
+    chunks = [content] if content else []
+    ends = [len(content.encode("utf-8"))] if content else []
+    return {
+        "chunks": chunks,
+        "ends": ends,
+        "n": len(chunks),
+        "is_public": bool(is_public),
+        "gen": gen or new_resource_gen(),
+        "version": 1,
+    }
+
+
+def _content_gen(content: str) -> str:
+    # для старых записей gen считается из контента, чтобы все процессы получили один и тот же
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+def normalize_resource(item: dict) -> dict:
+    """Старый вид {"content": "..."} -> куски"""
+    if "chunks" not in item:
+        content = item.get("content", "")
+        return chunked_resource(content, item.get("is_public", False), _content_gen(content))
+    return item
+
+
+def normalize_resources(data: dict):
+    for key, item in data.items():
+        data[key] = normalize_resource(item)
+
+
+def resource_size(item: dict) -> int:
+    n = item["n"]
+    return item["ends"][n - 1] if n else 0
+
+
+def resource_content(item: dict) -> str:
+    return "".join(islice(item["chunks"], item["n"]))
+
+
+def resource_view(item: dict) -> dict:
+    return {
+        "content": resource_content(item),
+        "is_public": item["is_public"],
+        "version": resource_version(item),
+    }
+
+
+def _user_listing(user: dict) -> dict:
+    # без хеша пароля: списки уходят наружу
+    return {"username": user["username"], "roles": user["roles"]}
+
+
+def _public_listing(owner: str, item: dict) -> dict:
+    return {"user_name": owner, "size": resource_size(item), "version": resource_version(item)}
+
+
+def search_hit(owner: str, score: float, is_public: bool, size: int) -> dict:
+    return {
+        "user_name": owner,
+        "score": round(score, 4),
+        "is_public": bool(is_public),
+        "size": size,
+    }
+
+
+def resource_version(item: dict) -> str:
+    return f"{item['gen']}.{item['version']}"
+
+
+def append_chunk(item: dict, content: str, is_public: bool) -> dict:
+    """Новая запись ресурса с дописанным куском. Вызывать под блокировкой записи"""
+    n = item["n"]
+    chunks, ends = item["chunks"], item["ends"]
+    if content:
+        # хвост после n мог остаться от записи, которую потом не применили
+        del chunks[n:], ends[n:]
+        chunks.append(content)
+        ends.append(resource_size(item) + len(content.encode("utf-8")))
+        n += 1
+    changed = bool(content) or bool(is_public) != item["is_public"]
+    return {
+        **item,
+        "n": n,
+        "is_public": bool(is_public),
+        "version": item["version"] + changed,
+    }
+
+
+def slice_chunks(pairs, start: int, stop: int) -> Iterator[bytes]:
+    """(кусок, его конец в байтах) по порядку -> байты из [start, stop)"""
+    for data, end in pairs:
+        if end <= start:
+            continue
+        raw = data.encode("utf-8")
+        begin = end - len(raw)
+        if begin >= stop:
+            break
+        yield raw[max(0, start - begin) : stop - begin]
+
+
+# рефреш токен хранится по jti: {"sub": юзер, "fam": семья, "exp": unix время, "used": false}.
+# Семья - все токены одного логина, каждый refresh выдает следующий токен той же семьи.
+# Отзыв семьи - одна запись-метка (FAMILY_PREFIX + fam), а не поиск всех ее токенов
+FAMILY_PREFIX = "family:"
+
+
+def refresh_record(sub: str, fam: str, exp: int) -> dict:
+    return {"sub": sub, "fam": fam, "exp": exp, "used": False}
+
+
+def drop_legacy_refresh_tokens(data: dict):
+    """Старый формат username -> строка токена не переносится, нужен новый логин"""
+    for key in [key for key, value in data.items() if not isinstance(value, dict)]:
+        del data[key]
+
+
+def check_rotation(data: dict, jti: str, now: float) -> tuple[str, dict | None]:
+    """Проверка токена по снимку json хранилища -> (статус, запись)"""
+    record = data.get(jti)
+    if record is None or record["exp"] <= now:
+        return "missing", None
+    if FAMILY_PREFIX + record["fam"] in data:
+        return "revoked", record
+    if record["used"]:
+        return "reused", record
+    return "ok", record
+
+
+class JsonFile:
+    """Кэш json файла в памяти процесса.
+    Файл читается один раз и перечитывается, только если поменялись его inode/mtime/size.
+
+    write_behind=True: изменения только помечают файл измененным, а flush() пишет
+    все накопленные изменения одной компактной записью"""
+
+    def __init__(self, path: str, write_behind: bool = False, prepare=None):
+        self.path = path
+        self.write_behind = write_behind
+        # prepare(data) приводит только что прочитанные данные к текущему виду
+        self.prepare = prepare
+        self.lock = threading.RLock()
+        self._lock_depth = 0
+        self._stamp = None
+        self._data: dict = {}
+        self.dirty = False
+        # вторичные индексы (GroupIndex, ContentSearch), изменения ниже обновляют их точечно
+        self.indexes: list = []
+
+    def _file_stamp(self):
+        st = os.stat(self.path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _read(self) -> dict:
+        data = open_db(self.path)
+        if self.prepare is not None:
+            self.prepare(data)
+        return data
+
+    def on_load(self, data: dict):
+        """вызывается после чтения файла, для построения индексов"""
+
+    def before_save(self):
+        """вызывается перед записью файла на диск, под его блокировкой.
+        Ошибка здесь отменяет запись"""
+
+    def on_save(self):
+        """вызывается после записи файла на диск, под его блокировкой"""
+
+    def data(self) -> dict:
+        # один stat вместо чтения и парсинга всего файла.
+        # Несброшенные изменения важнее файла на диске, их не перечитываем
+        if not self.dirty and self._stamp != self._file_stamp():
+            with self.lock:
+                stamp = self._file_stamp()
+                if not self.dirty and self._stamp != stamp:
+                    self._data = self._read()
+                    self.on_load(self._data)
+                    self._stamp = stamp
+        return self._data
+
+    @contextmanager
+    def write_lock(self):
+        """Блокировка на чтение-изменение-запись: потоки процесса и другие процессы"""
+        with self.lock:
+            self._lock_depth += 1
+            try:
+                if self._lock_depth > 1 or self.write_behind:
+                    yield
+                else:
+                    with file_lock(self.path):
+                        yield
+            finally:
+                self._lock_depth -= 1
+
+    # изменения. Вызывать под write_lock().
+    # Значения не меняются на месте, а заменяются целиком: так их можно отдавать читателям
+    def set(self, key: str, value):
+        data = self.data()
+        self._changed(key, data.get(key), value)
+        data[key] = value
+        self._commit({"op": "set", "k": key, "v": value})
+
+    def delete(self, key: str) -> bool:
+        old = self.data().pop(key, None)
+        if old is None:
+            return False
+        self._changed(key, old, None)
+        self._commit({"op": "del", "k": key})
+        return True
+
+    def append_content(self, key: str, content: str, is_public: bool) -> int | None:
+        """Дописать кусок в ресурс, вернуть новый размер в байтах"""
+        data = self.data()
+        item = data.get(key)
+        if item is None:
+            return None
+        data[key] = append_chunk(item, content, is_public)
+        self._changed(key, item, data[key])
+        self._commit(
+            {
+                "op": "append_chunk",
+                "k": key,
+                "n": item["n"],
+                "content": content,
+                "is_public": is_public,
+            }
+        )
+        return resource_size(data[key])
+
+    def set_many(self, items: dict):
+        """Несколько set одной записью на диск"""
+        self._update(items)
+        self._commit_many([{"op": "set", "k": key, "v": value} for key, value in items.items()])
+
+    def delete_many(self, keys: list[str]) -> list[bool]:
+        data = self.data()
+        deleted = []
+        for key in keys:
+            old = data.pop(key, None)
+            if old is not None:
+                self._changed(key, old, None)
+            deleted.append(old is not None)
+        records = [{"op": "del", "k": key} for key, ok in zip(keys, deleted) if ok]
+        if records:
+            self._commit_many(records)
+        return deleted
+
+    def update(self, items: dict):
+        self._update(items)
+        self.save()
+
+    def _update(self, items: dict):
+        data = self.data()
+        if self.indexes:
+            for key, value in items.items():
+                self._changed(key, data.get(key), value)
+        data.update(items)
+
+    def _changed(self, key: str, old, new):
+        for index in self.indexes:
+            index.update(key, old, new)
+
+    def _commit(self, record: dict):
+        self._commit_many([record])
+
+    def _commit_many(self, records: list[dict]):
+        self.save()
+
+    def save(self):
+        if self.write_behind:
+            self.dirty = True
+            return
+        self.before_save()
+        save_to_db(self.path, self._data)
+        self._stamp = self._file_stamp()
+        self.on_save()
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            with file_lock(self.path):
+                self.before_save()
+                save_to_db(self.path, self._data, pretty=False)
+                self._stamp = self._file_stamp()
+                self.dirty = False
+                self.on_save()
+
+    def invalidate(self):
+        """сброс кэша, следующее обращение перечитает файл"""
+        with self.lock:
+            self._stamp = None
+
+
+class GroupIndex:
+    """Вторичный индекс над словарем JsonFile: группа -> отсортированный список ключей.
+
+    entries(key, value) -> [(группа, ключ сортировки)]. Индекс строится при первой
+    странице для текущего словаря файла, дальше изменения файла правят его точечно
+    (bisect). Перечитанный файл (изменения другого процесса) - новый словарь,
+    для него индекс строится заново"""
+
+    def __init__(self, json_file: JsonFile, entries):
+        self.json_file = json_file
+        self.entries = entries
+        self._data = None
+        self._groups: dict = {}
+        json_file.indexes.append(self)
+
+    def groups(self) -> dict:
+        with self.json_file.lock:
+            data = self.json_file.data()
+            if self._data is not data:
+                groups = {}
+                for key, value in data.items():
+                    for group, sort_key in self.entries(key, value):
+                        groups.setdefault(group, []).append(sort_key)
+                for keys in groups.values():
+                    keys.sort()
+                self._groups, self._data = groups, data
+            return self._groups
+
+    def update(self, key: str, old, new):
+        # индекс для другого словаря (или еще не построен) перестроится сам
+        if self._data is not self.json_file._data:
+            return
+        if old is not None:
+            for group, sort_key in self.entries(key, old):
+                keys = self._groups.get(group, [])
+                i = bisect_left(keys, sort_key)
+                if i < len(keys) and keys[i] == sort_key:
+                    del keys[i]
+        if new is not None:
+            for group, sort_key in self.entries(key, new):
+                insort(self._groups.setdefault(group, []), sort_key)
+
+    def page(self, group, after: str, limit: int) -> list[str]:
+        keys = self.groups().get(group, [])
+        start = bisect_right(keys, after)
+        return keys[start : start + limit]
+
+
+def _user_index_entries(user_id: str, user: dict):
+    # None - все юзеры, остальные группы - роли
+    username = user["username"]
+    return [(None, username), *((role, username) for role in user["roles"])]
+
+
+def _public_index_entries(owner: str, item: dict):
+    return [(True, owner)] if item["is_public"] else []
+
+
+class ContentSearch:
+    """Поисковый индекс (search.SearchIndex) по контенту ресурсов JsonFile.
+
+    Как GroupIndex: строится при первом поиске для текущего словаря файла, дальше
+    изменения правят его точечно. Дописанный кусок индексируется один, без
+    перечитывания всего ресурса"""
+
+    def __init__(self, json_file: JsonFile):
+        self.json_file = json_file
+        self._data = None
+        self._index = SearchIndex()
+        json_file.indexes.append(self)
+
+    def index(self) -> SearchIndex:
+        with self.json_file.lock:
+            data = self.json_file.data()
+            if self._data is not data:
+                index = SearchIndex()
+                for owner, item in data.items():
+                    index.add(owner, resource_content(item), item["is_public"])
+                self._index, self._data = index, data
+            return self._index
+
+    def update(self, key: str, old, new):
+        if self._data is not self.json_file._data:
+            return
+        if new is None:
+            self._index.remove(key)
+        elif old is not None and old["gen"] == new["gen"] and new["n"] >= old["n"]:
+            # тот же ресурс, дописаны куски old["n"]..new["n"] (или сменился флаг)
+            appended = "".join(islice(new["chunks"], old["n"], new["n"]))
+            self._index.append(key, appended, new["is_public"])
+        else:
+            self._index.add(key, resource_content(new), new["is_public"])
+
+
+class UsersFile(JsonFile):
+    """db.json с индексом username -> uuid.
+
+    snapshot_path: после каждой записи db.json рядом пишется бинарный снапшот
+    (snapshot.py), по которому читают все воркеры. Сам словарь юзеров после записи
+    выбрасывается из памяти: он нужен только для следующего изменения"""
+
+    def __init__(self, path: str, write_behind: bool = False, snapshot_path: str | None = None):
+        super().__init__(path, write_behind)
+        self.by_username: dict[str, str] = {}
+        # роль -> отсортированные username, для списков в админке
+        self.roles_index = GroupIndex(self, _user_index_entries)
+        self.snapshot = UserSnapshot(snapshot_path) if snapshot_path else None
+        # (поколение, снапшот) между before_save и on_save
+        self._pending_snapshot = None
+        # сумма record_size всех юзеров, чтобы не влезающий в снапшот юзер
+        # отклонялся сразу, а не при записи
+        self.records_size = 0
+        if self.snapshot is not None:
+            self.ensure_snapshot()
+
+    def on_load(self, data: dict):
+        self.by_username = {user["username"]: user_id for user_id, user in data.items()}
+        if self.snapshot is not None:
+            self.records_size = sum(record_size(user_id, user) for user_id, user in data.items())
+
+    def records_size_with(self, key: str, value: dict) -> int:
+        """records_size после set(key, value). ValueError, если юзер не влезет в снапшот"""
+        data = self.data()
+        old = data.get(key)
+        size = self.records_size + record_size(key, value)
+        if old is not None:
+            size -= record_size(key, old)
+        if snapshot_size(len(data) + (old is None), size) > MAX_SIZE:
+            raise ValueError("Юзер не влезает в снапшот")
+        return size
+
+    def set(self, key, value):
+        if self.snapshot is not None:
+            self.records_size = self.records_size_with(key, value)
+        super().set(key, value)
+        self.by_username[value["username"]] = key
+
+    def before_save(self):
+        # снапшот собирается до записи db.json: если юзеры в него не влезают,
+        # не пишется и db.json, файлы не расходятся
+        if self.snapshot is None:
+            return
+        generation = read_generation(self.snapshot.path) + 1
+        try:
+            self._pending_snapshot = generation, pack_users(self._data, generation)
+        except Exception:
+            # данные и dirty остаются: с write_behind в словаре и чужие несброшенные изменения
+            log.exception("снапшот юзеров %s не собран, db.json не записан", self.snapshot.path)
+            raise
+
+    def on_save(self):
+        if self.snapshot is not None:
+            generation, payload = self._pending_snapshot
+            self._pending_snapshot = None
+            stamp_source(payload, self._stamp)
+            self._publish_snapshot(generation, payload)
+            self._data, self.by_username, self._stamp = {}, {}, None
+
+    def write_snapshot(self):
+        generation = read_generation(self.snapshot.path) + 1
+        self._publish_snapshot(generation, pack_users(self._data, generation, self._stamp))
+
+    def _publish_snapshot(self, generation: int, payload: bytearray):
+        write_file_atomic(self.snapshot.path, payload)
+        set_generation(self.snapshot.path, generation)
+
+    def ensure_snapshot(self):
+        """Снапшот заново, если его нет или db.json менялся в обход приложения"""
+        with self.write_lock():
+            header = read_header(self.snapshot.path)
+            if header is None or header[1] != self._file_stamp():
+                self.data()
+                self.write_snapshot()
+                self._data, self.by_username, self._stamp = {}, {}, None
+
+
+def apply_wal_record(data: dict, record: dict):
+    """Применение записи журнала. Повторное применение ничего не ломает"""
+    op, key = record["op"], record["k"]
+    if op == "set":
+        data[key] = record["v"]
+    elif op == "del":
+        data.pop(key, None)
+    elif op == "append_chunk":
+        item = data.get(key)
+        if item is None:
+            return
+        item = normalize_resource(item)
+        # если кусков уже больше, чем было до дописывания, запись уже есть в снапшоте
+        if item["n"] != record["n"]:
+            return
+        data[key] = append_chunk(item, record["content"], record["is_public"])
+
+
+def replay_wal(path: str, data: dict) -> tuple[int, int]:
+    """Проигрывает журнал поверх data.
+    Возвращает число записей и смещение конца последней целой строки"""
+    records = 0
+    valid_end = 0
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return records, valid_end
+    with f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # недописанная строка после падения
+            try:
+                record = loads(line)
+            except ValueError:
+                break
+            apply_wal_record(data, record)
+            records += 1
+            valid_end += len(line)
+    return records, valid_end
+
+
+class LoggedJsonFile(JsonFile):
+    """json снапшот + журнал изменений path.wal (jsonl).
+    Изменение дописывает в журнал одну строку вместо перезаписи всего файла.
+    Когда в журнале compact_every записей, в фоне пишется новый снапшот,
+    а журнал очищается. Записи журнала идемпотентны, поэтому падение между
+    записью снапшота и очисткой журнала безопасно"""
+
+    def __init__(
+        self, path: str, compact_every: int = 10000, fsync: bool = True, prepare=None
+    ):
+        super().__init__(path, prepare=prepare)
+        self.wal_path = path + ".wal"
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.wal_records = 0
+        self._wal_valid_end = 0
+        self._wal = None
+        self._compacting = False
+
+    def _file_stamp(self):
+        try:
+            wal = os.stat(self.wal_path)
+            wal_stamp = wal.st_ino, wal.st_size
+        except FileNotFoundError:
+            wal_stamp = None
+        return super()._file_stamp(), wal_stamp
+
+    def _read(self) -> dict:
+        self._close_wal()
+        data = open_db(self.path)
+        self.wal_records, self._wal_valid_end = replay_wal(self.wal_path, data)
+        # после журнала: ресурсы старого вида в снапшоте, которых журнал не коснулся
+        if self.prepare is not None:
+            self.prepare(data)
+        return data
+
+    def _open_wal(self):
+        if self._wal is None:
+            with suppress(FileNotFoundError):
+                # хвост от недописанной записи обрезаем, иначе новые строки встанут после него
+                if os.path.getsize(self.wal_path) > self._wal_valid_end:
+                    os.truncate(self.wal_path, self._wal_valid_end)
+            self._wal = open(self.wal_path, "ab")
+        return self._wal
+
+    def _close_wal(self):
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+    def _commit_many(self, records: list[dict]):
+        # пачка записей - одна запись в файл и один fsync
+        encoded = b"".join(dumps(record) + b"\n" for record in records)
+        wal = self._open_wal()
+        wal.write(encoded)
+        wal.flush()
+        if self.fsync:
+            os.fsync(wal.fileno())
+        self.wal_records += len(records)
+        self._wal_valid_end += len(encoded)
+        self._stamp = self._file_stamp()
+        if self.wal_records >= self.compact_every and not self._compacting:
+            self._compacting = True
+            threading.Thread(
+                target=self.compact, name="wal-compaction", daemon=True
+            ).start()
+
+    def save(self):
+        """Снапшот всего состояния и пустой журнал"""
+        save_to_db(self.path, self._data, pretty=False)
+        self._close_wal()
+        with open(self.wal_path, "wb"):
+            pass
+        self.wal_records = 0
+        self._wal_valid_end = 0
+        self._stamp = self._file_stamp()
+
+    def compact(self):
+        try:
+            with self.write_lock():
+                self.data()
+                self.save()
+        finally:
+            self._compacting = False
+
+
+class JsonStorage(Storage):
+    """Текущие json файлы из db/.
+    flush_interval > 0 включает отложенную запись: пачка изменений сбрасывается
+    на диск раз в flush_interval секунд. Так можно только с одним процессом.
+    wal=True: ресурсы и рефреш токены пишутся в журнал (LoggedJsonFile)"""
+
+    def __init__(
+        self,
+        users_path: str,
+        resources_path: str,
+        tokens_path: str,
+        flush_interval: float = 0.0,
+        wal: bool = False,
+        wal_compact_every: int = 10000,
+        wal_fsync: bool = True,
+        users_snapshot: str | None = None,
+    ):
+        write_behind = flush_interval > 0
+        self.users = UsersFile(users_path, write_behind, users_snapshot)
+        if wal:
+            self.resources = LoggedJsonFile(
+                resources_path, wal_compact_every, wal_fsync, prepare=normalize_resources
+            )
+            self.refresh_tokens = LoggedJsonFile(
+                tokens_path,
+                wal_compact_every,
+                wal_fsync,
+                prepare=drop_legacy_refresh_tokens,
+            )
+        else:
+            self.resources = JsonFile(
+                resources_path, write_behind, prepare=normalize_resources
+            )
+            self.refresh_tokens = JsonFile(
+                tokens_path, write_behind, prepare=drop_legacy_refresh_tokens
+            )
+        self._files = (self.users, self.resources, self.refresh_tokens)
+        # хозяева публичных ресурсов по порядку
+        self.public_resources = GroupIndex(self.resources, _public_index_entries)
+        self.content_search = ContentSearch(self.resources)
+        self._stop = threading.Event()
+        self._flusher = None
+        if write_behind:
+            self._flusher = threading.Thread(
+                target=self._flush_loop,
+                args=(flush_interval,),
+                name="json-flusher",
+                daemon=True,
+            )
+            self._flusher.start()
+
+    def _flush_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                # изменения остаются несброшенными до следующей попытки
+                log.exception("фоновая запись json не удалась")
+
+    def flush(self):
+        for json_file in self._files:
+            json_file.flush()
+
+    def compact(self):
+        """Снапшоты и пустые журналы для файлов с журналом"""
+        for json_file in self._files:
+            if isinstance(json_file, LoggedJsonFile):
+                json_file.compact()
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def get_user(self, username):
+        # несброшенные изменения (write_behind) есть только в словаре, не в снапшоте
+        if self.users.snapshot is not None and not self.users.dirty:
+            return self.users.snapshot.get(username)
+        users = self.users.data()
+        user_id = self.users.by_username.get(username)
+        if user_id is None:
+            return None
+        return users[user_id]
+
+    def get_user_by_id(self, user_id):
+        return self.users.data().get(user_id)
+
+    def add_user(self, user_id, data):
+        with self.users.write_lock():
+            self.users.data()
+            if data["username"] in self.users.by_username:
+                raise HTTPException(status_code=409, detail="User already exists")
+            if self.users.snapshot is not None:
+                try:
+                    self.users.records_size_with(user_id, data)
+                except ValueError as e:
+                    raise HTTPException(status_code=413, detail=str(e))
+            self.users.set(user_id, data)
+
+    def set_user_roles(self, username, roles):
+        with self.users.write_lock():
+            users = self.users.data()
+            user_id = self.users.by_username.get(username)
+            if user_id is None:
+                return False
+            self.users.set(user_id, {**users[user_id], "roles": roles})
+            return True
+
+    def get_resource(self, owner):
+        item = self.resources.data().get(owner)
+        if item is None:
+            return None
+        return resource_view(item)
+
+    def get_resource_meta(self, owner):
+        item = self.resources.data().get(owner)
+        if item is None:
+            return None
+        return {
+            "size": resource_size(item),
+            "chunks": item["n"],
+            "is_public": item["is_public"],
+            "version": resource_version(item),
+        }
+
+    def read_resource(self, owner, start=0, stop=None):
+        item = self.resources.data().get(owner)
+        if item is None:
+            return None
+        n, chunks, ends = item["n"], item["chunks"], item["ends"]
+        if stop is None:
+            stop = resource_size(item)
+        # первый кусок, который кончается после start
+        first = bisect_right(ends, start, 0, n)
+        return slice_chunks(
+            zip(islice(chunks, first, n), islice(ends, first, n)), start, stop
+        )
+
+    def create_resource(self, owner, data):
+        with self.resources.write_lock():
+            if owner in self.resources.data():
+                return False
+            self.resources.set(
+                owner, chunked_resource(data.get("content", ""), data.get("is_public"))
+            )
+            return True
+
+    def append_resource(self, owner, content, is_public):
+        with self.resources.write_lock():
+            return self.resources.append_content(owner, content, is_public)
+
+    def delete_resource(self, owner):
+        with self.resources.write_lock():
+            return self.resources.delete(owner)
+
+    def get_resources(self, owners):
+        data = self.resources.data()
+        result = {}
+        for owner in owners:
+            item = data.get(owner)
+            result[owner] = None if item is None else resource_view(item)
+        return result
+
+    def create_resources(self, items):
+        with self.resources.write_lock():
+            data = self.resources.data()
+            created, new_items = [], {}
+            for owner, item in items:
+                ok = owner not in data and owner not in new_items
+                created.append(ok)
+                if ok:
+                    new_items[owner] = chunked_resource(
+                        item.get("content", ""), item.get("is_public")
+                    )
+            if new_items:
+                self.resources.set_many(new_items)
+            return created
+
+    def delete_resources(self, owners):
+        with self.resources.write_lock():
+            return self.resources.delete_many(owners)
+
+    def list_users(self, role, after, limit):
+        with self.users.lock:
+            users = self.users.data()
+            return [
+                _user_listing(users[self.users.by_username[username]])
+                for username in self.users.roles_index.page(role, after, limit)
+            ]
+
+    def list_public_resources(self, after, limit):
+        with self.resources.lock:
+            data = self.resources.data()
+            return [
+                _public_listing(owner, data[owner])
+                for owner in self.public_resources.page(True, after, limit)
+            ]
+
+    def search_resources(self, terms, viewer, see_all, offset, limit):
+        with self.resources.lock:
+            data = self.resources.data()
+            hits = self.content_search.index().search(terms, viewer, see_all, offset, limit)
+            return [
+                search_hit(owner, score, data[owner]["is_public"], resource_size(data[owner]))
+                for owner, score in hits
+            ]
+
+    def get_refresh_token(self, jti):
+        return self.refresh_tokens.data().get(jti)
+
+    def save_refresh_token(self, jti, record):
+        with self.refresh_tokens.write_lock():
+            self.refresh_tokens.set(jti, record)
+
+    def rotate_refresh_token(self, jti, new_jti, record, now):
+        with self.refresh_tokens.write_lock():
+            status, old = check_rotation(self.refresh_tokens.data(), jti, now)
+            if status == "reused":
+                # метка живет, пока может быть жив последний токен семьи
+                self.refresh_tokens.set(FAMILY_PREFIX + old["fam"], {"exp": record["exp"]})
+            elif status == "ok":
+                self.refresh_tokens.set_many({jti: {**old, "used": True}, new_jti: record})
+            return status
+
+    def sweep_refresh_tokens(self, now):
+        with self.refresh_tokens.write_lock():
+            expired = [
+                key
+                for key, record in self.refresh_tokens.data().items()
+                if record["exp"] <= now
+            ]
+            if expired:
+                self.refresh_tokens.delete_many(expired)
+            return len(expired)
+
+    def import_data(self, users, resources, refresh_tokens):
+        resources = {owner: normalize_resource(item) for owner, item in resources.items()}
+        refresh_tokens = dict(refresh_tokens)
+        drop_legacy_refresh_tokens(refresh_tokens)
+        for json_file, data in zip(self._files, (users, resources, refresh_tokens)):
+            with json_file.write_lock():
+                json_file.update(data)
+                json_file.invalidate()
+
+
+class AsyncStorage:
+    """Асинхронная обертка над Storage. Каждый вызов уходит в пул потоков,
+    так что диск и sqlite не блокируют event loop: await store.get_user(...)"""
+
+    def __init__(self, storage: Storage):
+        self.sync = storage
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+
+        def timed(*args, **kwargs):
+            # замер в потоке пула: только работа хранилища, без ожидания в очереди
+            with span("db", name):
+                return method(*args, **kwargs)
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(timed, *args, **kwargs)
+
+        return call
+
+
+def create_storage(backend: str = settings.storage_backend) -> Storage:
+    if backend == "sqlite":
+        # sqlite_storage сам импортирует отсюда базовый класс и общие функции
+        from sqlite_storage import SqliteStorage
+
+        return SqliteStorage(settings.sqlite_path, pool_size=settings.sqlite_pool_size)
+    if backend == "json":
+        return JsonStorage(
+            settings.db,
+            settings.db_resources,
+            settings.db_refresh_tokens,
+            flush_interval=settings.db_flush_interval,
+            wal=settings.db_wal,
+            wal_compact_every=settings.db_wal_compact_every,
+            wal_fsync=settings.db_wal_fsync,
+            users_snapshot=settings.users_snapshot,
+        )
+    raise ValueError(f"Неизвестный STORAGE_BACKEND: {backend}")
@@ -0,0 +1,51 @@
+"""Обслуживание хранилища из командной строки.
+
+Перенос json в sqlite:
+    python storage_cli.py migrate
+Свернуть журналы (DB_WAL=1) в снапшоты:
+    python storage_cli.py compact
+"""
+import argparse
+
+# files
+from sqlite_storage import SqliteStorage
+from storage import JsonStorage, open_db
+
+# settings
+from settings import settings
+
+
+def migrate(sqlite_path: str = settings.sqlite_path):
+    """Импорт db/*.json в sqlite. Повторный запуск перезаписывает записи с теми же ключами"""
+    target = SqliteStorage(sqlite_path, pool_size=1)
+    try:
+        target.import_data(
+            open_db(settings.db),
+            open_db(settings.db_resources),
+            open_db(settings.db_refresh_tokens),
+        )
+    finally:
+        target.close()
+
+
+def compact():
+    """Свернуть журналы db/*.wal в снапшоты"""
+    target = JsonStorage(
+        settings.db, settings.db_resources, settings.db_refresh_tokens, wal=True
+    )
+    target.compact()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Управление хранилищем")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="импорт db/*.json в sqlite")
+    migrate_parser.add_argument("--sqlite-path", default=settings.sqlite_path)
+    commands.add_parser("compact", help="свернуть журналы db/*.wal в снапшоты")
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate(args.sqlite_path)
+        print(f"json из db/ импортирован в {args.sqlite_path}")
+    elif args.command == "compact":
+        compact()
+        print("журналы свернуты")